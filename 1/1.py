@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import  wx
-from socket import *
-import threading
-import time
-from concurrent.futures import ThreadPoolExecutor
+from chat_engine import ChatEngine
+from metrics import MetricsServer
+from offline import MailboxStore
+from search import SearchIndex
+from transcript import TranscriptLog
+from ui_buffer import MessageView
 # 服务器
 class MsbServer(wx.Frame):
 
@@ -29,85 +31,68 @@ class MsbServer(wx.Frame):
         box.Add(self.text, 1, wx.ALIGN_CENTER)
         pl.SetSizer(box)
         '''以上代码窗口结束 '''
-        # 创建一个拥有10个工作线程的线程池
-        self.executor = ThreadPoolExecutor(max_workers=10)
 
         '''服务准备执行的一些属性'''
-        self.isOn = False # 服务器没有启动
-        self.host_port= ('',8888)
-        self.server_socket = socket(AF_INET,SOCK_STREAM) # TCP协议的服务器端套接字
-        self.server_socket.bind(self.host_port)
-        self.server_socket.listen(5)
-        self.session_thread_map={} # 存放所有的服务器会话线程，字典：客户端名字为Key，会话线程为Value
+        # 服务器的收发都交给无界面的 ChatEngine，这个窗口只负责显示
+        self.engine = None
+        self.host_port = ('', 8888)
+        # 聊天记录由 TranscriptLog 自动追加到 records 目录，文本框只显示最近的消息，更早的用 Ctrl+PageUp 翻页
+        self.transcript = None
+        self.search = None  # 聊天记录的全文搜索索引，客户端可以按关键词、发送者、时间搜索
+        self.mailboxes = None  # 私信的信箱（offline.MailboxStore），和聊天记录一样跨越服务器的重启
+        self.view = MessageView(self.text)
+        # 运行指标：浏览器或 Prometheus 访问 http://127.0.0.1:9100/metrics
+        self.metrics_port = 9100
+        self.metrics_server = None
 
         '''给所有的按钮绑定相应的动作'''
         self.Bind(wx.EVT_BUTTON,self.start_server,start_server_button) #给启动按钮，绑定一个按钮事件，事件触发的时候会自动调用一个函数
         self.Bind(wx.EVT_BUTTON,self.save_record,record_save_button)
+        self.Bind(wx.EVT_BUTTON,self.stop_server,stop_server_button)
 
+    @property
+    def isOn(self):
+        return self.engine is not None and self.engine.isOn
 
     #服务器开始启动函数
     def start_server(self,event):
         print('服务器开始启动')
-        if not self.isOn:
-            #启动服务器的主线程
-            self.isOn =True
-            main_thread = threading.Thread(target=self.do_work)
-            main_thread.setDaemon(True) #设置为守护线程
-            main_thread.start()
+        if self.engine is None:
+            if self.transcript is None:
+                self.transcript = TranscriptLog('records')
+            if self.mailboxes is None:
+                self.mailboxes = MailboxStore('mailboxes')  # 私信的信箱，用户不在线时先存着
+            if self.search is None:
+                self.search = SearchIndex('records/search.db')
+                self.search.catch_up('records')  # 以前的聊天记录也能搜到
+            self.engine = ChatEngine(self.host_port, transcript=self.transcript, mailboxes=self.mailboxes,
+                                     search=self.search)
+            self.engine.add_listener(self.show_info)
+            self.engine.start() # 事件循环在后台守护线程里运行
+            try:
+                self.metrics_server = MetricsServer(self.engine.metrics,port=self.metrics_port).start()
+            except OSError as e:
+                print('运行指标的端口%d打不开：%s' %(self.metrics_port,e))
 
-    #服务运行之后的函数
-    def do_work(self):
-        print("服务器开始工作")
-        while self.isOn:
-            session_socket,client_addr = self.server_socket.accept()
-            #服务首先接受客户端发过来的第一条消息，我们规定第一条消息为客户端的名字
-            username = session_socket.recv(1024).decode('UTF-8') #接受客户端名字
-            #创建一个会话线程
-            session_thread =  SessionThread(session_socket,username,self)
-            self.session_thread_map[username] = session_thread
-            # 使用线程池处理连接
-            self.executor.submit(session_thread.run)
-            # 表示有客户端进入到聊天室
-            self.show_info_and_send_client("服务器通知","欢迎%s进入聊天室！"%username,time.strftime('%Y-%m-%d %H:%M:%S',time.localtime()))
-        self.server_socket.close()
+    #服务器停止函数
+    def stop_server(self,event):
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
 
+    #在文本中显示聊天信息，由引擎线程回调，放进缓冲区后由界面线程按帧批量刷新
+    def show_info(self,send_data):
+        self.view.post('---------------------------------\n%s' %send_data)
 
-    #在文本中显示聊天信息，同时发送消息给所有客户端 ,source：信息源，data就是信息，
-    def show_info_and_send_client(self,source,data,data_time):
-        send_data = '%s : %s\n时间：%s\n' %(source,data,data_time)
-        self.text.AppendText('---------------------------------\n%s' %send_data) #在服务器的文本框显示信息
-        for client in self.session_thread_map.values():
-            if client.isOn: #当前客户端是活动
-                client.user_socket.send(send_data.encode('UTF-8'))
-
-    #服务保存聊天记录
+    #服务保存聊天记录：记录一直在自动追加，这里只是马上落盘
     def save_record(self,event):
-        record = self.text.GetValue()
-        with open("record.log","w+") as f:
-            f.write(record)
-
-
-# 服务器端会话线程的类
-class SessionThread(threading.Thread):
-    def __init__(self,socket,un,server):
-        threading.Thread.__init__(self)
-        self.user_socket=socket
-        self.username =un
-        self.server =server
-        self.isOn = True # 会话线程是否启动
+        if self.transcript is not None:
+            self.transcript.flush()
+            print('聊天记录已经保存到%s目录' %self.transcript.directory)
 
-    def run(self): # 会话线程的运行
-        print('客户端%s,已经和服务器连接成功，服务器启动一个会话线程'%self.username)
-        while self.isOn:
-            data = self.user_socket.recv(1024).decode('UTF-8') #接受客户端的聊天信息
-            if data == 'A^disconnect^B': # 如果客户端点击断开按钮，先发一条消息给服务器：消息的内容我们规定：A^disconnect^B
-                self.isOn = False
-                # 有用户离开，需要在聊天室通知其他人
-                self.server.show_info_and_send_client("服务器通知","%s离开聊天室！"%self.username,time.strftime('%Y-%m-%d %H:%M:%S',time.localtime()))
-            else:
-                # 其他聊天信息，我们应该显示给所有客户端，包括服务器
-                self.server.show_info_and_send_client(self.username,data,time.strftime('%Y-%m-%d %H:%M:%S',time.localtime()))
-        self.user_socket.close() # 保持和客户端会话的socket关掉
 
 if __name__ == '__main__':
     app = wx.App()
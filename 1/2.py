@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import wx
-from socket import *
+import asyncio
 import threading
+import protocol
+from chat_client import ChatClient, DISCONNECTED, RECONNECTED
+from ui_buffer import MessageView
 # 客户端
 # 客户端继承 wx.Frame，就拥有窗口界面
 class MsbClient(wx.Frame):
@@ -24,6 +27,8 @@ class MsbClient(wx.Frame):
         #创建聊天内容的文本框，不能写消息 :TE_MULTILINE -->多行  TE_READONLY-->只读
         self.text =  wx.TextCtrl(pl,size=(400,250),style =wx.TE_MULTILINE | wx.TE_READONLY)
         box.Add(self.text,1,wx.ALIGN_CENTER)
+        # 收到的消息先进缓冲区，界面按帧批量刷新，只显示最近的消息，Ctrl+PageUp 翻看更早的
+        self.view = MessageView(self.text)
 
         #创建聊天的输入文本框,可以写
         self.input_text = wx.TextCtrl(pl, size=(400, 100), style=wx.TE_MULTILINE )
@@ -50,47 +55,99 @@ class MsbClient(wx.Frame):
 
         '''客户端的属性'''
         self.name =c_name
-        self.isConnected = False #客户端是否已经连上服务器
-        self.client_socket = None
+        # 收发都交给 chat_client.ChatClient，它运行在后台线程的 asyncio 事件循环里，界面只负责显示
+        self.client = None
+        self.loop = None
+
+    @property
+    def isConnected(self): #客户端是否已经连上服务器
+        return self.client is not None and self.client.isConnected
 
 
     # 连接服务器
     def connect_to_server(self,event):
         print("客户端%s,开始连接服务器"%self.name)
-        if not self.isConnected:
-            server_host_port = ('localhost',8888)
-            self.client_socket = socket(AF_INET,SOCK_STREAM)
-            self.client_socket.connect(server_host_port)
-            # 之前规定，客户端只要连接成功，马上把自己的名字发给服务器
-            self.client_socket.send(self.name.encode('UTF-8'))
-            t  = threading.Thread(target=self.receive_data)
-            t.setDaemon(True) # 客户端UI界面如果关闭，当前守护线程也自动关闭
-            self.isConnected = True
-            t.start()
-
-    # 接受服务器发送过来的聊天数据
-    def receive_data(self):
+        if self.client is None:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                t = threading.Thread(target=self.loop.run_forever)
+                t.setDaemon(True) # 客户端UI界面如果关闭，当前守护线程也自动关闭
+                t.start()
+            self.client = ChatClient(self.name,('localhost',8888))
+            asyncio.run_coroutine_threadsafe(self.receive_data(self.client),self.loop)
+
+    # 接受服务器发送过来的聊天数据（在后台事件循环里运行）
+    async def receive_data(self,client):
+        try:
+            await client.connect() # 连上之后马上把自己的名字放在 JOIN 帧里发给服务器
+        except OSError as e:
+            print("客户端%s连接服务器失败：%s"%(self.name,e))
+            if self.client is client:
+                self.client = None
+            return
         print("客户端准备接收服务器的数据")
-        while self.isConnected:
-            data =self.client_socket.recv(1024).decode('UTF-8')
-            # 从服务器接收到的数据，需要显示
-            self.text.AppendText('%s\n'%data)
+        # 进来先看看大家最近聊了什么
+        await client.history(last=50)
+        async for message in client:
+            if message.type == protocol.CHAT:
+                msg = message.body
+                data = '%s : %s\n时间：%s\n' %(msg['source'],msg['data'],msg['time'])
+                # 从服务器接收到的数据，交给界面线程显示
+                self.view.post('%s\n'%data)
+            elif message.type == protocol.DM:
+                msg = message.body
+                self.view.post('[私信] %s : %s\n时间：%s\n\n' %(msg['source'],msg['data'],msg['time']))
+            elif message.type == DISCONNECTED:
+                self.view.post('与服务器的连接断开了，正在重新连接...\n\n')
+            elif message.type == RECONNECTED:
+                self.view.post('重新连上了服务器\n\n')
 
 
     #客户端发送信息到聊天室
     def send_to(self,event):
-        if self.isConnected:
+        if self.client is not None: # 正在重连时发的消息会先存着，连上后补发
             info = self.input_text.GetValue()
-            if info != '':
-                self.client_socket.send(info.encode('UTF-8'))
+            if info.startswith('/搜索 '):
+                # "/搜索 关键词" 在聊天记录里搜索，结果显示在聊天框里
+                asyncio.run_coroutine_threadsafe(self.search(self.client, info[4:]),self.loop)
+                self.input_text.SetValue('')
+            elif info.startswith('@') and ' ' in info:
+                # "@名字 内容" 是私信，对方不在线时服务器先存着
+                to, data = info[1:].split(' ', 1)
+                asyncio.run_coroutine_threadsafe(self.send_dm(self.client, to, data),self.loop)
+                self.input_text.SetValue('')
+            elif info != '':
+                asyncio.run_coroutine_threadsafe(self.client.send(info),self.loop)
                 #输入框中的数据如果已经发送了，输入框重新为空
                 self.input_text.SetValue('')
 
+    async def send_dm(self,client,to,data):
+        try:
+            ack = await client.send_dm(to, data)
+        except (OSError, ConnectionError) as e:
+            self.view.post('私信没有发出去：%s\n\n' % e)
+            return
+        tip = '' if ack['online'] else '（%s不在线，上线后会收到）' % to
+        self.view.post('[私信给%s] %s%s\n\n' % (to, data, tip))
+
+    async def search(self,client,q):
+        try:
+            reply = await client.search(q=q)
+        except (OSError, ConnectionError) as e:
+            self.view.post('搜索失败：%s\n\n' % e)
+            return
+        lines = ['搜索“%s”，最近的%d条：\n' % (q, len(reply['results']))]
+        for msg in reply['results']:
+            lines.append('  %s %s : %s\n' % (msg['time'], msg['source'], msg['data']))
+        self.view.post(''.join(lines) + '\n')
+
     # 客户端离开聊天
     def go_out(self,event):
-        self.client_socket.send('A^disconnect^B'.encode('UTF-8'))
-        # 客户端主线程也关闭
-        self.isConnected = False
+        if self.client is None:
+            return
+        # 发 LEAVE 帧并关闭连接，之后不再自动重连
+        asyncio.run_coroutine_threadsafe(self.client.close(),self.loop)
+        self.client = None
 
 
     # 客户端输入框的信息重置
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+'''
+广播吞吐量和每条消息的系统调用次数：
+
+    python bench_broadcast.py --clients 200 --messages 2000
+
+--mode loop   原来 show_info_and_send_client 的做法：每条消息对每个客户端各格式化、编码、send 一次
+--mode engine ChatEngine：消息只编码一次，按节拍把每个客户端积压的帧合成一次 sendmsg
+
+服务器在子进程里运行；一个发送者连续发出 --messages 条聊天，主进程里的 --clients 个接收者
+全部收齐后计时。messages/s 按“发出的聊天条数 / 用时”计算，系统调用次数是服务器发送数据用的
+send/sendmsg 调用总数除以消息数。
+'''
+import argparse
+import json
+import multiprocessing
+import selectors
+import threading
+import time
+from socket import *
+
+import protocol
+from chat_engine import ChatEngine, now_str
+
+
+def run_engine(conn, flush_interval):
+    engine = ChatEngine(('127.0.0.1', 0), backlog=1024, max_queue_frames=100000,
+                        max_queue_bytes=1 << 30, flush_interval=flush_interval)
+    engine.start()
+    engine.ready.wait()
+    conn.send(engine.address[1])
+    while conn.recv():  # 主进程要统计结果
+        conn.send(engine.stats['send_calls'])
+
+
+def run_loop(conn, flush_interval):
+    # 原来的模型：每个会话一个线程，广播时在发送者的线程里逐个客户端阻塞 send
+    server_socket = socket(AF_INET, SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1024)
+    conn.send(server_socket.getsockname()[1])
+    clients = {}
+    lock = threading.Lock()
+    counter = {'send_calls': 0}
+
+    def show_info_and_send_client(source, data, data_time):
+        with lock:
+            for client in list(clients.values()):
+                body = {'source': source, 'data': data, 'time': data_time}
+                client.sendall(protocol.encode_frame(protocol.CHAT, body))
+                counter['send_calls'] += 1
+
+    def session(sock):
+        decoder = protocol.FrameDecoder()
+        name = None
+        while True:
+            frames = protocol.recv_frames(sock, decoder)
+            if frames is None:
+                return
+            for frame in frames:
+                body = protocol.decode_body(frame.payload)
+                if frame.type == protocol.JOIN:
+                    name = body['name']
+                    with lock:
+                        clients[name] = sock
+                    sock.sendall(protocol.encode_frame(protocol.ACK, {'name': name}))
+                    show_info_and_send_client('服务器通知', '欢迎%s进入聊天室！' % name, now_str())
+                elif frame.type == protocol.CHAT:
+                    show_info_and_send_client(name, body['data'], now_str())
+
+    def accept():
+        while True:
+            sock, _ = server_socket.accept()
+            t = threading.Thread(target=session, args=(sock,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    while conn.recv():
+        conn.send(counter['send_calls'])
+
+
+def measure(mode, clients, messages, flush_interval):
+    parent, child = multiprocessing.Pipe()
+    target = run_engine if mode == 'engine' else run_loop
+    server = multiprocessing.Process(target=target, args=(child, flush_interval))
+    server.daemon = True
+    server.start()
+    port = parent.recv()
+
+    selector = selectors.DefaultSelector()
+    states = []
+    for i in range(clients):
+        sock = create_connection(('127.0.0.1', port))
+        sock.sendall(protocol.encode_frame(protocol.JOIN, {'name': 'recv%d' % i}))
+        sock.setblocking(False)
+        state = {'decoder': protocol.FrameDecoder(), 'count': 0}
+        selector.register(sock, selectors.EVENT_READ, state)
+        states.append(state)
+    sender = create_connection(('127.0.0.1', port))
+    sender.sendall(protocol.encode_frame(protocol.JOIN, {'name': 'sender'}))
+    # 发送者自己也会收到广播，要一直读掉，否则它的接收缓冲区满了会卡住原来的阻塞 send
+    def drain_sender():
+        while sender.recv(65536):
+            pass
+
+    drain = threading.Thread(target=drain_sender)
+    drain.daemon = True
+    drain.start()
+
+    def receive(timeout):
+        # 读一轮，返回这一轮收到的帧数
+        got = 0
+        for key, _ in selector.select(timeout):
+            state = key.data
+            try:
+                n = key.fileobj.recv_into(state['decoder'].buffer())
+            except BlockingIOError:
+                continue
+            state['decoder'].advance(n)
+            count = sum(1 for _ in state['decoder'].frames())
+            state['count'] += count
+            got += count
+        return got
+
+    # 先把登录的 ACK 和欢迎通知读完：0.5 秒内再没有新数据就算读完了
+    while receive(0.5):
+        pass
+    for state in states:
+        state['count'] = 0
+    frames = [protocol.encode_frame(protocol.CHAT, {'data': '第%d条消息，大家好' % i}) for i in range(messages)]
+
+    parent.send('stats')
+    base_calls = parent.recv()
+    start = time.perf_counter()
+    sender_thread = threading.Thread(target=sender.sendall, args=(b''.join(frames),))
+    sender_thread.start()
+    while any(state['count'] < messages for state in states):
+        receive(1)
+    cost = time.perf_counter() - start
+    sender_thread.join()
+    parent.send('stats')
+    send_calls = parent.recv() - base_calls
+    parent.send('')
+    server.terminate()
+    server.join()
+    return cost, send_calls
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='广播吞吐量和每条消息的系统调用次数')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--mode', choices=['loop', 'engine', 'both'], default='both')
+    parser.add_argument('--flush-interval', type=float, default=0.001)
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    modes = ['loop', 'engine'] if args.mode == 'both' else [args.mode]
+    results = []
+    for mode in modes:
+        cost, send_calls = measure(mode, args.clients, args.messages, args.flush_interval)
+        row = {'mode': mode, 'clients': args.clients, 'messages': args.messages, 'seconds': cost,
+               'messages_per_sec': args.messages / cost,
+               'send_calls': send_calls, 'send_calls_per_message': send_calls / args.messages}
+        results.append(row)
+        print('%-6s 客户端:%d 消息:%d 用时:%.3fs  %.0f 条/s  每条消息 %.1f 次发送调用' % (
+            mode, args.clients, args.messages, cost, row['messages_per_sec'], row['send_calls_per_message']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+多进程模式的吞吐量：
+
+    python bench_cluster.py --workers 1 2 4 --client-procs 4 --receivers 50 --messages 500
+
+对每个 --workers 取值启动一套 cluster（BusHub + N 个工作进程），再起 --client-procs 个客户端进程，
+每个客户端进程里有 --receivers 个接收者和 1 个发送者，发送者各发 --messages 条聊天。
+每个接收者都要收到所有发送者的全部消息（可能经过总线从别的工作进程转过来），
+统计服务器每秒投递给客户端的消息数，并检查同一个发送者的消息顺序没有乱。
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import tempfile
+import threading
+import time
+from socket import *
+
+import protocol
+from cluster import BusHub, start_workers
+
+
+def free_port():
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run_server(workers, port, bus_path):
+    hub = BusHub(bus_path)
+    processes = start_workers(workers, ('127.0.0.1', port), bus_path, max_queue_frames=100000,
+                              max_queue_bytes=1 << 30)
+    try:
+        hub.serve_forever()
+    finally:
+        for p in processes:
+            p.terminate()
+
+
+def run_clients(index, port, receivers, messages, senders, barrier, result_queue):
+    selector = selectors.DefaultSelector()
+    states = []
+    for i in range(receivers):
+        sock = create_connection(('127.0.0.1', port))
+        sock.sendall(protocol.encode_frame(protocol.JOIN, {'name': 'recv%d-%d' % (index, i)}))
+        sock.setblocking(False)
+        state = {'decoder': protocol.FrameDecoder(), 'count': 0, 'last': {}, 'disorder': 0}
+        selector.register(sock, selectors.EVENT_READ, state)
+        states.append(state)
+    sender_name = 'sender%d' % index
+    sender = create_connection(('127.0.0.1', port))
+    sender.sendall(protocol.encode_frame(protocol.JOIN, {'name': sender_name}))
+
+    def drain_sender():
+        try:
+            while sender.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    t = threading.Thread(target=drain_sender)
+    t.daemon = True
+    t.start()
+
+    def receive(timeout):
+        got = 0
+        for key, _ in selector.select(timeout):
+            state = key.data
+            try:
+                n = key.fileobj.recv_into(state['decoder'].buffer())
+            except BlockingIOError:
+                continue
+            state['decoder'].advance(n)
+            for frame in state['decoder'].frames():
+                got += 1
+                if frame.type != protocol.CHAT:
+                    continue
+                msg = protocol.decode_body(frame.payload)
+                if not msg['source'].startswith('sender'):
+                    continue
+                seq = int(msg['data'])
+                # 同一个发送者的消息必须按顺序到达
+                if seq != state['last'].get(msg['source'], -1) + 1:
+                    state['disorder'] += 1
+                state['last'][msg['source']] = seq
+                state['count'] += 1
+        return got
+
+    # 先把登录和欢迎通知读完
+    while receive(0.5):
+        pass
+    barrier.wait()
+    start = time.perf_counter()
+    sender.sendall(b''.join(protocol.encode_frame(protocol.CHAT, {'data': str(i)}) for i in range(messages)))
+    expected = messages * senders
+    while any(state['count'] < expected for state in states):
+        receive(1)
+    result_queue.put((time.perf_counter() - start, sum(state['disorder'] for state in states)))
+
+
+def measure(workers, client_procs, receivers, messages):
+    port = free_port()
+    bus_path = os.path.join(tempfile.gettempdir(), 'chat-bench-bus-%d.sock' % os.getpid())
+    server = multiprocessing.Process(target=run_server, args=(workers, port, bus_path))
+    server.start()
+    time.sleep(1)  # 等工作进程都监听上
+    barrier = multiprocessing.Barrier(client_procs)
+    result_queue = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=run_clients, args=(
+        i, port, receivers, messages, client_procs, barrier, result_queue)) for i in range(client_procs)]
+    for p in clients:
+        p.start()
+    results = [result_queue.get() for _ in clients]
+    for p in clients:
+        p.join()
+    server.terminate()
+    server.join()
+    cost = max(r[0] for r in results)
+    delivered = client_procs * receivers * client_procs * messages
+    return {'workers': workers, 'client_procs': client_procs, 'receivers': receivers, 'messages': messages,
+            'seconds': cost, 'delivered': delivered, 'delivered_per_sec': delivered / cost,
+            'out_of_order': sum(r[1] for r in results)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='多进程模式的吞吐量')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--client-procs', type=int, default=4)
+    parser.add_argument('--receivers', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    print('CPU 核数：%d' % os.cpu_count())
+    results = []
+    for workers in args.workers:
+        row = measure(workers, args.client_procs, args.receivers, args.messages)
+        results.append(row)
+        print('工作进程:%d  投递:%d 条  用时:%.3fs  %.0f 条/s  乱序:%d' % (
+            workers, row['delivered'], row['seconds'], row['delivered_per_sec'], row['out_of_order']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+'''
+压缩能省多少流量、花多少 CPU：
+
+    python bench_compress.py --messages 5000 --clients 200
+
+第一部分在进程内对不同长度的聊天广播帧做压缩和解压，比较不压缩、普通 zlib、带预置字典的 zlib
+三种情况的字节数和每帧用时。
+
+第二部分端到端：服务器在子进程里运行，--clients 个客户端（都请求压缩或者都不请求）接收
+一个发送者的 --messages 条广播，统计服务器实际发出的字节数和服务器进程用掉的 CPU 时间。
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import resource
+import time
+import zlib
+
+import protocol
+from chat_client import ChatClient
+from chat_engine import ChatEngine, now_str
+from loadgen import raise_fd_limit
+
+WORDS = ('大家好', '今天', '晚上', '一起去', '吃饭', '食堂', '图书馆', '作业', '课程设计', '老师', '同学',
+         '哈哈哈', '好的', '谢谢', '没问题', '明天', '考试', '复习', '周末', '打球', '电影', '什么时候',
+         '在哪里', '我觉得', '可以', '不行', '已经', '提交了', '代码', '服务器', '客户端', '聊天室')
+
+
+def make_text(rng, words):
+    return '，'.join(''.join(rng.choice(WORDS) for _ in range(3)) for _ in range(max(1, words // 3)))
+
+
+def make_frames(count, words, seed=1):
+    rng = random.Random(seed)
+    frames = []
+    for i in range(count):
+        msg = {'source': 'user%d' % rng.randrange(200), 'data': make_text(rng, words),
+               'time': now_str(), 'room': '大厅', 'id': 100000 + i}
+        frames.append(protocol.encode_frame(protocol.CHAT, msg))
+    return frames
+
+
+def micro(frames):
+    raw = sum(len(frame) for frame in frames)
+    plain = 0
+    start = time.process_time()
+    for frame in frames:
+        plain += protocol.HEADER.size + len(zlib.compress(frame[protocol.HEADER.size:], 6))
+    plain_cost = time.process_time() - start
+    start = time.process_time()
+    compressed = [protocol.compress_frame(frame, 0) for frame in frames]
+    dict_cost = time.process_time() - start
+    start = time.process_time()
+    decoder = protocol.FrameDecoder()
+    for frame in compressed:
+        decoder.feed(frame)
+        for _ in decoder.frames():
+            pass
+    decompress_cost = time.process_time() - start
+    n = len(frames)
+    return {'frames': n, 'avg_frame_bytes': raw / n,
+            'zlib_ratio': plain / raw, 'zlib_us_per_frame': plain_cost / n * 1e6,
+            'zdict_ratio': sum(len(frame) for frame in compressed) / raw, 'zdict_us_per_frame': dict_cost / n * 1e6,
+            'decompress_us_per_frame': decompress_cost / n * 1e6}
+
+
+def run_server(conn):
+    engine = ChatEngine(('127.0.0.1', 0), backlog=1024, max_queue_frames=100000, max_queue_bytes=1 << 30)
+    engine.start()
+    engine.ready.wait()
+    conn.send(engine.address[1])
+    while conn.recv():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        conn.send((engine.metrics.bytes_out.value, usage.ru_utime + usage.ru_stime))
+
+
+def measure(port_conn, port, clients, texts, compress):
+    async def main():
+        receivers = [ChatClient('r%d' % i, ('127.0.0.1', port), reconnect=False, compress=compress,
+                                heartbeat=None, receive_messages=False) for i in range(clients)]
+        await asyncio.gather(*(client.connect() for client in receivers))
+        sender = ChatClient('sender', ('127.0.0.1', port), reconnect=False, compress=compress, heartbeat=None)
+        await sender.connect()
+        await asyncio.sleep(0.5)
+        port_conn.send('stats')
+        base_bytes, base_cpu = port_conn.recv()
+        for text in texts:
+            await sender.send(text)
+        await sender.send('done')
+        async for message in sender:
+            if message.type == protocol.CHAT and message.body.get('data') == 'done':
+                break
+        await asyncio.sleep(0.5)  # 让其他接收者也收完
+        port_conn.send('stats')
+        bytes_out, cpu = port_conn.recv()
+        await asyncio.gather(*(client.close() for client in receivers + [sender]))
+        return bytes_out - base_bytes, cpu - base_cpu
+
+    return asyncio.run(main())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='压缩省下的流量和 CPU 开销')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--words', type=int, default=60, help='端到端测试里每条消息大约多少个词')
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    raise_fd_limit()
+    results = {'micro': [], 'end_to_end': []}
+    for words in (6, 30, 90, 300):
+        row = micro(make_frames(args.messages, words))
+        row['words'] = words
+        results['micro'].append(row)
+        print('每条约%3d个词 平均%5.0f字节  zlib: %.2f %.1fus  zlib+字典: %.2f %.1fus  解压 %.1fus' % (
+            words, row['avg_frame_bytes'], row['zlib_ratio'], row['zlib_us_per_frame'],
+            row['zdict_ratio'], row['zdict_us_per_frame'], row['decompress_us_per_frame']))
+
+    rng = random.Random(2)
+    texts = [make_text(rng, args.words) for _ in range(args.messages)]
+    for compress in (False, True):
+        parent, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=run_server, args=(child,))
+        server.start()
+        port = parent.recv()
+        bytes_out, cpu = measure(parent, port, args.clients, texts, compress)
+        parent.send('')
+        server.terminate()
+        server.join()
+        row = {'compress': compress, 'clients': args.clients, 'messages': args.messages, 'words': args.words,
+               'bytes_out': bytes_out, 'bytes_per_delivery': bytes_out / (args.messages * (args.clients + 1)),
+               'server_cpu_seconds': cpu}
+        results['end_to_end'].append(row)
+        print('端到端 压缩:%-5s 客户端:%d 消息:%d  服务器发出 %.1fMB（每次投递 %.0f 字节）  服务器 CPU %.2fs' % (
+            compress, args.clients, args.messages, bytes_out / 1e6, row['bytes_per_delivery'], cpu))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
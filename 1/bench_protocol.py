@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''
+分帧协议解析吞吐量：
+
+    python bench_protocol.py --frames 200000 --chunk 1024
+
+先把一批聊天帧编码成一条字节流，再按 --chunk 大小切开（模拟 TCP 每次 recv 收到的块，
+帧会被拆开或者粘在一起），用 FrameDecoder 解析，统计每秒帧数和 MB/s。
+--json 额外解析每一帧的 JSON 消息体。
+'''
+import argparse
+import json
+import time
+
+import protocol
+
+
+def build_stream(count):
+    frames = []
+    for i in range(count):
+        # 中英文混合，长度不一，检查多字节字符被拆开的情况
+        data = '第%d条消息 hello %s' % (i, '聊天' * (i % 40))
+        frames.append(protocol.encode_frame(protocol.CHAT, {'source': 'user%d' % (i % 100), 'data': data,
+                                                            'time': '2020-05-20 13:14:00'}))
+    return b''.join(frames)
+
+
+def run(stream, chunk, decode_json):
+    decoder = protocol.FrameDecoder()
+    view = memoryview(stream)
+    count = 0
+    start = time.perf_counter()
+    for offset in range(0, len(stream), chunk):
+        piece = view[offset:offset + chunk]
+        n = len(piece)
+        decoder.buffer(n)[:n] = piece  # 相当于 recv_into
+        decoder.advance(n)
+        for frame in decoder.frames():
+            if decode_json:
+                protocol.decode_body(frame.payload)
+            count += 1
+    return count, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='分帧协议解析吞吐量')
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--chunk', type=int, nargs='+', default=[64, 1024, 65536])
+    parser.add_argument('--json', action='store_true', help='同时解析 JSON 消息体')
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    stream = build_stream(args.frames)
+    results = []
+    for chunk in args.chunk:
+        count, cost = run(stream, chunk, args.json)
+        assert count == args.frames
+        row = {'chunk': chunk, 'frames': count, 'seconds': cost,
+               'frames_per_sec': count / cost, 'mb_per_sec': len(stream) / cost / 1024 / 1024}
+        results.append(row)
+        print('块大小:%6d  帧数:%d  用时:%.3fs  %.0f 帧/s  %.1f MB/s' % (
+            chunk, count, cost, row['frames_per_sec'], row['mb_per_sec']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
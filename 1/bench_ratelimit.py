@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+刷屏的客户端对正常客户端延迟的影响：
+
+    python bench_ratelimit.py --honest 100 --rate 2 --flooders 1 --duration 10
+
+服务器在子进程里运行，--honest 个正常客户端每个每秒发 --rate 条消息，同时 --flooders 个刷屏的
+客户端在另一个子进程里不停地发。统计正常客户端消息的端到端延迟（p50 / p99 / p999）和
+服务器广播出去的刷屏消息条数。依次比较三种配置：
+
+    none    不限流
+    reject  每个客户端 --msg-rate 条/秒，超过的丢弃
+    delay   每个客户端 --msg-rate 条/秒，超过的推迟读取
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import signal
+import time
+from socket import *
+
+import protocol
+from chat_client import ChatClient
+from chat_engine import ChatEngine
+from loadgen import MAGIC, raise_fd_limit, summary
+from ratelimit import DELAY, REJECT, RateLimiter
+
+FLOOD = 'flood'
+
+
+def run_server(conn, policy, msg_rate, msg_burst):
+    limiter = RateLimiter(msg_rate, msg_burst, policy=policy) if policy else None
+    engine = ChatEngine(('127.0.0.1', 0), backlog=1024, max_queue_frames=100000,
+                        max_queue_bytes=1 << 30, limiter=limiter)
+    engine.start()
+    engine.ready.wait()
+    conn.send(engine.address[1])
+    while conn.recv():  # 主进程要统计结果
+        conn.send((engine.metrics.broadcasts.value, engine.metrics.throttled.value))
+
+
+def run_flooder(port, index, duration):
+    # 不管服务器收不收，一直往里写，收到的广播直接丢掉
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sock = create_connection(('127.0.0.1', port))
+    sock.sendall(protocol.encode_frame(protocol.JOIN, {'name': 'flooder%d' % index}))
+    sock.setblocking(False)
+    frame = protocol.encode_frame(protocol.CHAT, {'data': '%s 刷屏刷屏刷屏刷屏刷屏刷屏刷屏刷屏' % FLOOD})
+    chunk = frame * 64
+    stop = time.monotonic() + duration
+    while time.monotonic() < stop:
+        try:
+            sock.send(chunk)
+        except BlockingIOError:
+            pass
+        try:
+            while sock.recv(256 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        except OSError:
+            break
+        time.sleep(0.0005)
+    sock.close()
+
+
+async def honest_clients(port, honest, rate, duration):
+    latencies = []
+    flood_seen = [0]
+    clients = [ChatClient('honest%d' % i, ('127.0.0.1', port), reconnect=False) for i in range(honest)]
+    await asyncio.gather(*(client.connect() for client in clients))
+
+    async def receive(client, own):
+        async for message in client:
+            if message.type != protocol.CHAT:
+                continue
+            data = message.body.get('data', '')
+            if data.startswith(FLOOD):
+                flood_seen[0] += 1
+            elif own and data.startswith(MAGIC):
+                latencies.append(time.perf_counter() - float(data.split('|')[1]))
+
+    async def send(client, index, start, stop):
+        interval = 1.0 / rate
+        scheduled = start + interval * index / honest
+        while scheduled < stop:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await client.send('%s|%.9f' % (MAGIC, scheduled))
+            scheduled += interval
+
+    # 只有第一个客户端统计延迟（所有正常消息它都会收到），其他人只负责发送和把收到的消息读掉
+    receivers = [asyncio.ensure_future(receive(client, i == 0)) for i, client in enumerate(clients)]
+    start = time.perf_counter()
+    stop = start + duration
+    await asyncio.gather(*(send(client, i, start, stop) for i, client in enumerate(clients)))
+    await asyncio.sleep(2)
+    await asyncio.gather(*(client.close() for client in clients))
+    await asyncio.gather(*receivers, return_exceptions=True)
+    return latencies, flood_seen[0]
+
+
+def measure(policy, args):
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=run_server, args=(child, policy, args.msg_rate, args.msg_burst))
+    server.start()
+    port = parent.recv()
+    flooders = [multiprocessing.Process(target=run_flooder, args=(port, i, args.duration))
+                for i in range(args.flooders)]
+    for p in flooders:
+        p.start()
+    latencies, flood_seen = asyncio.run(honest_clients(port, args.honest, args.rate, args.duration))
+    for p in flooders:
+        p.join()
+    parent.send('stats')
+    broadcasts, throttled = parent.recv()
+    parent.send('')
+    server.terminate()
+    server.join()
+    return {'policy': policy or 'none', 'honest': args.honest, 'rate': args.rate, 'flooders': args.flooders,
+            'msg_rate': args.msg_rate, 'duration': args.duration, 'broadcasts': broadcasts,
+            'throttled': throttled, 'flood_delivered_to_observer': flood_seen,
+            'honest_messages': len(latencies), 'expected_honest_messages': int(args.honest * args.rate * args.duration),
+            'latency_ms': summary(latencies)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='刷屏对正常客户端延迟的影响')
+    parser.add_argument('--honest', type=int, default=100, help='正常客户端数')
+    parser.add_argument('--rate', type=float, default=2.0, help='每个正常客户端每秒发几条')
+    parser.add_argument('--flooders', type=int, default=1, help='刷屏的客户端数')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--msg-rate', type=float, default=20.0, help='限流时每个客户端每秒最多几条')
+    parser.add_argument('--msg-burst', type=float, default=40.0)
+    parser.add_argument('--policy', choices=['none', REJECT, DELAY, 'all'], default='all')
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    raise_fd_limit()
+    policies = [None, REJECT, DELAY] if args.policy == 'all' else [None if args.policy == 'none' else args.policy]
+    results = []
+    for policy in policies:
+        row = measure(policy, args)
+        results.append(row)
+        latency = row['latency_ms']
+        print('%-6s 广播:%d 被限流:%d 正常消息:%d/%d  延迟 p50 %.1fms  p99 %.1fms  p999 %.1fms' % (
+            row['policy'], row['broadcasts'], row['throttled'], row['honest_messages'],
+            row['expected_honest_messages'], latency.get('p50', 0), latency.get('p99', 0), latency.get('p999', 0)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''
+房间广播的扇出开销：
+
+    python bench_rooms.py --users 10000 --rooms 500
+
+在进程内构造 --users 个已登录的会话，平均分到 --rooms 个房间里，然后直接调用
+ChatEngine.show_info_and_send_client 广播，统计每条消息在服务器端的扇出时间
+（编码 + 放进每个接收者的发送队列）。不经过真实的 socket，测的是广播路径本身。
+
+rooms 模式：每条消息只发给所在房间的成员；
+global 模式：所有人都在大厅，相当于原来对 session_thread_map 里的每个人都发一遍。
+'''
+import argparse
+import json
+import time
+
+from chat_engine import ChatEngine, Session, now_str
+from outbound import OutboundQueue
+from rooms import LOBBY
+
+
+class NullSocket:
+    # 只占位，广播路径不会真的去写 socket
+    def fileno(self):
+        return -1
+
+
+def build_engine(users, rooms):
+    engine = ChatEngine(('127.0.0.1', 0))
+    for i in range(users):
+        session = Session(NullSocket(), None, OutboundQueue(max_frames=100000, max_bytes=1 << 30))
+        session.username = 'user%d' % i
+        engine.session_map[session.username] = session
+        engine.rooms.join(session, 'room%d' % (i % rooms) if rooms else LOBBY)
+    return engine
+
+
+def run(engine, messages, rooms):
+    start = time.perf_counter()
+    for m in range(messages):
+        room = 'room%d' % (m % rooms) if rooms else LOBBY
+        engine.show_info_and_send_client('user%d' % m, '第%d条消息' % m, now_str(), room)
+    cost = time.perf_counter() - start
+    enqueued = sum(len(session.out_queue) for session in engine.session_map.values())
+    return cost, enqueued
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='房间广播的扇出开销')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--rooms', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=5000, help='rooms 模式广播的消息数')
+    parser.add_argument('--global-messages', type=int, default=200, help='global 模式广播的消息数')
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    results = []
+    for mode, rooms, messages in (('rooms', args.rooms, args.messages), ('global', 0, args.global_messages)):
+        engine = build_engine(args.users, rooms)
+        cost, enqueued = run(engine, messages, rooms)
+        row = {'mode': mode, 'users': args.users, 'rooms': rooms or 1, 'messages': messages, 'seconds': cost,
+               'messages_per_sec': messages / cost, 'fanout_per_message': enqueued / messages,
+               'us_per_message': cost / messages * 1e6}
+        results.append(row)
+        print('%-6s 用户:%d 房间:%d 消息:%d  每条扇出:%.0f  每条用时:%.1fus  %.0f 条/s' % (
+            mode, args.users, row['rooms'], messages, row['fanout_per_message'], row['us_per_message'],
+            row['messages_per_sec']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+全文搜索的查询延迟：
+
+    python bench_search.py --messages 1000000 --queries 200
+
+先往一个新的索引文件里灌 --messages 条随机生成的聊天消息（已经存在就直接用，--rebuild 重新生成），
+然后对几类典型的搜索各查 --queries 次，统计每次查询的用时（p50 / p99 / max），单位毫秒：
+
+    常见词      出现在很多消息里的关键词，只取最新的一页
+    少见词      只出现在少数消息里的关键词
+    多个关键词  两个关键词都要出现
+    发送者      只按发送者搜
+    发送者+词   发送者和关键词一起
+    时间范围    某一个小时里的消息
+    深翻页      常见词一直往后翻 20 页，看最后一页的用时
+'''
+import argparse
+import json
+import os
+import queue
+import random
+import sqlite3
+import time
+
+from bench_compress import WORDS
+from loadgen import summary
+from search import SearchIndex, tokenize
+
+RARE = ('期末答辩', '羽毛球赛', '实验报告', '数据结构', '操作系统')
+
+
+def make_message(rng, i, start):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 12))]
+    if rng.random() < 0.001:
+        words.insert(rng.randrange(len(words)), rng.choice(RARE))
+    return {'id': i, 'source': 'user%d' % rng.randrange(5000), 'room': '大厅' if rng.random() < 0.8 else '房间%d' % rng.randrange(50),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start + i * 0.5)), 'data': ''.join(words)}
+
+
+def build(path, messages, batch=20000):
+    # 直接用 SearchIndex 的表结构和分词，批量灌数据，比一条一条 add 快得多
+    SearchIndex(path).close()
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA synchronous=OFF')
+    rng = random.Random(1)
+    start = time.time() - messages * 0.5
+    begin = time.perf_counter()
+    for first in range(1, messages + 1, batch):
+        rows = [make_message(rng, i, start) for i in range(first, min(first + batch, messages + 1))]
+        with db:
+            db.executemany('INSERT INTO messages (id, source, room, time, data) VALUES (?, ?, ?, ?, ?)',
+                           [(m['id'], m['source'], m['room'], m['time'], m['data']) for m in rows])
+            db.executemany('INSERT INTO messages_fts (rowid, body) VALUES (?, ?)',
+                           [(m['id'], tokenize(m['data'])) for m in rows])
+    db.execute('INSERT INTO messages_fts (messages_fts) VALUES (\'optimize\')')
+    db.commit()
+    db.close()
+    return time.perf_counter() - begin
+
+
+def time_range(path):
+    db = sqlite3.connect(path)
+    low, high = db.execute('SELECT MIN(time), MAX(time) FROM messages').fetchone()
+    db.close()
+    return low, high
+
+
+def run_query(index, **kw):
+    results = queue.Queue()
+    start = time.perf_counter()
+    index.search(results.put, **kw)
+    reply = results.get()
+    elapsed = time.perf_counter() - start
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+    return elapsed, reply
+
+
+def deep_page(index, q, pages):
+    before = None
+    elapsed = 0.0
+    for _ in range(pages):
+        elapsed, reply = run_query(index, q=q, before=before)
+        before = reply['next']
+        if before is None:
+            break
+    return elapsed, None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='全文搜索的查询延迟')
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200, help='每类搜索查多少次')
+    parser.add_argument('--db', default='bench_search.db')
+    parser.add_argument('--rebuild', action='store_true', help='删掉已有的索引文件重新生成')
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    if args.rebuild and os.path.exists(args.db):
+        os.remove(args.db)
+    if not os.path.exists(args.db):
+        print('生成%d条消息的索引……' % args.messages)
+        print('用时 %.1fs' % build(args.db, args.messages))
+    low, high = time_range(args.db)
+    index = SearchIndex(args.db)
+    rng = random.Random(2)
+    hour = 3600
+
+    def random_hour():
+        base = time.mktime(time.strptime(low, '%Y-%m-%d %H:%M:%S'))
+        span = time.mktime(time.strptime(high, '%Y-%m-%d %H:%M:%S')) - base - hour
+        begin = base + rng.random() * max(span, 0)
+        fmt = '%Y-%m-%d %H:%M:%S'
+        return time.strftime(fmt, time.localtime(begin)), time.strftime(fmt, time.localtime(begin + hour))
+
+    cases = [
+        ('常见词', lambda: run_query(index, q=rng.choice(WORDS))),
+        ('少见词', lambda: run_query(index, q=rng.choice(RARE))),
+        ('多个关键词', lambda: run_query(index, q='%s %s' % (rng.choice(WORDS), rng.choice(WORDS)))),
+        ('发送者', lambda: run_query(index, user='user%d' % rng.randrange(5000))),
+        ('发送者+词', lambda: run_query(index, q=rng.choice(WORDS), user='user%d' % rng.randrange(5000))),
+        ('时间范围', lambda: run_query(index, **dict(zip(('since', 'until'), random_hour())))),
+        ('深翻页', lambda: deep_page(index, rng.choice(WORDS), 20)),
+    ]
+    results = []
+    for name, case in cases:
+        case()  # 预热
+        latencies = [case()[0] for _ in range(args.queries)]
+        row = {'case': name, 'messages': args.messages, 'latency_ms': summary(latencies)}
+        results.append(row)
+        latency = row['latency_ms']
+        print('%-8s p50 %6.2fms  p99 %6.2fms  max %6.2fms' % (name, latency['p50'], latency['p99'], latency['max']))
+    index.close()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+会话数量与内存、线程数的关系：
+
+    python bench_sessions.py --sessions 100 1000 5000
+
+服务器在子进程里运行，从 /proc 读取子进程的常驻内存(VmRSS)和线程数(Threads)。
+--mode engine 是 ChatEngine 的事件循环，--mode thread 是原来 1.py 里一个客户端一个线程的做法
+（去掉了线程池 10 个的上限，否则第 11 个客户端根本不会被服务）。
+客户端只建立连接不登录，测的是空闲会话本身的开销，不包括欢迎通知的广播。
+'''
+import argparse
+import json
+import multiprocessing
+import resource
+import threading
+import time
+from socket import *
+
+from chat_engine import ChatEngine
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def proc_status(pid):
+    result = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'Threads'):
+                result[key] = int(value.split()[0])
+    return result
+
+
+def run_engine(port_queue):
+    raise_fd_limit()
+    engine = ChatEngine(('127.0.0.1', 0), backlog=1024)
+    engine.start()
+    engine.ready.wait()
+    port_queue.put(engine.address[1])
+    while True:
+        time.sleep(3600)
+
+
+def run_threaded(port_queue):
+    # 原来的模型：accept 之后为每个会话起一个线程阻塞在 recv 上
+    raise_fd_limit()
+    server_socket = socket(AF_INET, SOCK_STREAM)
+    server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1024)
+    port_queue.put(server_socket.getsockname()[1])
+
+    def session(sock):
+        while sock.recv(1024):
+            pass
+
+    while True:
+        sock, _ = server_socket.accept()
+        t = threading.Thread(target=session, args=(sock,))
+        t.daemon = True
+        t.start()
+
+
+def measure(mode, counts):
+    port_queue = multiprocessing.Queue()
+    target = run_engine if mode == 'engine' else run_threaded
+    server = multiprocessing.Process(target=target, args=(port_queue,))
+    server.daemon = True
+    server.start()
+    port = port_queue.get()
+    time.sleep(0.2)
+    rows = [dict(mode=mode, sessions=0, **proc_status(server.pid))]
+    clients = []
+    for count in counts:
+        while len(clients) < count:
+            client = socket(AF_INET, SOCK_STREAM)
+            client.connect(('127.0.0.1', port))
+            clients.append(client)
+        time.sleep(0.5)  # 等服务器把连接都处理完
+        row = dict(mode=mode, sessions=count, **proc_status(server.pid))
+        rows.append(row)
+        print('%-6s 会话数:%6d  内存:%8d KB  线程数:%5d' % (mode, count, row['VmRSS'], row['Threads']))
+    for client in clients:
+        client.close()
+    server.terminate()
+    server.join()
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='会话数量与内存、线程数的关系')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--mode', choices=['engine', 'thread', 'both'], default='both')
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    raise_fd_limit()
+    modes = ['engine', 'thread'] if args.mode == 'both' else [args.mode]
+    results = []
+    for mode in modes:
+        results.extend(measure(mode, sorted(args.sessions)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+'''
+不依赖图形界面的聊天客户端库（asyncio）。
+
+    client = ChatClient('张三', ('localhost', 8888))
+    await client.connect()
+    await client.send('你好')
+    async for message in client:
+        print(message.type, message.body)
+
+图形界面的 MsbClient、机器人和压力测试工具都用它收发消息：
+    connect     连上服务器，发 JOIN 帧，等到服务器回 ACK 才返回
+    send        发聊天信息，只写进发送缓冲区不等回复（流水线），积压太多时才等一等
+    async for   接收迭代器，给出服务器发来的每一帧（Message，消息体已经解析成 dict）
+    重连        连接断开后按指数退避自动重连，重新进入原来的房间；断开期间 send 的消息先存着，连上后补发
+    文件        send_file 分块上传（按服务器给的窗口做流量控制），download 下载到本地文件；
+                房间里有人分享文件时，接收迭代器里会出现 FILE_READY 消息
+    搜索        search 按关键词、发送者、房间、时间搜索聊天记录，分页返回（见 search.py）
+    私信        send_dm 发给某个用户，对方不在线时服务器存进他的信箱，等他登录再补发（见 offline.py）；
+                收到的私信是 DM 消息，客户端收到就自动回 DM_ACK 确认，重复补发的私信按序号去掉
+    压缩        登录时和服务器协商，见 protocol.py
+    心跳        heartbeat 秒没有发过数据就发一个 PING，服务器发来的 PING 自动回 ACK；
+                3 个心跳周期收不到服务器的任何数据，就当连接已经断了，按上面的方式重连
+'''
+import asyncio
+import itertools
+import os
+import random
+import time
+from collections import deque, namedtuple
+
+import protocol
+from files import FILE_ID, split_data
+
+Message = namedtuple('Message', ['type', 'body'])
+
+# 接收迭代器里的状态通知，不是服务器发来的帧
+DISCONNECTED = 'disconnected'
+RECONNECTED = 'reconnected'
+
+_CLOSED = object()
+
+
+class FileTransferError(Exception):
+    '''服务器拒绝了上传或者下载，或者传输途中连接断了'''
+
+
+class _Upload:
+    def __init__(self):
+        self.acked = 0  # 服务器确认收到的字节数
+        self.changed = asyncio.Event()
+        self.error = None
+
+
+class _Download:
+    def __init__(self, path, future):
+        self.path = path
+        self.future = future
+        self.file = None
+        self.size = None
+        self.received = 0
+
+
+class ChatClient:
+    def __init__(self, name, host_port=('localhost', 8888), room=None, reconnect=True,
+                 backoff_initial=0.5, backoff_max=30.0, write_buffer=64 * 1024,
+                 receive_messages=True, heartbeat=15.0, compress=True,
+                 compress_threshold=protocol.COMPRESS_THRESHOLD):
+        self.name = name
+        self.host_port = host_port
+        self.room = room  # 登录时进入的房间，不写就是大厅
+        self.reconnect = reconnect
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.write_buffer = write_buffer  # 发送缓冲区超过这个字节数时 send 才等待
+        # 为 False 时登录之后收到的数据直接丢掉，适合只发不收的机器人和压力测试里的旁观者
+        self.receive_messages = receive_messages
+        self.heartbeat = heartbeat
+        # 登录时请求压缩，服务器同意后自己发的大帧也压缩；收到的压缩帧由 FrameDecoder 自动解压
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.compressing = False
+        self.rooms = set()  # 通过 join_room 进入的房间，重连后自动重新进入
+        self.isConnected = False
+        self.closed = False
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._heartbeat_task = None
+        self._last_sent = self._last_received = time.monotonic()
+        self._pending = deque()  # 断开期间要发送的帧
+        self._decoder = None
+        self._messages = asyncio.Queue()
+        # 文件传输的状态，服务器对它们的 ACK 在收到时直接处理，不放进接收队列
+        self._tokens = itertools.count(1)
+        self._offers = {}  # token -> 等待服务器回复的 Future（上传文件分配 file_id、私信的确认）
+        self._dm_seen = 0  # 收到的私信的最大序号，也是已经确认到的序号
+        self._uploads = {}  # file_id -> _Upload
+        self._downloads = {}  # file_id -> _Download
+
+    # ---------------- 连接 ----------------
+
+    async def connect(self):
+        '''连上服务器并登录，返回服务器的 ACK'''
+        self.closed = False
+        ack = await self._open()
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+        if self.heartbeat:
+            self._heartbeat_task = asyncio.ensure_future(self._heartbeat_loop())
+        return ack
+
+    async def close(self):
+        '''通知服务器离开并关闭连接，不再重连'''
+        self.closed = True
+        if self._writer is not None:
+            if self.isConnected:
+                try:
+                    self._writer.write(protocol.encode_frame(protocol.LEAVE))
+                    await self._writer.drain()
+                except OSError:
+                    pass
+            self._writer.close()
+        self.isConnected = False
+        for task in (self._heartbeat_task, self._reader_task):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._messages.put_nowait(_CLOSED)
+
+    async def _open(self):
+        self._reader, self._writer = await asyncio.open_connection(*self.host_port)
+        body = {'name': self.name}
+        if self.room:
+            body['room'] = self.room
+        if self.compress:
+            body['compress'] = [protocol.COMPRESSION]
+        self._writer.write(protocol.encode_frame(protocol.JOIN, body))
+        decoder = protocol.FrameDecoder()
+        early = []  # 登录 ACK 之前收到的其他帧
+        ack = None
+        while ack is None:
+            data = await self._reader.read(64 * 1024)
+            if not data:
+                raise ConnectionResetError('服务器关闭了连接')
+            decoder.feed(data)
+            for frame in decoder.frames():
+                body = protocol.decode_body(frame.payload)
+                if ack is None and frame.type == protocol.ACK and 'name' in body:
+                    ack = body
+                else:
+                    early.append(Message(frame.type, body))
+        self._decoder = decoder
+        self.compressing = ack.get('compress') == protocol.COMPRESSION
+        self._last_sent = self._last_received = time.monotonic()
+        self.isConnected = True
+        for room in self.rooms:
+            self._writer.write(protocol.encode_frame(protocol.ROOM_JOIN, {'room': room}))
+        while self._pending:
+            self._writer.write(self._pending.popleft())
+        if self.receive_messages:
+            for message in early:
+                self._messages.put_nowait(message)
+        return ack
+
+    async def _read_loop(self):
+        while not self.closed:
+            try:
+                await self._receive()
+            except (OSError, asyncio.IncompleteReadError, protocol.ProtocolError):
+                pass
+            self.isConnected = False
+            self._writer.close()
+            # 服务器那边的传输状态随连接一起没了，正在进行的传输都算失败
+            self._fail_transfers(FileTransferError('连接断开了'))
+            if self.closed:
+                break
+            if not self.reconnect:
+                self._messages.put_nowait(Message(DISCONNECTED, {}))
+                self._messages.put_nowait(_CLOSED)
+                break
+            self._messages.put_nowait(Message(DISCONNECTED, {}))
+            await self._reconnect()
+
+    async def _receive(self):
+        decoder = self._decoder
+        while True:
+            data = await self._reader.read(256 * 1024)
+            if not data:
+                return  # 服务器关闭了连接
+            self._last_received = time.monotonic()
+            if not self.receive_messages:
+                continue  # 登录之后的帧都不需要，连切帧都省掉；心跳由 _heartbeat_loop 负责
+            decoder.feed(data)
+            dm_seen = self._dm_seen
+            for frame in decoder.frames():
+                if frame.type == protocol.PING:
+                    self._writer.write(protocol.encode_frame(protocol.ACK, {'ping': True}))
+                    continue
+                if frame.type == protocol.FILE_DATA:
+                    self._on_file_data(frame.payload)
+                    continue
+                body = protocol.decode_body(frame.payload)
+                if frame.type == protocol.ACK and (body.get('ping') or self._on_reply(body)):
+                    continue  # 心跳和文件传输的回复，不用交给使用者
+                if frame.type == protocol.SEARCH and self._on_reply(body):
+                    continue
+                if frame.type == protocol.DM:
+                    if body['seq'] <= self._dm_seen:
+                        continue  # 确认之前连接断了，服务器又补发了一次
+                    self._dm_seen = body['seq']
+                self._messages.put_nowait(Message(frame.type, body))
+            if self._dm_seen > dm_seen:
+                # 这一批收到的私信一起确认
+                self._writer.write(protocol.encode_frame(protocol.DM_ACK, {'upto': self._dm_seen}))
+
+    async def _heartbeat_loop(self):
+        while not self.closed:
+            await asyncio.sleep(self.heartbeat / 3)
+            if not self.isConnected:
+                continue
+            now = time.monotonic()
+            if now - self._last_received > self.heartbeat * 3:
+                # 服务器没有任何回应（断网、服务器死机），主动断开，由 _read_loop 重连
+                self._writer.close()
+                self._writer.transport.abort()
+            elif now - self._last_sent > self.heartbeat:
+                try:
+                    await self.send_frame(protocol.PING)
+                except (OSError, ConnectionError):
+                    pass
+
+    async def _reconnect(self):
+        # 指数退避加随机抖动，避免服务器重启后所有客户端同时涌上来
+        delay = self.backoff_initial
+        while not self.closed:
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                ack = await self._open()
+            except (OSError, asyncio.IncompleteReadError, protocol.ProtocolError):
+                delay = min(delay * 2, self.backoff_max)
+                continue
+            self._messages.put_nowait(Message(RECONNECTED, ack))
+            return
+
+    # ---------------- 发送 ----------------
+
+    async def send(self, data, room=None):
+        '''发一条聊天信息，不等服务器回复'''
+        body = {'data': data}
+        if room:
+            body['room'] = room
+        await self.send_frame(protocol.CHAT, body)
+
+    async def send_dm(self, to, data):
+        '''给用户 to 发私信，返回服务器的确认 {"dm": 序号, "to": ..., "online": 对方是否在线}'''
+        token = next(self._tokens)
+        future = asyncio.get_running_loop().create_future()
+        self._offers[token] = future
+        await self.send_frame(protocol.DM, {'to': to, 'data': data, 'token': token})
+        ack = await future
+        if 'error' in ack:
+            raise ConnectionError(ack['error'])
+        return ack
+
+    async def search(self, q=None, user=None, room=None, since=None, until=None, before=None, limit=20):
+        '''
+        搜索聊天记录，返回 {"results": [消息, ...], "next": ...}，按从新到旧排列；
+        把 next 作为 before 再搜一次就是下一页，next 为 None 表示没有更多了
+        '''
+        token = next(self._tokens)
+        future = asyncio.get_running_loop().create_future()
+        self._offers[token] = future
+        body = {'token': token, 'limit': limit}
+        for key, value in (('q', q), ('user', user), ('room', room), ('since', since), ('until', until),
+                           ('before', before)):
+            if value is not None:
+                body[key] = value
+        await self.send_frame(protocol.SEARCH, body)
+        reply = await future
+        if 'error' in reply:
+            raise ConnectionError(reply['error'])
+        return reply
+
+    async def join_room(self, room):
+        self.rooms.add(room)
+        await self.send_frame(protocol.ROOM_JOIN, {'room': room})
+
+    async def leave_room(self, room):
+        self.rooms.discard(room)
+        await self.send_frame(protocol.ROOM_LEAVE, {'room': room})
+
+    async def list_rooms(self, room=None):
+        await self.send_frame(protocol.ROOM_LIST, {'room': room} if room else {})
+
+    async def history(self, room=None, last=None, since=None):
+        '''请求历史消息，回放的消息和正常消息一样从接收迭代器里出来，最后是 ACK {"history_done": 条数}'''
+        body = {'room': room} if room else {}
+        if since is not None:
+            body['since'] = since
+        else:
+            body['last'] = last
+        await self.send_frame(protocol.HISTORY, body)
+
+    async def send_file(self, path, room=None, chunk_size=64 * 1024):
+        '''上传一个文件，服务器收齐之后返回 file_id；房间里的人会收到 FILE_READY'''
+        size = os.path.getsize(path)
+        token = next(self._tokens)
+        future = asyncio.get_running_loop().create_future()
+        self._offers[token] = future
+        body = {'name': os.path.basename(path), 'size': size, 'token': token}
+        if room:
+            body['room'] = room
+        await self.send_frame(protocol.FILE_OFFER, body)
+        ack = await future
+        if 'error' in ack:
+            raise FileTransferError(ack['error'])
+        file_id, window = ack['file_id'], ack['window']
+        upload = self._uploads[file_id] = _Upload()
+        try:
+            with open(path, 'rb') as f:
+                sent = 0
+                while sent < size:
+                    # 最多领先服务器确认 window 字节，服务器收得慢就等它的 ACK
+                    while sent - upload.acked >= window:
+                        await self._wait_upload(upload)
+                    chunk = f.read(min(chunk_size, size - sent))
+                    if not chunk:
+                        raise FileTransferError('文件在上传过程中变小了')
+                    await self.send_frame(protocol.FILE_DATA, FILE_ID.pack(file_id) + chunk)
+                    sent += len(chunk)
+            while upload.acked < size:
+                await self._wait_upload(upload)
+        finally:
+            self._uploads.pop(file_id, None)
+        return file_id
+
+    async def _wait_upload(self, upload):
+        upload.changed.clear()
+        await upload.changed.wait()
+        if upload.error is not None:
+            raise upload.error
+
+    async def download(self, file_id, path):
+        '''把服务器上的文件下载到 path，下载完返回 path'''
+        future = asyncio.get_running_loop().create_future()
+        self._downloads[file_id] = _Download(path, future)
+        await self.send_frame(protocol.FILE_GET, {'file_id': file_id})
+        return await future
+
+    def _on_reply(self, body):
+        # 带 token 的回复（文件上传、私信、搜索）和文件传输相关的 ACK 在这里处理掉，返回 True；其他 ACK 返回 False
+        if 'token' in body:
+            future = self._offers.pop(body['token'], None)
+            if future is not None and not future.done():
+                future.set_result(body)
+            return True
+        file_id = body.get('file_id')
+        if file_id is None:
+            return False
+        if 'received' in body:
+            upload = self._uploads.get(file_id)
+            if upload is not None:
+                upload.acked = body['received']
+                upload.changed.set()
+            return True
+        download = self._downloads.get(file_id)
+        if download is None:
+            return False
+        if 'error' in body:
+            del self._downloads[file_id]
+            download.future.set_exception(FileTransferError(body['error']))
+        else:
+            download.size = body['size']
+            download.file = open(download.path, 'wb')
+        return True
+
+    def _on_file_data(self, payload):
+        file_id, chunk = split_data(payload)
+        download = self._downloads.get(file_id)
+        if download is None or download.file is None:
+            return
+        download.file.write(chunk)
+        download.received += len(chunk)
+        if download.received >= download.size:
+            download.file.close()
+            del self._downloads[file_id]
+            download.future.set_result(download.path)
+
+    def _fail_transfers(self, error):
+        for future in self._offers.values():
+            if not future.done():
+                future.set_exception(error)
+        self._offers.clear()
+        for upload in self._uploads.values():
+            upload.error = error
+            upload.changed.set()
+        for download in self._downloads.values():
+            if download.file is not None:
+                download.file.close()
+            if not download.future.done():
+                download.future.set_exception(error)
+        self._downloads.clear()
+
+    async def ping(self):
+        await self.send_frame(protocol.PING)
+
+    async def send_frame(self, ftype, body=None):
+        frame = protocol.encode_frame(ftype, body)
+        if self.compressing and ftype != protocol.FILE_DATA:  # 文件内容一般已经压缩过，不再浪费 CPU
+            frame = protocol.compress_frame(frame, self.compress_threshold)
+        if not self.isConnected:
+            if self.closed or not self.reconnect:
+                raise ConnectionError('没有连接服务器')
+            self._pending.append(frame)
+            return
+        self._writer.write(frame)
+        self._last_sent = time.monotonic()
+        # 多条消息连续写进缓冲区，一起发出去；只有对方收得慢、缓冲区积压时才等待
+        if self._writer.transport.get_write_buffer_size() > self.write_buffer:
+            await self._writer.drain()
+
+    # ---------------- 接收 ----------------
+
+    async def receive(self):
+        '''等下一条消息，连接关闭后返回 None'''
+        message = await self._messages.get()
+        if message is _CLOSED:
+            self._messages.put_nowait(_CLOSED)  # 后面再调用也直接返回
+            return None
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
@@ -0,0 +1,943 @@
+# -*- coding: utf-8 -*-
+'''
+聊天服务器的核心引擎，不依赖 wx 界面，可以单独运行：
+
+    python chat_engine.py --port 8888
+
+引擎基于 selectors 实现单线程事件循环，所有会话的读写都在同一个线程里完成，
+不再为每个客户端创建一个线程，因此一个进程可以同时挂住成千上万个连接。
+界面（MsbServer）只需要通过 add_listener 注册回调，就能收到要显示的聊天信息。
+'''
+import argparse
+import heapq
+import itertools
+import selectors
+import threading
+import time
+from collections import deque
+from socket import *
+
+import protocol
+from files import Download, FileRejected, FileStore, split_data
+from metrics import ChatMetrics, MetricsServer
+from offline import MailboxStore
+from outbound import DISCONNECT, DROP_OLDEST, OVERFLOW_POLICIES, OutboundQueue, QueueOverflow
+from protocol import FrameDecoder, ProtocolError, is_integer
+from ratelimit import DELAY, REJECT, THROTTLE_POLICIES, RateLimiter
+from rooms import LOBBY, RoomIndex
+from search import SearchIndex
+from transcript import FSYNC_INTERVAL, FSYNC_POLICIES, TranscriptLog
+
+
+def now_str():
+    # 聊天信息统一使用的时间格式
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+
+
+# 服务器端的一个会话，只保存状态，读写由 ChatEngine 的事件循环驱动
+class Session:
+    def __init__(self, socket, addr, out_queue):
+        self.user_socket = socket
+        self.addr = addr
+        self.username = None  # 第一帧 JOIN 带着客户端的名字，收到之前为 None
+        self.isOn = True  # 会话是否活动
+        # 把收到的字节切成完整的帧；登录之前只接受小帧，登录之后才放开到 MAX_FRAME_SIZE
+        self.decoder = FrameDecoder(capacity=4096, max_frame=protocol.MAX_LOGIN_FRAME_SIZE)
+        self.out_queue = out_queue  # 有上限的发送队列，由事件循环在可写时发送
+        self.want_write = False  # 发送队列里还有数据，需要关注可写事件
+        self.paused = False  # 被限流，暂时不读这个会话的 socket
+        self.events = 0  # 当前在 selector 上关注的事件
+        self.limits = None  # 限流用的令牌桶（ratelimit.SessionLimits）
+        self.held = None  # delay 限流时扣住的那一帧，恢复读取时先处理它
+        self.compress = False  # 登录时双方协商好了压缩，大的帧压缩之后再发
+        self.uploads = {}  # 正在上传的文件：file_id -> files.StoredFile，上传超时被删掉的是 None
+        self.downloads = deque()  # 正在下载的文件（files.Download），文本队列空了才发下一块
+        self.dm_sent = 0  # 这个会话已经收到（放进了发送队列）的信箱序号，信箱补发完之前新私信不直接发
+        self.closing = False  # 已经决定断开，等下一轮事件循环关闭
+        self.handler = None  # 注册到 selector 上的事件回调
+        self.queued_at = None  # 发送队列从空变成非空的时刻，用来统计发送等待时间
+        self.last_seen = time.monotonic()  # 最后一次收到这个客户端数据的时刻
+        self.last_ping = 0.0  # 最后一次给它发心跳的时刻
+
+    def fileno(self):
+        return self.user_socket.fileno()
+
+
+class ChatEngine:
+    def __init__(self, host_port=('', 8888), backlog=128, max_queue_frames=1000,
+                 max_queue_bytes=4 * 1024 * 1024, overflow=DROP_OLDEST, flush_interval=0.001,
+                 reuse_port=False, bus_path=None, transcript=None, ping_interval=20.0, idle_timeout=60.0,
+                 login_timeout=10.0, reap_interval=5.0, limiter=None, compression=True,
+                 compress_threshold=protocol.COMPRESS_THRESHOLD, files=None, mailboxes=None,
+                 search=None):
+        self.host_port = host_port
+        self.backlog = backlog
+        # 心跳：客户端 ping_interval 秒没有发来任何数据，服务器就发一个 PING，客户端回 ACK；
+        # 超过 idle_timeout 秒还没有数据，说明客户端已经不在了（断网、死机），由清理任务关闭会话。
+        # 连上之后 login_timeout 秒还没发 JOIN 的连接也会被关闭。idle_timeout 为 None 时不清理。
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.login_timeout = login_timeout
+        self.reap_interval = reap_interval
+        # 限流（ratelimit.RateLimiter），为 None 时不限制
+        self.limiter = limiter
+        # 客户端要求压缩时是否同意；广播帧超过 compress_threshold 字节才压缩，每条广播只压缩一次
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        # 上传文件的暂存（files.FileStore），为 None 时用默认设置
+        self.files = files if files is not None else FileStore()
+        # 私信的信箱（offline.MailboxStore），为 None 时不支持私信
+        self.mailboxes = mailboxes
+        # 多进程模式（见 cluster.py）：几个进程用 SO_REUSEPORT 监听同一个端口，
+        # 通过 bus_path 这个 Unix socket 把广播转给其他进程
+        self.reuse_port = reuse_port
+        self.bus_path = bus_path
+        self.bus = None
+        # 聊天记录日志（transcript.TranscriptLog），每条广播都会自动追加进去
+        self.transcript = transcript
+        # 聊天记录的全文搜索（search.SearchIndex），每条广播都会自动建索引；为 None 时不支持搜索
+        self.search = search
+        self.replay_batch = 200  # 回放历史时每一轮最多放进发送队列的条数
+        self.max_replay = 1000  # 按 last 请求历史时最多回放多少条
+        # 每个会话发送队列的上限和满了之后的处理策略，见 outbound.py
+        self.max_queue_frames = max_queue_frames
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow = overflow
+        # 发送的节拍：广播先进队列，每隔 flush_interval 秒集中发送一次
+        self.flush_interval = flush_interval
+        self._dirty = set()  # 队列里有新数据、等待发送的会话
+        self._flush_scheduled = False
+        self.isOn = False
+        self.server_socket = None
+        self.selector = selectors.DefaultSelector()
+        self.sessions = {}  # fileno -> Session
+        self.session_map = {}  # 客户端名字 -> Session
+        self.rooms = RoomIndex()  # 房间 <-> 成员的双向索引，广播只发给房间成员
+        self.listeners = []  # 界面等观察者，回调参数为要显示的聊天信息
+        self._timers = []  # 定时任务堆：(时间, 序号, 回调)
+        self._timer_seq = itertools.count()
+        self._pending_calls = []  # 其它线程提交到事件循环里执行的函数
+        self._pending_lock = threading.Lock()
+        # 用一对 socket 唤醒阻塞在 select 上的事件循环
+        self._wakeup_r, self._wakeup_w = socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._thread = None
+        self.ready = threading.Event()  # 开始监听之后置位
+        # 运行指标，用 metrics.MetricsServer 以 Prometheus 文本格式输出
+        self.metrics = ChatMetrics(self)
+
+    # ---------------- 对外接口 ----------------
+
+    def add_listener(self, callback):
+        '''注册观察者，每条要显示的聊天信息都会调用一次 callback(send_data)'''
+        self.listeners.append(callback)
+
+    def start(self):
+        '''在后台守护线程里启动事件循环，给界面使用'''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.serve_forever)
+            self._thread.daemon = True
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=5.0):
+        '''
+        停止服务器，可以在任意线程调用。用 start() 启动的，等事件循环线程退出（监听的端口已经关掉）再返回，
+        界面上马上再点“启动”不会和旧的事件循环抢端口。
+        '''
+        self.call_soon_threadsafe(self._shutdown)
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    @property
+    def stats(self):
+        '''几个主要的计数，给测试脚本用'''
+        m = self.metrics
+        return {'frames_in': m.frames_in.value, 'broadcasts': m.broadcasts.value,
+                'send_calls': m.send_calls.value, 'bytes_out': m.bytes_out.value}
+
+    @property
+    def address(self):
+        '''实际监听的地址，端口传 0 时由系统分配'''
+        return self.server_socket.getsockname()
+
+    def call_soon_threadsafe(self, callback, *args):
+        '''把函数交给事件循环线程执行'''
+        with self._pending_lock:
+            self._pending_calls.append((callback, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def call_later(self, delay, callback, *args):
+        '''delay 秒之后在事件循环线程里执行 callback'''
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_seq), callback, args))
+
+    def serve_forever(self):
+        print("服务器开始工作")
+        self.server_socket = socket(AF_INET, SOCK_STREAM)  # TCP协议的服务器端套接字
+        self.server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        self.server_socket.bind(self.host_port)
+        self.server_socket.listen(self.backlog)
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self._accept)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, self._on_wakeup)
+        if self.bus_path:
+            self._connect_bus()
+        if self.idle_timeout:
+            self.call_later(self.reap_interval, self._reap)
+        self.call_later(60, self._expire_files)
+        self.isOn = True
+        self.ready.set()
+        try:
+            while self.isOn:
+                for key, mask in self.selector.select(self._next_timeout()):
+                    key.data(key.fileobj, mask)
+                self._run_timers()
+        finally:
+            self._close_all()
+
+    # 服务器通知和聊天信息都走这里：显示给界面，同时发送给房间里的所有客户端
+    def show_info_and_send_client(self, source, data, data_time, room=LOBBY):
+        self.metrics.broadcasts.inc()
+        msg = {'source': source, 'data': data, 'time': data_time, 'room': room}
+        if self.transcript is not None:
+            # 写进聊天记录日志，同时分配消息 id
+            self.transcript.append(msg)
+        if self.search is not None:
+            self.search.add(msg)
+        # 只编码一次，房间里所有客户端共用同一帧
+        payload = protocol.encode_frame(protocol.CHAT, msg)
+        if self.bus is not None:
+            # 多进程模式下同一帧也交给总线，由其他进程发给它们自己的客户端
+            self._send(self.bus, payload)
+        self._deliver(source, data, data_time, room, payload)
+
+    def _deliver(self, source, data, data_time, room, payload):
+        # 显示给界面，并放进本进程里这个房间所有成员的发送队列
+        send_data = '%s : %s\n时间：%s\n' % (source, data, data_time)
+        if room != LOBBY:
+            send_data = '[%s] %s' % (room, send_data)
+        for callback in self.listeners:
+            callback(send_data)
+        start = time.perf_counter()
+        compressed = None  # 第一次遇到支持压缩的接收者时才压缩，之后所有人共用
+        for session in list(self.rooms.members(room)):
+            if session.isOn:  # 当前客户端是活动
+                if session.compress:
+                    if compressed is None:
+                        compressed = self._compress(payload)
+                    self._send(session, compressed)
+                else:
+                    self._send(session, payload)
+        self.metrics.fanout.observe(time.perf_counter() - start)
+
+    def _compress(self, frame):
+        start = time.perf_counter()
+        compressed = protocol.compress_frame(frame, self.compress_threshold)
+        if compressed is not frame:
+            self.metrics.compressions.inc()
+            self.metrics.compress_saved.inc(len(frame) - len(compressed))
+            self.metrics.compress_time.observe(time.perf_counter() - start)
+        return compressed
+
+    # ---------------- 事件循环内部 ----------------
+
+    def _next_timeout(self):
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.monotonic())
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            callback(*args)
+
+    def _on_wakeup(self, sock, mask):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._pending_lock:
+            calls, self._pending_calls = self._pending_calls, []
+        for callback, args in calls:
+            callback(*args)
+
+    def _accept(self, server_socket, mask):
+        # 一次把积压的连接都接进来
+        while True:
+            try:
+                session_socket, client_addr = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # 文件描述符用完等情况，等下一轮再接
+                print('接受连接失败：%s' % e)
+                return
+            self.metrics.accepts.inc()
+            session_socket.setblocking(False)
+            session_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            session = Session(session_socket, client_addr, OutboundQueue(
+                self.max_queue_frames, self.max_queue_bytes, self.overflow))
+            session.handler = self._make_handler(session)
+            if self.limiter is not None:
+                session.limits = self.limiter.session()
+            self.sessions[session.fileno()] = session
+            self._update_events(session)
+
+    def _make_handler(self, session):
+        def handler(sock, mask):
+            if mask & selectors.EVENT_READ:
+                self._on_readable(session)
+            if mask & selectors.EVENT_WRITE and session.isOn:
+                self._flush(session)
+        return handler
+
+    def _on_readable(self, session):
+        try:
+            n = session.user_socket.recv_into(session.decoder.buffer())
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+        if n == 0:
+            # 对方直接关闭了连接
+            self._close_session(session, notify=True)
+            return
+        session.decoder.advance(n)
+        session.last_seen = time.monotonic()
+        self.metrics.bytes_in.inc(n)
+        self._process_frames(session)
+
+    def _process_frames(self, session):
+        on_frame = self._on_bus_frame if session is self.bus else self._on_frame
+        try:
+            if session.held is not None:
+                frame, session.held = session.held, None
+                if self._admit(session, frame):
+                    on_frame(session, frame)
+                if session.paused or not session.isOn:
+                    return
+            for frame in session.decoder.frames():
+                self.metrics.frames_in.inc()
+                if self._admit(session, frame):
+                    on_frame(session, frame)
+                if session.paused or not session.isOn:
+                    return
+        except ProtocolError as e:
+            print('客户端%s协议错误：%s' % (session.username, e))
+            self._close_session(session, notify=True)
+        except (TypeError, ValueError, KeyError) as e:
+            # 消息体里的字段类型不对之类的漏网之鱼：只断开这一个客户端，事件循环不能因此退出
+            print('客户端%s发来的数据不对：%r' % (session.username, e))
+            self._close_session(session, notify=True)
+
+    def _admit(self, session, frame):
+        '''限流：这一帧可以处理返回 True；被拒绝或者被扣住（delay 策略，会话暂停读取）返回 False'''
+        if session.limits is None or session.username is None or frame.type in (protocol.PING, protocol.ACK):
+            return True
+        # 文件内容只算字节数，不算消息条数
+        file_data = frame.type == protocol.FILE_DATA
+        wait = self.limiter.check(session.limits, protocol.HEADER.size + len(frame.payload),
+                                  messages=0 if file_data else 1)
+        if not wait:
+            session.limits.warned = False
+            return True
+        self.metrics.throttled.inc()
+        if self.limiter.policy == DELAY or file_data:
+            # 文件的分块丢了文件就坏了，所以不管什么策略都只推迟
+            # 扣住这一帧（复制一份，解码器的缓冲区之后还会复用），不再读 socket，等令牌够了再继续
+            session.held = protocol.Frame(frame.type, frame.flags, bytes(frame.payload))
+            session.paused = True
+            self._update_events(session)
+            self.call_later(wait, self._resume, session)
+        elif not session.limits.warned:
+            session.limits.warned = True
+            self._send(session, protocol.encode_frame(protocol.ACK, {'error': '你发得太快了，消息被丢弃'}))
+        return False
+
+    def _resume(self, session):
+        if not session.isOn:
+            return
+        session.paused = False
+        self._process_frames(session)
+        if session.isOn and not session.paused:
+            self._update_events(session)
+
+    def _update_events(self, session):
+        # 按照是否暂停读取、是否有数据要发，调整在 selector 上关注的事件
+        events = 0 if session.paused else selectors.EVENT_READ
+        if session.want_write:
+            events |= selectors.EVENT_WRITE
+        if events == session.events:
+            return
+        if not session.events:
+            self.selector.register(session.user_socket, events, session.handler)
+        elif not events:
+            self.selector.unregister(session.user_socket)
+        else:
+            self.selector.modify(session.user_socket, events, session.handler)
+        session.events = events
+
+    def _on_frame(self, session, frame):
+        if session.username is None:
+            # 我们规定第一帧必须是 JOIN，里面带着客户端的名字
+            if frame.type != protocol.JOIN:
+                raise ProtocolError('第一帧必须是 JOIN')
+            body = protocol.decode_body(frame.payload)
+            if not body.get('name'):
+                raise ProtocolError('JOIN 里没有名字')
+            room = self._room_of(session, body)
+            if room is None:
+                return
+            if not protocol.valid_name(body['name']):
+                # 没有登录，客户端可以换个名字再发 JOIN，一直不发的话 login_timeout 之后被关掉
+                self._send(session, protocol.encode_frame(protocol.ACK, {
+                    'error': '名字必须是不超过%d个字符的字符串' % protocol.MAX_NAME_LENGTH}))
+                return
+            compress = self.compression and protocol.COMPRESSION in (body.get('compress') or ())
+            self._login(session, body['name'], room, compress)
+        elif frame.type == protocol.CHAT:
+            # 其他聊天信息，我们应该显示给房间里的所有客户端，包括服务器
+            body = protocol.decode_body(frame.payload)
+            room = self._room_of(session, body)
+            if room is None:
+                return
+            if not self.rooms.is_member(session, room):
+                self._send(session, protocol.encode_frame(protocol.ACK, {'error': '你不在房间%s里' % room}))
+                return
+            self.show_info_and_send_client(session.username, body.get('data', ''), now_str(), room)
+        elif frame.type == protocol.ROOM_JOIN:
+            room = self._room_of(session, protocol.decode_body(frame.payload), None)
+            if room is not None:
+                self._join_room(session, room)
+        elif frame.type == protocol.ROOM_LEAVE:
+            room = self._room_of(session, protocol.decode_body(frame.payload), None)
+            if room is not None and self.rooms.leave(session, room):
+                self._send(session, protocol.encode_frame(protocol.ACK, {'room_leave': room}))
+                self.show_info_and_send_client("服务器通知", "%s离开房间%s！" % (session.username, room), now_str(), room)
+        elif frame.type == protocol.ROOM_LIST:
+            body = protocol.decode_body(frame.payload)
+            if body.get('room'):
+                room = self._room_of(session, body)
+                if room is None:
+                    return
+                names = sorted(member.username for member in self.rooms.members(room))
+                body = {'room': room, 'members': names}
+            else:
+                body = {'rooms': self.rooms.list_rooms()}
+            self._send(session, protocol.encode_frame(protocol.ROOM_LIST, body))
+        elif frame.type == protocol.HISTORY:
+            self._start_replay(session, protocol.decode_body(frame.payload))
+        elif frame.type == protocol.SEARCH:
+            self._start_search(session, protocol.decode_body(frame.payload))
+        elif frame.type == protocol.FILE_DATA:
+            self._on_file_data(session, frame.payload)
+        elif frame.type == protocol.FILE_OFFER:
+            self._on_file_offer(session, protocol.decode_body(frame.payload))
+        elif frame.type == protocol.FILE_GET:
+            self._on_file_get(session, protocol.decode_body(frame.payload))
+        elif frame.type == protocol.DM:
+            self._on_direct(session, protocol.decode_body(frame.payload))
+        elif frame.type == protocol.DM_ACK:
+            if self.mailboxes is not None:
+                upto = protocol.decode_body(frame.payload).get('upto')
+                if is_integer(upto):
+                    self.mailboxes.ack(session.username, upto)
+                else:
+                    self._send(session, protocol.encode_frame(protocol.ACK, {'error': 'DM_ACK 的 upto 必须是整数序号'}))
+        elif frame.type == protocol.LEAVE:
+            # 客户端点击断开按钮
+            self._close_session(session, notify=True)
+        elif frame.type == protocol.PING:
+            self._send(session, protocol.encode_frame(protocol.ACK, {'ping': True}))
+        elif frame.type == protocol.ACK:
+            pass
+        else:
+            raise ProtocolError('未知的帧类型：%d' % frame.type)
+
+    def _room_of(self, session, body, default=LOBBY, token=None):
+        '''
+        取出请求里的房间名，没写就是 default。房间名不合法（列表、数字、太长）时回 ACK {"error"}，返回 None；
+        default 也是 None 说明这个请求必须写房间名。
+        '''
+        room = body.get('room') or default
+        if room is not None and protocol.valid_name(room):
+            return room
+        error = {'error': '房间名必须是不超过%d个字符的字符串' % protocol.MAX_NAME_LENGTH}
+        if token is not None:
+            error['token'] = token
+        self._send(session, protocol.encode_frame(protocol.ACK, error))
+        return None
+
+    def _join_room(self, session, room):
+        if not self.rooms.join(session, room):
+            return
+        self._send(session, protocol.encode_frame(protocol.ACK, {'room_join': room}))
+        if room == LOBBY:
+            # 表示有客户端进入到聊天室
+            self.show_info_and_send_client("服务器通知", "欢迎%s进入聊天室！" % session.username, now_str(), room)
+        else:
+            self.show_info_and_send_client("服务器通知", "欢迎%s进入房间%s！" % (session.username, room), now_str(), room)
+
+    def _start_replay(self, session, body):
+        # 新加入或者重连的客户端请求历史消息：最后 N 条，或者某个 id 之后的所有消息
+        room = self._room_of(session, body)
+        if room is None:
+            return
+        if self.transcript is None:
+            self._send(session, protocol.encode_frame(protocol.ACK, {'error': '服务器没有保存聊天记录'}))
+            return
+        if not self.rooms.is_member(session, room):
+            self._send(session, protocol.encode_frame(protocol.ACK, {'error': '你不在房间%s里' % room}))
+            return
+        try:
+            since = None if body.get('since') is None else int(body['since'])
+            last = min(max(int(body.get('last') or 0), 0), self.max_replay)
+        except (TypeError, ValueError):
+            self._send(session, protocol.encode_frame(protocol.ACK, {'error': 'last 和 since 必须是整数'}))
+            return
+        ids = self.transcript.index.ids(room, last=last if since is None else None, since=since)
+        self._continue_replay(session, ids, 0)
+
+    def _continue_replay(self, session, ids, pos):
+        # 每一轮只回放 replay_batch 条，发送队列积压过半就等一会儿，不挤占直播消息
+        if not session.isOn or session.closing:
+            return
+        if len(session.out_queue) > session.out_queue.max_frames // 2:
+            self.call_later(0.05, self._continue_replay, session, ids, pos)
+            return
+        end = min(pos + self.replay_batch, len(ids))
+        for line in self.transcript.index.read(ids[pos:end]):
+            # 日志里的一行就是当初广播的消息体，直接装进帧里
+            frame = protocol.encode_frame(protocol.CHAT, line)
+            self._send(session, self._compress(frame) if session.compress else frame)
+        if end < len(ids):
+            self.call_later(0, self._continue_replay, session, ids, end)
+        else:
+            self._send(session, protocol.encode_frame(protocol.ACK, {'history_done': len(ids)}))
+
+    def _start_search(self, session, body):
+        # 查询在搜索索引的读线程里做，查完交回事件循环发给客户端
+        token = body.get('token')
+        if self.search is None:
+            self._send(session, protocol.encode_frame(protocol.ACK, {'token': token, 'error': '服务器不支持搜索'}))
+            return
+        room = body.get('room')
+        if room and self._room_of(session, body, token=token) is None:
+            return
+        if room and not self.rooms.is_member(session, room):
+            self._send(session, protocol.encode_frame(protocol.ACK, {'token': token, 'error': '你不在房间%s里' % room}))
+            return
+        # 和回放历史一样，只能搜自己所在的房间
+        rooms = [room] if room else sorted(self.rooms.rooms(session))
+        self.metrics.searches.inc()
+
+        def done(result):
+            self.call_soon_threadsafe(self._on_search_done, session, token, result)
+        self.search.search(done, q=body.get('q'), user=body.get('user'), rooms=rooms, since=body.get('since'),
+                           until=body.get('until'), before=body.get('before'), limit=body.get('limit') or 20)
+
+    def _on_search_done(self, session, token, result):
+        if not session.isOn or session.closing:
+            return
+        result['token'] = token
+        if 'error' in result:
+            self._send(session, protocol.encode_frame(protocol.ACK, result))
+            return
+        self.metrics.search_time.observe(result['took_ms'] / 1000)
+        frame = protocol.encode_frame(protocol.SEARCH, result)
+        self._send(session, self._compress(frame) if session.compress else frame)
+
+    # ---------------- 私信（见 offline.py） ----------------
+
+    def _on_direct(self, session, body):
+        token = body.get('token')
+        to = body.get('to')
+        if self.mailboxes is None:
+            self._send(session, protocol.encode_frame(protocol.ACK, {'token': token, 'error': '服务器不支持私信'}))
+            return
+        if not protocol.valid_name(to):
+            self._send(session, protocol.encode_frame(protocol.ACK, {'token': token, 'error': '私信没有接收者'}))
+            return
+        if not self.mailboxes.known(to):
+            # 只能发给登录过的用户，随便编的名字不会多出一个信箱
+            self._send(session, protocol.encode_frame(protocol.ACK, {'token': token, 'error': '没有这个用户：%s' % to}))
+            return
+        self.metrics.direct_messages.inc()
+        record = {'source': session.username, 'to': to, 'data': body.get('data', ''), 'time': now_str()}
+
+        def failed(seq, error):
+            self.call_soon_threadsafe(self._on_direct_failed, session, token, to, seq, error)
+        # 不管在不在线都先进信箱，对方确认之后才算送达
+        seq = self.mailboxes.append(to, record, failed)
+        target = self.session_map.get(to)  # 按名字直接找到接收者的会话
+        online = target is not None and target.isOn and not target.closing
+        if online and target.dm_sent == seq - 1:
+            # 信箱里之前的私信都已经发给他了，这一条直接发；否则等补发的时候一起从信箱里读
+            target.dm_sent = seq
+            frame = protocol.encode_frame(protocol.DM, record)
+            self._send(target, self._compress(frame) if target.compress else frame)
+        elif not online:
+            self.metrics.direct_offline.inc()
+        self._send(session, protocol.encode_frame(protocol.ACK, {'token': token, 'dm': seq, 'to': to, 'online': online}))
+
+    def _on_direct_failed(self, session, token, to, seq, error):
+        # 信箱写文件失败，这条私信没有存下来，告诉发送者
+        if not session.isOn or session.closing:
+            return
+        self._send(session, protocol.encode_frame(protocol.ACK, {
+            'token': token, 'dm': seq, 'to': to, 'error': '私信没有保存成功：%s' % (error.strerror or error)}))
+
+    def _drain_mailbox(self, session):
+        # 登录时补发信箱里没确认的私信：读文件在信箱的写线程里做，读完一批交回事件循环发送，
+        # 发送队列积压过半就等一会儿再读下一批
+        if not session.isOn or session.closing:
+            return
+        if len(session.out_queue) > session.out_queue.max_frames // 2:
+            self.call_later(0.05, self._drain_mailbox, session)
+            return
+        self.mailboxes.read(session.username, session.dm_sent,
+                            lambda lines, last: self.call_soon_threadsafe(self._on_mailbox_read, session, lines, last))
+
+    def _on_mailbox_read(self, session, lines, last):
+        if not session.isOn or session.closing:
+            return
+        if lines is None:
+            # 读信箱出错了，过一会儿再试；在这之前新来的私信也不直接发，免得跳过没补发的
+            self.call_later(1.0, self._drain_mailbox, session)
+            return
+        for line in lines:
+            frame = protocol.encode_frame(protocol.DM, line)
+            self._send(session, self._compress(frame) if session.compress else frame)
+        self.metrics.direct_drained.inc(len(lines))
+        mailbox = self.mailboxes.mailbox(session.username)
+        if lines and last < mailbox.next_seq - 1:
+            session.dm_sent = last
+            self._drain_mailbox(session)
+        else:
+            # 补发完了（补发期间新来的私信也读到了），之后的私信直接发
+            session.dm_sent = mailbox.next_seq - 1
+
+    # ---------------- 文件传输（见 files.py） ----------------
+
+    def _on_file_offer(self, session, body):
+        token = body.get('token')
+        room = self._room_of(session, body, token=token)
+        if room is None:
+            return
+        if not self.rooms.is_member(session, room):
+            self._send(session, protocol.encode_frame(protocol.ACK, {'token': token, 'error': '你不在房间%s里' % room}))
+            return
+        name = body.get('name') or '未命名'
+        size = body.get('size') or 0
+        if not isinstance(name, str) or not is_integer(size):
+            self._send(session, protocol.encode_frame(protocol.ACK, {
+                'token': token, 'error': '文件名必须是字符串，大小必须是整数'}))
+            return
+        try:
+            stored = self.files.create(name, size, session.username, room)
+        except (FileRejected, TypeError, ValueError) as e:
+            self._send(session, protocol.encode_frame(protocol.ACK, {'token': token, 'error': str(e)}))
+            return
+        session.uploads[stored.file_id] = stored
+        self._send(session, protocol.encode_frame(protocol.ACK, {
+            'token': token, 'file_id': stored.file_id, 'window': self.files.window}))
+
+    def _on_file_data(self, session, payload):
+        file_id, chunk = split_data(payload)
+        if file_id not in session.uploads:
+            raise ProtocolError('没有登记过的文件：%d' % file_id)
+        stored = session.uploads[file_id]
+        if stored is None:
+            return  # 已经超时删掉的文件，路上还没到的内容直接丢掉
+        if self.files.get(file_id) is not stored:
+            # 太久没有新数据，已经被 FileStore.expire() 删掉了，客户端要重新 FILE_OFFER
+            session.uploads[file_id] = None
+            self._send(session, protocol.encode_frame(protocol.ACK, {'file_id': file_id, 'error': '上传超时，文件已经删除'}))
+            return
+        stored.write(chunk)
+        self.metrics.file_bytes_in.inc(len(chunk))
+        if stored.complete or stored.received - stored.acked >= self.files.window // 2:
+            # 告诉客户端收到了多少，客户端才能继续发后面的
+            stored.acked = stored.received
+            self._send(session, protocol.encode_frame(protocol.ACK, {'file_id': file_id, 'received': stored.received}))
+        if not stored.complete:
+            return
+        del session.uploads[file_id]
+        self.metrics.files_uploaded.inc()
+        data_time = now_str()
+        # 文件通知也只编码一次，房间里所有人共用
+        ready = protocol.encode_frame(protocol.FILE_READY, {
+            'file_id': file_id, 'name': stored.name, 'size': stored.size, 'source': stored.source,
+            'room': stored.room, 'time': data_time})
+        for member in list(self.rooms.members(stored.room)):
+            if member.isOn:
+                self._send(member, ready)
+        # 再发一条普通的聊天通知，不认识 FILE_READY 的客户端和聊天记录里也能看到
+        self.show_info_and_send_client(
+            "服务器通知", "%s分享了文件%s（%d字节，编号%d）" % (stored.source, stored.name, stored.size, file_id),
+            data_time, stored.room)
+
+    def _on_file_get(self, session, body):
+        file_id = body.get('file_id')
+        stored = self.files.get(file_id) if is_integer(file_id) else None
+        if stored is None or not stored.complete:
+            self._send(session, protocol.encode_frame(protocol.ACK, {'file_id': file_id, 'error': '文件不存在或者已经过期'}))
+            return
+        if not self.rooms.is_member(session, stored.room):
+            self._send(session, protocol.encode_frame(protocol.ACK, {
+                'file_id': file_id, 'error': '你不在房间%s里' % stored.room}))
+            return
+        self._send(session, protocol.encode_frame(protocol.ACK, {
+            'file_id': file_id, 'name': stored.name, 'size': stored.size}))
+        session.downloads.append(Download(stored))
+        self._mark_dirty(session)
+
+    def _expire_files(self):
+        self.files.expire()
+        self.call_later(60, self._expire_files)
+
+    def _connect_bus(self):
+        bus_socket = socket(AF_UNIX, SOCK_STREAM)
+        bus_socket.connect(self.bus_path)
+        bus_socket.setblocking(False)
+        # 总线也当成一个会话来收发，发送队列满了说明总线卡死，直接断开
+        self.bus = Session(bus_socket, self.bus_path, OutboundQueue(
+            100000, 256 * 1024 * 1024, DISCONNECT))
+        self.bus.decoder = FrameDecoder()
+        self.bus.handler = self._make_handler(self.bus)
+        self._update_events(self.bus)
+
+    def _on_bus_frame(self, bus, frame):
+        # 其他进程转过来的广播，只发给本进程的客户端，不再转回总线
+        if frame.type != protocol.CHAT:
+            return
+        msg = protocol.decode_body(frame.payload)
+        payload = protocol.encode_frame(protocol.CHAT, bytes(frame.payload))
+        self._deliver(msg['source'], msg['data'], msg['time'], msg.get('room', LOBBY), payload)
+
+    def _login(self, session, username, room, compress=False):
+        print('客户端%s,已经和服务器连接成功' % username)
+        session.username = username
+        session.compress = compress
+        session.decoder.max_frame = protocol.MAX_FRAME_SIZE
+        old = self.session_map.get(username)
+        if old is not None:
+            # 同名客户端重新登录，旧的会话直接关闭
+            self._close_session(old, notify=False)
+        self.session_map[username] = session
+        ack = {'name': username}
+        if compress:
+            ack['compress'] = protocol.COMPRESSION
+        self._send(session, protocol.encode_frame(protocol.ACK, ack))
+        self._join_room(session, room)
+        if self.mailboxes is not None:
+            # 登录过的用户才有信箱，别人才能给他发私信
+            mailbox = self.mailboxes.mailbox(username)
+            session.dm_sent = mailbox.acked
+            if mailbox.pending():
+                self._drain_mailbox(session)
+
+    def _send(self, session, payload):
+        '''
+        把一帧放进会话的发送队列。这里不马上发送，而是记下这个会话，等 flush_interval 之后
+        统一发送，这期间积压的多帧合成一次 sendmsg，聊天刷屏时系统调用次数大大减少。
+        '''
+        if session.closing:
+            return
+        try:
+            session.out_queue.push(payload)
+        except QueueOverflow as e:
+            print('客户端%s接收太慢，断开：%s' % (session.username, e))
+            self.metrics.overflows.inc()
+            session.closing = True
+            # 正在广播，不能在这里直接改动 session_map，放到下一轮再关闭
+            self.call_later(0, self._close_session, session, True)
+            return
+        self.metrics.frames_out.inc()
+        if session.queued_at is None:
+            session.queued_at = time.perf_counter()  # 队列里最早一帧等待发送的起点
+        self._mark_dirty(session)
+
+    def _mark_dirty(self, session):
+        self._dirty.add(session)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.call_later(self.flush_interval, self._flush_dirty)
+
+    def _flush_dirty(self):
+        self._flush_scheduled = False
+        dirty, self._dirty = self._dirty, set()
+        for session in dirty:
+            if session.isOn and not session.closing:
+                self._flush(session)
+
+    def _flush(self, session):
+        try:
+            sent, calls = session.out_queue.write_to(session.user_socket)
+            # 聊天消息都发完了才发文件的下一块，传大文件时聊天不会被堵住
+            while not session.out_queue and session.downloads:
+                download = session.downloads[0]
+                n, c, finished = download.write_to(session.user_socket)
+                sent += n
+                calls += c
+                self.metrics.file_bytes_out.inc(n)
+                if download.done:
+                    download.close()
+                    session.downloads.popleft()
+                if not finished:
+                    break  # socket 写满了
+        except OSError:
+            session.closing = True
+            self.call_later(0, self._close_session, session, True)
+            return
+        self.metrics.send_calls.inc(calls)
+        self.metrics.bytes_out.inc(sent)
+        if sent and session.queued_at is not None:
+            self.metrics.send_latency.observe(time.perf_counter() - session.queued_at)
+            session.queued_at = time.perf_counter() if session.out_queue else None
+        # 队列里还有数据就关注可写事件，发完了就取消，避免空转
+        want_write = bool(session.out_queue) or bool(session.downloads)
+        if want_write != session.want_write:
+            session.want_write = want_write
+            self._update_events(session)
+
+    def queue_depths(self):
+        '''每个会话发送队列的深度：{客户端名字: (帧数, 字节数)}'''
+        return {name: session.out_queue.depth() for name, session in list(self.session_map.items())}
+
+    def _close_session(self, session, notify):
+        if not session.isOn:
+            return
+        session.isOn = False
+        try:
+            self.selector.unregister(session.user_socket)
+        except (KeyError, ValueError):
+            pass
+        self.sessions.pop(session.fileno(), None)
+        session.user_socket.close()  # 保持和客户端会话的socket关掉
+        for file_id in session.uploads:
+            self.files.remove(file_id)  # 没传完的文件不要了
+        session.uploads.clear()
+        for download in session.downloads:
+            download.close()
+        session.downloads.clear()
+        if session is self.bus:
+            print('广播总线断开，服务器停止')
+            self.bus = None
+            self.isOn = False
+            return
+        rooms = self.rooms.leave_all(session)
+        username = session.username
+        if username is not None and self.session_map.get(username) is session:
+            del self.session_map[username]
+            if notify:
+                # 有用户离开，需要在他所在的每个房间通知其他人
+                for room in rooms:
+                    self.show_info_and_send_client("服务器通知", "%s离开聊天室！" % username, now_str(), room)
+
+    def _reap(self):
+        # 定期检查所有会话：长时间没有数据的先发心跳，再不回就关闭，离开通知由 _close_session 发一次
+        now = time.monotonic()
+        ping = protocol.encode_frame(protocol.PING)
+        for session in list(self.sessions.values()):
+            if not session.isOn or session.closing:
+                continue
+            idle = now - session.last_seen
+            if session.username is None:
+                if idle > self.login_timeout:
+                    self.metrics.reaped.inc()
+                    self._close_session(session, notify=False)
+            elif idle > self.idle_timeout:
+                print('客户端%s已经%d秒没有响应，断开' % (session.username, idle))
+                self.metrics.reaped.inc()
+                self._close_session(session, notify=True)
+            elif idle > self.ping_interval and now - session.last_ping > self.ping_interval:
+                session.last_ping = now
+                self._send(session, ping)
+        self.call_later(self.reap_interval, self._reap)
+
+    def _shutdown(self):
+        self.isOn = False
+
+    def _close_all(self):
+        for session in list(self.sessions.values()):
+            self._close_session(session, notify=False)
+        if self.bus is not None:
+            self.bus.user_socket.close()
+            self.bus = None
+        self.files.close()
+        self.selector.close()
+        self.server_socket.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        print("服务器已经停止")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='无界面的聊天服务器')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--max-queue-frames', type=int, default=1000, help='每个会话发送队列最多积压的帧数')
+    parser.add_argument('--max-queue-bytes', type=int, default=4 * 1024 * 1024, help='每个会话发送队列最多积压的字节数')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=DROP_OLDEST, help='发送队列满了之后的处理策略')
+    parser.add_argument('--flush-interval', type=float, default=0.001, help='集中发送的间隔（秒）')
+    parser.add_argument('--records', default='records', help='聊天记录日志的目录，为空表示不记录')
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default=FSYNC_INTERVAL, help='聊天记录的 fsync 策略')
+    parser.add_argument('--ping-interval', type=float, default=20.0, help='客户端空闲多少秒后发心跳')
+    parser.add_argument('--idle-timeout', type=float, default=60.0, help='客户端空闲多少秒后断开')
+    parser.add_argument('--msg-rate', type=float, help='每个客户端每秒最多发几条消息')
+    parser.add_argument('--msg-burst', type=float, help='每个客户端最多连续发几条消息')
+    parser.add_argument('--byte-rate', type=float, help='每个客户端每秒最多发多少字节')
+    parser.add_argument('--byte-burst', type=float, help='每个客户端最多连续发多少字节')
+    parser.add_argument('--global-msg-rate', type=float, help='所有客户端加起来每秒最多几条消息')
+    parser.add_argument('--global-byte-rate', type=float, help='所有客户端加起来每秒最多多少字节')
+    parser.add_argument('--throttle', choices=THROTTLE_POLICIES, default=REJECT, help='超过限制时丢弃还是推迟读取')
+    parser.add_argument('--no-compress', action='store_true', help='不同意客户端的压缩请求')
+    parser.add_argument('--compress-threshold', type=int, default=protocol.COMPRESS_THRESHOLD,
+                        help='消息体超过多少字节才压缩')
+    parser.add_argument('--search', default='records/search.db', help='全文搜索索引的 SQLite 文件，为空表示不支持搜索')
+    parser.add_argument('--mailboxes', default='mailboxes', help='私信信箱的目录，为空表示不支持私信')
+    parser.add_argument('--metrics-port', type=int, help='在 127.0.0.1 的这个端口上提供 /metrics')
+    parser.add_argument('--metrics-unix', help='在这个 Unix socket 上提供 /metrics')
+    args = parser.parse_args()
+    transcript = TranscriptLog(args.records, fsync=args.fsync) if args.records else None
+    mailboxes = MailboxStore(args.mailboxes, fsync=args.fsync) if args.mailboxes else None
+    search = SearchIndex(args.search) if args.search else None
+    if search is not None and args.records:
+        search.catch_up(args.records)
+    limiter = None
+    if args.msg_rate or args.byte_rate or args.global_msg_rate or args.global_byte_rate:
+        limiter = RateLimiter(args.msg_rate, args.msg_burst, args.byte_rate, args.byte_burst,
+                              global_message_rate=args.global_msg_rate, global_byte_rate=args.global_byte_rate,
+                              policy=args.throttle)
+    engine = ChatEngine((args.host, args.port), max_queue_frames=args.max_queue_frames,
+                        max_queue_bytes=args.max_queue_bytes, overflow=args.overflow,
+                        flush_interval=args.flush_interval, transcript=transcript,
+                        ping_interval=args.ping_interval, idle_timeout=args.idle_timeout, limiter=limiter,
+                        compression=not args.no_compress, compress_threshold=args.compress_threshold,
+                        mailboxes=mailboxes, search=search)
+    engine.add_listener(lambda send_data: print('---------------------------------\n%s' % send_data, end=''))
+    if args.metrics_port:
+        MetricsServer(engine.metrics, port=args.metrics_port).start()
+    if args.metrics_unix:
+        MetricsServer(engine.metrics, unix_path=args.metrics_unix).start()
+    try:
+        engine.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if transcript is not None:
+            transcript.close()
+        if mailboxes is not None:
+            mailboxes.close()
+        if search is not None:
+            search.close()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+'''
+多进程聊天服务器：
+
+    python cluster.py --workers 4 --port 8888
+
+启动 N 个工作进程，每个进程跑一个 ChatEngine，用 SO_REUSEPORT 监听同一个端口，
+由内核把新连接分给各个进程，这样消息扇出就不再受一个进程的 GIL 限制。
+
+主进程跑一个 BusHub，用 Unix socket 把所有工作进程连起来：某个进程里产生的广播帧交给总线，
+总线原样转发给其他所有进程，它们再发给自己的客户端。每个进程到总线只有一条连接，
+总线按收到的顺序转发，所以同一个发送者的消息在所有进程里的顺序都是一致的。
+
+多进程模式的限制：聊天记录和 HISTORY 回放、私信信箱、全文搜索都是一个进程自己的文件，
+几个进程各写各的会让消息 id 重复、信箱找不到接收者，所以多进程模式下这几个功能不开，
+客户端请求时会收到 ACK {"error": "服务器没有保存聊天记录" / "服务器不支持私信" / "服务器不支持搜索"}；
+start_workers 收到 transcript、mailboxes、search 参数时直接报错。需要这些功能就用 chat_engine.py 单进程运行。
+限流照常工作：每个客户端的限制就在它所在的进程里；全局限制按进程数平均分给每个进程。
+'''
+import argparse
+import multiprocessing
+import os
+import selectors
+import signal
+import tempfile
+from socket import *
+
+import protocol
+from chat_engine import ChatEngine
+from metrics import MetricsServer
+from outbound import DISCONNECT, OVERFLOW_POLICIES, DROP_OLDEST, OutboundQueue, QueueOverflow
+from ratelimit import REJECT, THROTTLE_POLICIES, RateLimiter
+
+# 这些功能的数据是一个进程自己的文件，多进程模式不支持，见模块说明
+SINGLE_PROCESS_FEATURES = ('transcript', 'mailboxes', 'search')
+
+
+class BusHub:
+    '''进程间的广播总线：把每个工作进程发来的帧转发给其他所有工作进程'''
+
+    def __init__(self, path):
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+        self.peers = {}  # socket -> (解码器, 发送队列)
+        self.isOn = False
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server_socket = socket(AF_UNIX, SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.listen(64)
+        self.server_socket.setblocking(False)
+
+    def serve_forever(self):
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.isOn = True
+        try:
+            while self.isOn:
+                for key, mask in self.selector.select(1):
+                    if key.fileobj is self.server_socket:
+                        self._accept()
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self._on_readable(key.fileobj)
+                    if mask & selectors.EVENT_WRITE and key.fileobj in self.peers:
+                        self._flush(key.fileobj)
+        finally:
+            for sock in list(self.peers):
+                sock.close()
+            self.server_socket.close()
+            self.selector.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _accept(self):
+        sock, _ = self.server_socket.accept()
+        sock.setblocking(False)
+        self.peers[sock] = (protocol.FrameDecoder(), OutboundQueue(100000, 256 * 1024 * 1024, DISCONNECT))
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def _on_readable(self, sock):
+        decoder, _ = self.peers[sock]
+        try:
+            n = sock.recv_into(decoder.buffer())
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+        if n == 0:
+            self._drop(sock)
+            return
+        decoder.advance(n)
+        others = [peer for peer in self.peers if peer is not sock]
+        try:
+            for frame in decoder.frames():
+                data = protocol.encode_frame(frame.type, bytes(frame.payload), frame.flags)
+                for peer in others:
+                    if peer not in self.peers:
+                        continue  # 前面的帧已经把它挤爆断开了
+                    try:
+                        self.peers[peer][1].push(data)
+                    except QueueOverflow:
+                        print('工作进程接收太慢，断开总线连接')
+                        self._drop(peer)
+        except protocol.ProtocolError as e:
+            # 只断开发来坏帧的这个进程，总线还要给其他进程转发；前面已经放进队列的帧照样发出去
+            print('工作进程发来的数据不对，断开总线连接：%s' % e)
+            self._drop(sock)
+        for peer in others:
+            if peer in self.peers:
+                self._flush(peer)
+
+    def _flush(self, sock):
+        queue = self.peers[sock][1]
+        try:
+            queue.write_to(sock)
+        except OSError:
+            self._drop(sock)
+            return
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if queue else selectors.EVENT_READ
+        self.selector.modify(sock, events)
+
+    def _drop(self, sock):
+        if self.peers.pop(sock, None) is not None:
+            self.selector.unregister(sock)
+            sock.close()
+
+
+def run_worker(host_port, bus_path, engine_kwargs, metrics_port=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C 由主进程统一处理
+    engine = ChatEngine(host_port, reuse_port=True, bus_path=bus_path, **engine_kwargs)
+    if metrics_port:
+        MetricsServer(engine.metrics, port=metrics_port).start()
+    engine.serve_forever()
+
+
+def start_workers(workers, host_port, bus_path, metrics_port=None, **engine_kwargs):
+    '''
+    启动 workers 个工作进程，返回进程列表；总线 BusHub 必须已经在 bus_path 上监听。
+    给了 metrics_port 的话，第 i 个工作进程在 metrics_port + i 上提供 /metrics。
+    engine_kwargs 传给每个进程的 ChatEngine，不能有 transcript、mailboxes、search（见模块说明）。
+    '''
+    unsupported = [name for name in SINGLE_PROCESS_FEATURES if engine_kwargs.get(name) is not None]
+    if unsupported:
+        raise ValueError('多进程模式不支持：%s' % ', '.join(unsupported))
+    processes = []
+    for i in range(workers):
+        port = metrics_port + i if metrics_port else None
+        p = multiprocessing.Process(target=run_worker, args=(host_port, bus_path, engine_kwargs, port),
+                                    name='chat-worker-%d' % i)
+        p.daemon = True
+        p.start()
+        processes.append(p)
+    return processes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='多进程聊天服务器',
+        epilog='多进程模式不保存聊天记录（没有 HISTORY 回放），也不支持私信和搜索；需要的话用 chat_engine.py 单进程运行。')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--bus', default=os.path.join(tempfile.gettempdir(), 'chat-bus-%d.sock' % os.getpid()),
+                        help='总线使用的 Unix socket 路径')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=DROP_OLDEST, help='发送队列满了之后的处理策略')
+    parser.add_argument('--msg-rate', type=float, help='每个客户端每秒最多发几条消息')
+    parser.add_argument('--msg-burst', type=float, help='每个客户端最多连续发几条消息')
+    parser.add_argument('--byte-rate', type=float, help='每个客户端每秒最多发多少字节')
+    parser.add_argument('--byte-burst', type=float, help='每个客户端最多连续发多少字节')
+    parser.add_argument('--global-msg-rate', type=float, help='所有客户端加起来每秒最多几条消息（平均分给每个进程）')
+    parser.add_argument('--global-byte-rate', type=float, help='所有客户端加起来每秒最多多少字节（平均分给每个进程）')
+    parser.add_argument('--throttle', choices=THROTTLE_POLICIES, default=REJECT, help='超过限制时丢弃还是推迟读取')
+    parser.add_argument('--metrics-port', type=int, help='第 i 个工作进程在这个端口 + i 上提供 /metrics')
+    args = parser.parse_args()
+    limiter = None
+    if args.msg_rate or args.byte_rate or args.global_msg_rate or args.global_byte_rate:
+        # 每个进程有自己的全局令牌桶，加起来等于设定的全局限制
+        limiter = RateLimiter(args.msg_rate, args.msg_burst, args.byte_rate, args.byte_burst,
+                              global_message_rate=args.global_msg_rate and args.global_msg_rate / args.workers,
+                              global_byte_rate=args.global_byte_rate and args.global_byte_rate / args.workers,
+                              policy=args.throttle)
+    hub = BusHub(args.bus)
+    processes = start_workers(args.workers, (args.host, args.port), args.bus, metrics_port=args.metrics_port,
+                              overflow=args.overflow, limiter=limiter)
+    print('启动了%d个工作进程，总线：%s' % (len(processes), args.bus))
+    print('注意：多进程模式不保存聊天记录，HISTORY 回放、私信和搜索都不可用')
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in processes:
+            p.terminate()
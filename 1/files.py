@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+聊天室里的文件传输：服务器端的文件暂存和分块下发。
+
+上传：客户端发 FILE_OFFER 登记文件，服务器分配 file_id，之后客户端用 FILE_DATA 帧一块一块地发；
+服务器每收到窗口的一半就回 ACK {"file_id": ..., "received": 字节数}，客户端最多领先 window 字节，
+这样大文件不会把服务器的接收缓冲和内存撑满。每个上传的文件在服务器上只存一份：
+不超过 spool_bytes 的放在内存里，大的写进临时文件（关闭即删除）。
+上传到一半的文件在会话关闭时删掉；会话还在但是 upload_timeout 秒没有新数据的也由 expire() 删掉，
+登记的大小不会一直占着 max_total_bytes。
+
+下载：收到 FILE_GET 后给这个会话挂一个 Download，事件循环在会话的文本发送队列空了以后才发下一块，
+所以传大文件时聊天消息最多只等一块（chunk_size）的时间。磁盘上的文件用 os.sendfile 直接从
+页缓存发到 socket，不经过 Python 的内存；内存里的小文件直接 send。没有 os.sendfile 的平台（Windows）
+每一块先读进内存再 send。
+
+FILE_DATA 帧的消息体不是 JSON，而是 4 字节的 file_id（网络字节序）加上文件内容。
+'''
+import os
+import struct
+import tempfile
+import time
+
+import protocol
+
+FILE_ID = struct.Struct('!I')
+HAS_SENDFILE = hasattr(os, 'sendfile')
+
+
+class FileRejected(Exception):
+    '''上传请求不能接受（太大、空间不够），消息作为错误回给客户端'''
+
+
+def data_frame_header(file_id, length):
+    '''FILE_DATA 帧的帧头加上 file_id，后面紧跟 length 字节的文件内容'''
+    return protocol.HEADER.pack(protocol.VERSION, protocol.FILE_DATA, 0, FILE_ID.size + length) + FILE_ID.pack(file_id)
+
+
+def split_data(payload):
+    '''把 FILE_DATA 的消息体拆成 (file_id, 文件内容)'''
+    if len(payload) < FILE_ID.size:
+        raise protocol.ProtocolError('FILE_DATA 太短')
+    return FILE_ID.unpack_from(payload)[0], payload[FILE_ID.size:]
+
+
+class StoredFile:
+    def __init__(self, file_id, name, size, source, room, spool_bytes, directory):
+        self.file_id = file_id
+        self.name = name
+        self.size = size
+        self.source = source
+        self.room = room
+        self.received = 0
+        self.acked = 0  # 最后一次回 ACK 时收到的字节数
+        self.created = time.monotonic()
+        self.updated = self.created  # 最后一次收到内容的时间
+        self.downloads = 0  # 正在下载的人数，过期时有人在下载就等下载完再删
+        if size <= spool_bytes:
+            self.data = bytearray()
+            self.file = None
+        else:
+            self.data = None
+            self.file = tempfile.TemporaryFile(dir=directory)
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def write(self, chunk):
+        if self.received + len(chunk) > self.size:
+            raise protocol.ProtocolError('文件%d的内容超过了登记的大小' % self.file_id)
+        if self.file is None:
+            self.data += chunk
+        else:
+            self.file.write(chunk)
+            if self.received + len(chunk) == self.size:
+                self.file.flush()  # sendfile 直接读文件，缓冲区里的数据要先写进去
+        self.received += len(chunk)
+        self.updated = time.monotonic()
+
+    def read(self, offset, length):
+        '''读出文件的一段，没有 sendfile 的平台下载时用'''
+        if self.file is None:
+            return self.data[offset:offset + length]
+        if hasattr(os, 'pread'):
+            return os.pread(self.file.fileno(), length, offset)
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.data = None
+
+
+class FileStore:
+    def __init__(self, directory=None, spool_bytes=256 * 1024, max_file_bytes=100 * 1024 * 1024,
+                 max_total_bytes=1024 * 1024 * 1024, ttl=3600.0, window=1024 * 1024, upload_timeout=300.0):
+        self.directory = directory  # 临时文件放在哪里，None 表示系统的临时目录
+        self.spool_bytes = spool_bytes
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.ttl = ttl  # 上传完成之后保留多久
+        self.upload_timeout = upload_timeout  # 上传到一半的文件多久没有新数据就删掉
+        self.window = window  # 上传时客户端最多领先服务器确认多少字节
+        self.files = {}  # file_id -> StoredFile
+        self.total_bytes = 0
+        self._next_id = 1
+
+    def create(self, name, size, source, room):
+        if size <= 0:
+            raise FileRejected('文件是空的')
+        if size > self.max_file_bytes:
+            raise FileRejected('文件太大，最多%d字节' % self.max_file_bytes)
+        if self.total_bytes + size > self.max_total_bytes:
+            raise FileRejected('服务器暂存的文件太多了，稍后再试')
+        stored = StoredFile(self._next_id, name, size, source, room, self.spool_bytes, self.directory)
+        self._next_id += 1
+        self.files[stored.file_id] = stored
+        self.total_bytes += size
+        return stored
+
+    def get(self, file_id):
+        return self.files.get(file_id)
+
+    def remove(self, file_id):
+        stored = self.files.pop(file_id, None)
+        if stored is not None:
+            self.total_bytes -= stored.size
+            stored.close()
+
+    def expire(self, now=None):
+        '''删掉过期而且没人在下载的文件，还有很久没有新数据的上传，返回删掉的个数'''
+        now = time.monotonic() if now is None else now
+        expired = [stored.file_id for stored in self.files.values()
+                   if (stored.complete and not stored.downloads and now - stored.created > self.ttl)
+                   or (not stored.complete and now - stored.updated > self.upload_timeout)]
+        for file_id in expired:
+            self.remove(file_id)
+        return len(expired)
+
+    def close(self):
+        for file_id in list(self.files):
+            self.remove(file_id)
+
+
+class Download:
+    '''一个会话正在下载的文件，由事件循环在 socket 可写时一块一块地发'''
+
+    def __init__(self, stored, chunk_size=64 * 1024):
+        self.stored = stored
+        self.chunk_size = chunk_size
+        self.offset = 0  # 下一块从文件的哪里开始
+        self.prefix = None  # 当前这一块还没发出去的帧头（内存里的文件连内容一起）
+        self.chunk_left = 0  # 当前这一块还要用 sendfile 发的字节数
+        stored.downloads += 1
+
+    @property
+    def done(self):
+        return self.offset >= self.stored.size and not self.prefix and not self.chunk_left
+
+    def write_to(self, sock):
+        '''
+        发送当前这一块（没有就开始下一块），返回 (发出的字节数, 系统调用次数, 这一块是否发完)。
+        socket 写满时返回，这一块没发完的部分下次接着发。
+        '''
+        stored = self.stored
+        if not self.prefix and not self.chunk_left:
+            length = min(self.chunk_size, stored.size - self.offset)
+            header = data_frame_header(stored.file_id, length)
+            if stored.file is None or not HAS_SENDFILE:
+                # 内存里的小文件（或者平台没有 sendfile），帧头和内容一起 send
+                self.prefix = memoryview(header + stored.read(self.offset, length))
+                self.offset += length
+            else:
+                self.prefix = memoryview(header)
+                self.chunk_left = length
+        sent = calls = 0
+        try:
+            while self.prefix:
+                n = sock.send(self.prefix)
+                calls += 1
+                sent += n
+                self.prefix = self.prefix[n:] if n < len(self.prefix) else None
+            while self.chunk_left:
+                # 非阻塞 socket 不能用 socket.sendfile，直接调用 os.sendfile，写满时抛 BlockingIOError
+                n = os.sendfile(sock.fileno(), stored.file.fileno(), self.offset, self.chunk_left)
+                calls += 1
+                if n == 0:
+                    raise ConnectionResetError('sendfile 没有写出任何数据')
+                sent += n
+                self.offset += n
+                self.chunk_left -= n
+        except (BlockingIOError, InterruptedError):
+            return sent, calls, False
+        return sent, calls, True
+
+    def close(self):
+        self.stored.downloads -= 1
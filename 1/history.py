@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+'''
+聊天记录的偏移索引和按 id 回放。
+
+transcript.py 写出的段文件一行一条消息，同一段里的 id 是连续的。HistoryIndex 在内存里只记：
+    每个段：第一条消息的 id、每一行在文件里的起始偏移（array，每条 8 字节）
+    每个房间：这个房间里所有消息的 id（array，每条 8 字节）
+消息内容本身不进内存。回放时按 id 找到段和偏移，用 mmap 直接从文件里切出那一行，
+这一行就是当初广播出去的 JSON，原样放进 CHAT 帧里发给客户端，不用再解析、编码一遍。
+'''
+import bisect
+import json
+import mmap
+import threading
+from array import array
+
+
+class Segment:
+    def __init__(self, first_id, path):
+        self.first_id = first_id
+        self.path = path
+        self.offsets = array('Q')  # 第 i 条消息（id = first_id + i）的起始偏移
+        self.end = 0  # 已经写进文件并且可以读的字节数
+
+
+class HistoryIndex:
+    def __init__(self):
+        self.segments = []
+        self.first_ids = []  # 和 segments 对应，用来二分查找
+        self.room_ids = {}  # 房间名 -> array(消息 id)
+        self.lock = threading.Lock()
+        self._maps = {}  # 路径 -> (mmap, 映射的长度)
+
+    def load(self, segments):
+        '''启动时扫描已有的段文件 [(第一条 id, 路径), ...] 建立索引（这时还没有写线程，不用加锁）'''
+        for first_id, path in segments:
+            segment = self._segment(first_id, path)
+            with open(path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    record = json.loads(line.decode('UTF-8'))
+                    self._add(segment, record['id'], record.get('room'), offset, offset + len(line))
+                    offset += len(line)
+
+    def add_batch(self, entries):
+        '''写线程每提交一批就调用一次：entries = [(段第一条 id, 路径, 消息 id, 房间, 起始偏移, 结束偏移), ...]'''
+        with self.lock:
+            for first_id, path, record_id, room, start, end in entries:
+                segment = self.segments[-1] if self.segments and self.segments[-1].path == path else None
+                if segment is None:
+                    segment = self._segment(first_id, path)
+                self._add(segment, record_id, room, start, end)
+
+    def ids(self, room, last=None, since=None):
+        '''房间里最后 last 条，或者 id 大于 since 的所有消息 id'''
+        with self.lock:
+            ids = self.room_ids.get(room)
+            if not ids:
+                return array('Q')
+            if since is not None:
+                return ids[bisect.bisect_right(ids, since):]
+            return ids[-last:] if last else array('Q')
+
+    def read(self, ids):
+        '''按 id 依次给出每条消息的 JSON（bytes，不带换行）'''
+        for record_id in ids:
+            with self.lock:
+                index = bisect.bisect_right(self.first_ids, record_id) - 1
+                if index < 0:
+                    continue
+                segment = self.segments[index]
+                i = record_id - segment.first_id
+                if i >= len(segment.offsets):
+                    continue
+                start = segment.offsets[i]
+                end = segment.offsets[i + 1] if i + 1 < len(segment.offsets) else segment.end
+            data = self._map(segment.path, end)
+            yield data[start:end - 1]
+
+    def close(self):
+        for data, _ in self._maps.values():
+            data.close()
+        self._maps.clear()
+
+    def _segment(self, first_id, path):
+        segment = Segment(first_id, path)
+        self.segments.append(segment)
+        self.first_ids.append(first_id)
+        return segment
+
+    def _add(self, segment, record_id, room, start, end):
+        segment.offsets.append(start)
+        segment.end = end
+        self.room_ids.setdefault(room, array('Q')).append(record_id)
+
+    def _map(self, path, need):
+        # 段文件一直在追加，映射的长度不够时重新映射一次
+        cached = self._maps.get(path)
+        if cached is not None and cached[1] >= need:
+            return cached[0]
+        if cached is not None:
+            cached[0].close()
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[path] = (data, len(data))
+        return data
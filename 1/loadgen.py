@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+'''
+聊天服务器的压力测试工具，不需要图形界面：
+
+    python loadgen.py --clients 2000 --senders 200 --rate 5 --duration 30 --output result.json
+
+打开 --clients 个模拟客户端，和图形界面的客户端一样用 chat_client.ChatClient 连接，走真实的
+握手流程（连上之后第一帧是带名字的 JOIN，等服务器回 ACK 才算登录成功），其中前 --senders 个按 --rate 条/秒的速度发聊天信息。
+
+统计内容：
+    连接建立时间   从开始 connect 到收到 JOIN 的 ACK
+    发送吞吐量     实际发出的聊天条数 / 发送时长
+    端到端延迟     消息里带着发送时刻，接收方收到时计算延迟，给出 p50 / p99 / p999
+    投递吞吐量     观察者收到的消息数 / 时长
+
+每条广播会发给所有客户端，负载生成器自己解析所有消息的话会先于服务器成为瓶颈，所以只有
+--observers 个客户端把消息放进接收队列并统计延迟，其余客户端把收到的字节直接丢掉。
+延迟按计划发送时刻计算（不是实际发出的时刻），发送端自己落后时也会算进延迟里，不会被掩盖。
+
+结果用 --output 写成 json，方便对比不同版本。
+'''
+import argparse
+import asyncio
+import json
+import resource
+import time
+
+import protocol
+from chat_client import ChatClient
+
+MAGIC = 'loadgen'
+
+
+def percentile(values, p):
+    '''values 已经排好序'''
+    if not values:
+        return None
+    index = min(len(values) - 1, int(p / 100.0 * len(values)))
+    return values[index]
+
+
+def summary(values, scale=1000.0):
+    # 秒转成毫秒
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {'count': len(values), 'mean': sum(values) / len(values) * scale,
+            'p50': percentile(values, 50) * scale, 'p99': percentile(values, 99) * scale,
+            'p999': percentile(values, 99.9) * scale, 'max': values[-1] * scale}
+
+
+def raise_fd_limit():
+    # 几千个连接会超过默认的 1024 个文件描述符
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class Bot:
+    def __init__(self, index, args, results):
+        self.index = index
+        self.args = args
+        self.results = results
+        self.observer = index < args.observers
+        self.sender = index < args.senders
+        # 压测时不自动重连，断开就是失败；不是观察者的客户端不处理收到的消息
+        self.client = ChatClient('bot%d' % index, (args.host, args.port), room=args.room, reconnect=False,
+                                 receive_messages=self.observer)
+
+    async def connect(self):
+        start = time.perf_counter()
+        await self.client.connect()
+        self.results['connect'].append(time.perf_counter() - start)
+
+    async def observe(self):
+        latencies = self.results['latency']
+        async for message in self.client:
+            if message.type != protocol.CHAT:
+                continue
+            data = message.body.get('data', '')
+            if not data.startswith(MAGIC):
+                continue
+            now = time.perf_counter()
+            _, sent = data.split('|', 2)[:2]
+            latencies.append(now - float(sent))
+            self.results['delivered'] += 1
+
+    async def send(self, start, stop):
+        # 按固定间隔排好发送计划，错开每个发送者的起点
+        interval = 1.0 / self.args.rate
+        scheduled = start + interval * (self.index % 1000) / 1000.0
+        padding = 'x' * self.args.size
+        while scheduled < stop:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.client.send('%s|%.9f|%s' % (MAGIC, scheduled, padding), self.args.room)
+            self.results['sent'] += 1
+            scheduled += interval
+
+    async def close(self):
+        try:
+            await self.client.close()
+        except OSError:
+            pass
+
+
+async def connect_all(bots, concurrency, results):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(bot):
+        async with semaphore:
+            try:
+                await asyncio.wait_for(bot.connect(), 30)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, protocol.ProtocolError):
+                results['connect_failed'] += 1
+                await bot.close()
+
+    await asyncio.gather(*(one(bot) for bot in bots))
+    return [bot for bot in bots if bot.client.isConnected]
+
+
+async def run(args):
+    results = {'connect': [], 'connect_failed': 0, 'latency': [], 'sent': 0, 'delivered': 0}
+    bots = [Bot(i, args, results) for i in range(args.clients)]
+
+    connect_start = time.perf_counter()
+    bots = await connect_all(bots, args.connect_concurrency, results)
+    connect_seconds = time.perf_counter() - connect_start
+    print('连接完成：%d 个成功，%d 个失败，用时 %.2fs' % (len(bots), results['connect_failed'], connect_seconds))
+
+    receivers = [asyncio.ensure_future(bot.observe()) for bot in bots if bot.observer]
+    await asyncio.sleep(args.warmup)
+    # 热身期间收到的欢迎信息之类不算
+    results['latency'].clear()
+    results['delivered'] = 0
+
+    start = time.perf_counter()
+    stop = start + args.duration
+    await asyncio.gather(*(bot.send(start, stop) for bot in bots if bot.sender))
+    send_seconds = time.perf_counter() - start
+    await asyncio.sleep(args.drain)
+    total_seconds = time.perf_counter() - start
+
+    await asyncio.gather(*(bot.close() for bot in bots))
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    observers = min(args.observers, len(bots))
+    expected = results['sent'] * observers
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'clients_connected': len(bots),
+        'connect_failed': results['connect_failed'],
+        'connect_seconds': connect_seconds,
+        'connect_ms': summary(results['connect']),
+        'sent': results['sent'],
+        'send_seconds': send_seconds,
+        'sent_per_sec': results['sent'] / send_seconds if send_seconds else 0,
+        'observers': observers,
+        'delivered': results['delivered'],
+        'delivery_ratio': results['delivered'] / expected if expected else None,
+        'delivered_per_sec': results['delivered'] / total_seconds,
+        # 每个客户端都会收到广播，服务器实际的投递量按观察者的比例估算
+        'fanout_per_sec_estimate': results['delivered'] / total_seconds * len(bots) / observers if observers else None,
+        'latency_ms': summary(results['latency']),
+    }
+    return report
+
+
+def print_report(report):
+    connect = report['connect_ms']
+    latency = report['latency_ms']
+    if connect['count']:
+        print('连接建立: p50 %.2fms  p99 %.2fms  p999 %.2fms  max %.2fms' % (
+            connect['p50'], connect['p99'], connect['p999'], connect['max']))
+    print('发送: %d 条，%.0f 条/s' % (report['sent'], report['sent_per_sec']))
+    if latency['count']:
+        print('投递: %d 条（%.1f%%），估计服务器扇出 %.0f 条/s' % (
+            report['delivered'], report['delivery_ratio'] * 100, report['fanout_per_sec_estimate']))
+        print('端到端延迟: p50 %.2fms  p99 %.2fms  p999 %.2fms  max %.2fms' % (
+            latency['p50'], latency['p99'], latency['p999'], latency['max']))
+    else:
+        print('观察者没有收到任何消息')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='聊天服务器压力测试')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--clients', type=int, default=1000, help='模拟客户端数')
+    parser.add_argument('--senders', type=int, default=100, help='其中发送消息的客户端数')
+    parser.add_argument('--observers', type=int, default=50, help='其中解析消息、统计延迟的客户端数')
+    parser.add_argument('--rate', type=float, default=1.0, help='每个发送者每秒发送的消息数')
+    parser.add_argument('--size', type=int, default=32, help='每条消息附加的填充字节数')
+    parser.add_argument('--duration', type=float, default=10.0, help='发送时长（秒）')
+    parser.add_argument('--warmup', type=float, default=1.0, help='连接完成后等待多久再开始发送')
+    parser.add_argument('--drain', type=float, default=2.0, help='发送结束后继续接收多久')
+    parser.add_argument('--room', help='所有客户端进入这个房间，不写就是大厅')
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='同时进行的连接数')
+    parser.add_argument('--output', help='把结果写成 json 文件')
+    args = parser.parse_args()
+    limit = raise_fd_limit()
+    if args.clients + 16 > limit:
+        parser.error('客户端数超过了文件描述符上限 %d' % limit)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
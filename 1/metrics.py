@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+'''
+聊天服务器的运行指标，用 Prometheus 的文本格式输出：
+
+    python chat_engine.py --metrics-port 9100
+    curl http://127.0.0.1:9100/metrics
+
+也可以用 --metrics-unix 指定一个 Unix socket 路径，只给本机的进程访问：
+
+    curl --unix-socket /tmp/chat-metrics.sock http://localhost/metrics
+
+计数器（*_total）只增不减，每秒的速率交给 Prometheus 的 rate() 去算；直方图按 Prometheus 的约定
+输出累积的 _bucket、_sum、_count。指标由事件循环线程更新，HTTP 线程只读，不加锁：
+读到的是某一时刻的近似值，对监控来说足够了。
+'''
+import bisect
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 以秒为单位的默认桶，从 10 微秒到 5 秒
+TIME_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels)
+    return '{%s}' % ','.join(escaped)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, (), self.value
+
+
+class Gauge:
+    '''当前值；给了 fn 的话每次输出时调用 fn() 取值'''
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, (), self.fn() if self.fn is not None else self.value
+
+
+class LabeledGauge:
+    '''一组带标签的当前值，fn() 返回 [(标签值, 数值), ...]'''
+    kind = 'gauge'
+
+    def __init__(self, name, help, label, fn):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.fn = fn
+
+    def samples(self):
+        for label_value, value in self.fn():
+            yield self.name, ((self.label, label_value),), value
+
+
+class LabeledCounter(LabeledGauge):
+    '''一组带标签的计数，数值由 fn() 从各个对象上读出来'''
+    kind = 'counter'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个是 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), list(self.counts)):
+            cumulative += count
+            yield self.name + '_bucket', (('le', _format_value(float(bound))),), cumulative
+        yield self.name + '_sum', (), self.sum
+        yield self.name + '_count', (), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, fn=None):
+        return self.add(Gauge(name, help, fn))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class ChatMetrics(Registry):
+    '''ChatEngine 用到的所有指标'''
+
+    def __init__(self, engine, top_sessions=100):
+        Registry.__init__(self)
+        self.engine = engine
+        # 每个会话一条时间序列，几万个连接会把监控系统撑爆，所以只输出积压最多的 top_sessions 个
+        self.top_sessions = top_sessions
+        self.gauge('chat_sessions', '当前的 TCP 连接数', lambda: len(engine.sessions))
+        self.gauge('chat_users', '已经登录的客户端数', lambda: len(engine.session_map))
+        self.gauge('chat_rooms', '当前的房间数', lambda: len(engine.rooms.members_of))
+        self.accepts = self.counter('chat_accepts_total', '接受的连接数')
+        self.frames_in = self.counter('chat_frames_in_total', '收到的帧数')
+        self.bytes_in = self.counter('chat_bytes_in_total', '收到的字节数')
+        self.broadcasts = self.counter('chat_broadcasts_total', '广播的消息数')
+        self.frames_out = self.counter('chat_frames_out_total', '放进发送队列的帧数')
+        self.bytes_out = self.counter('chat_bytes_out_total', '发出的字节数')
+        self.send_calls = self.counter('chat_send_calls_total', '发送数据用的 send/sendmsg 调用次数')
+        self.overflows = self.counter('chat_queue_overflows_total', '发送队列满了被断开的会话数')
+        self.reaped = self.counter('chat_sessions_reaped_total', '心跳超时或者一直不登录被清理的会话数')
+        self.throttled = self.counter('chat_throttled_total', '被限流（拒绝或者推迟）的帧数')
+        self.add(LabeledCounter('chat_session_throttled_total', '被限流最多的几个会话的限流次数', 'session',
+                                self._top_throttled))
+        self.gauge('chat_sessions_paused', '因为限流暂停读取的会话数',
+                   lambda: sum(1 for session in list(engine.sessions.values()) if session.paused))
+        self.gauge('chat_outbound_queue_frames_max', '所有会话里发送队列积压最多的帧数', self._max_depth)
+        self.add(LabeledGauge('chat_outbound_queue_frames', '积压最多的几个会话的发送队列帧数', 'session',
+                              self._top_depths))
+        self.compressions = self.counter('chat_compressions_total', '压缩的帧数（每条广播只压缩一次）')
+        self.compress_saved = self.counter('chat_compress_saved_bytes_total', '压缩每帧省下的字节数（不乘接收人数）')
+        self.compress_time = self.histogram('chat_compress_seconds', '压缩一帧的用时')
+        self.files_uploaded = self.counter('chat_files_uploaded_total', '上传完成的文件数')
+        self.file_bytes_in = self.counter('chat_file_bytes_in_total', '收到的文件内容字节数')
+        self.file_bytes_out = self.counter('chat_file_bytes_out_total', '发出的文件字节数（含帧头）')
+        self.gauge('chat_files_stored_bytes', '服务器暂存的文件总大小', lambda: engine.files.total_bytes)
+        self.direct_messages = self.counter('chat_direct_messages_total', '收到的私信数')
+        self.direct_offline = self.counter('chat_direct_offline_total', '接收者不在线、留在信箱里的私信数')
+        self.direct_drained = self.counter('chat_direct_drained_total', '登录时从信箱里补发的私信数')
+        self.gauge('chat_mailbox_pending', '所有信箱里还没确认的私信数', self._mailbox_pending)
+        self.searches = self.counter('chat_searches_total', '搜索请求数')
+        self.search_time = self.histogram('chat_search_seconds', '一次搜索查询的用时（不含排队）')
+        self.fanout = self.histogram('chat_fanout_seconds', '一条广播放进所有接收者发送队列的用时')
+        self.send_latency = self.histogram('chat_send_latency_seconds', '帧进入发送队列到写进 socket 的等待时间')
+
+    def _mailbox_pending(self):
+        mailboxes = self.engine.mailboxes
+        if mailboxes is None:
+            return 0
+        return sum(mailbox.pending() for mailbox in list(mailboxes.mailboxes.values()))
+
+    def _depths(self):
+        return [(session.username or str(session.addr), len(session.out_queue))
+                for session in list(self.engine.sessions.values())]
+
+    def _max_depth(self):
+        return max((depth for _, depth in self._depths()), default=0)
+
+    def _top_throttled(self):
+        counts = [(session.username or str(session.addr), session.limits.throttled)
+                  for session in list(self.engine.sessions.values())
+                  if session.limits is not None and session.limits.throttled]
+        counts.sort(key=lambda item: item[1], reverse=True)
+        return counts[:self.top_sessions]
+
+    def _top_depths(self):
+        depths = [item for item in self._depths() if item[1]]
+        depths.sort(key=lambda item: item[1], reverse=True)
+        return depths[:self.top_sessions]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket 没有客户端地址
+        return str(self.client_address or 'unix')
+
+    def log_message(self, format, *args):
+        pass  # 每次抓取都打印一行太吵了
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class MetricsServer:
+    '''在后台线程里提供 /metrics，port 和 unix_path 给一个就行'''
+
+    def __init__(self, registry, port=None, host='127.0.0.1', unix_path=None):
+        if unix_path:
+            self.httpd = _UnixHTTPServer(unix_path, _Handler)
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), _Handler)
+            self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        self.unix_path = unix_path
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics')
+        self._thread.daemon = True
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.unix_path and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
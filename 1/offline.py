@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+'''
+私信的离线存储和转发。
+
+每个用户一个信箱，在 mailboxes 目录下对应两个文件（文件名是用户名的 SHA-1，长度固定，
+用户名再长也不会超出文件系统对文件名长度的限制）：
+
+    <用户>.log   一行一条私信 JSON，带递增的序号 seq
+    <用户>.ack   {"user": 用户名, "acked": N}，序号不超过 N 的私信对方已经确认收到
+
+用户第一次登录时登记信箱（写出 .ack 文件），只能给登记过的用户发私信，随便编一个名字不会多出一个信箱。
+所有私信都先进信箱再投递，用户在线就马上发给他，不在线就等他下次登录时从信箱里取。
+客户端收到后回 DM_ACK {"upto": seq}（累计确认），确认过的私信不会再发；信箱文件前面确认过的部分
+超过 compact_bytes 而且超过文件的一半时，把没确认的部分复制到新文件里替换掉旧文件（压缩）。
+
+读写文件都在后台写线程里完成，事件循环只调用 append / ack / read 把请求放进队列：
+写线程每次把积压的追加一起写出，按 fsync 策略落盘（和 transcript.py 一样的 group commit）；
+读请求排在它之前的追加后面，所以一定能读到已经分配了序号的私信。
+写文件出错（磁盘满之类）只影响这一条私信：文件退回到最后一条完整的私信，通过回调告诉发送者，
+序号空出来不要紧，每一行的序号都记着，读的时候按序号二分查找。
+'''
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from array import array
+from bisect import bisect_right
+
+from transcript import FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_POLICIES
+
+LOG_SUFFIX = '.log'
+ACK_SUFFIX = '.ack'
+
+
+def mailbox_name(username):
+    return hashlib.sha1(username.encode('UTF-8')).hexdigest()
+
+
+class Mailbox:
+    def __init__(self, username, directory):
+        self.username = username
+        base = os.path.join(directory, mailbox_name(username))
+        self.path = base + LOG_SUFFIX
+        self.ack_path = base + ACK_SUFFIX
+        # 事件循环线程使用
+        self.next_seq = 1  # 下一条私信的序号
+        self.acked = 0  # 客户端确认到的序号
+        # 写线程使用：文件里每一行的序号和起始偏移
+        self.file = None
+        self.seqs = array('Q')
+        self.offsets = array('Q')
+        self.size = 0
+        self.durable_acked = 0  # 已经写进 .ack 文件的确认序号
+
+    def pending(self):
+        '''还没确认的私信条数'''
+        return self.next_seq - 1 - self.acked
+
+
+class MailboxStore:
+    def __init__(self, directory='mailboxes', fsync=FSYNC_INTERVAL, fsync_interval=1.0, batch_size=1024,
+                 compact_bytes=1024 * 1024, read_bytes=256 * 1024):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('未知的 fsync 策略：%s' % fsync)
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.compact_bytes = compact_bytes
+        self.read_bytes = read_bytes  # 每次读请求最多读这么多字节
+        os.makedirs(directory, exist_ok=True)
+        self.mailboxes = {}  # 用户名 -> Mailbox，投递时直接按名字找，不用扫描
+        self._load()
+        self._queue = queue.Queue()
+        self._last_fsync = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='mailbox-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # ---------------- 事件循环线程调用 ----------------
+
+    def mailbox(self, username):
+        '''取出用户的信箱，没有就新建并登记（写出 .ack 文件），用户登录时调用'''
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            mailbox = self.mailboxes[username] = Mailbox(username, self.directory)
+            self._queue.put(('register', mailbox, None))
+        return mailbox
+
+    def known(self, username):
+        '''是不是登记过信箱的用户，只能给这些用户发私信'''
+        return username in self.mailboxes
+
+    def append(self, username, record, on_error=None):
+        '''
+        把一条私信（dict）放进 username 的信箱，分配并返回序号。写文件失败时在写线程里调用
+        on_error(序号, 异常)，需要切换线程的话由 on_error 自己处理。
+        '''
+        mailbox = self.mailbox(username)
+        record['seq'] = mailbox.next_seq
+        mailbox.next_seq += 1
+        line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('UTF-8')
+        self._queue.put(('append', mailbox, (record['seq'], line, on_error)))
+        return record['seq']
+
+    def ack(self, username, upto):
+        '''客户端确认收到了序号不超过 upto 的私信，返回是否有新的确认'''
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None or upto <= mailbox.acked:
+            return False
+        mailbox.acked = min(upto, mailbox.next_seq - 1)
+        self._queue.put(('ack', mailbox, mailbox.acked))
+        return True
+
+    def pending(self, username):
+        mailbox = self.mailboxes.get(username)
+        return mailbox.pending() if mailbox is not None else 0
+
+    def read(self, username, after, callback):
+        '''
+        在写线程里读出序号大于 after 的私信（最多 read_bytes 字节），然后在写线程里调用
+        callback([一行一条私信的 bytes, ...], 最后一条的序号)；需要切换线程的话由 callback 自己处理。
+        读文件出错时调用 callback(None, after)。
+        '''
+        self._queue.put(('read', self.mailbox(username), (after, callback)))
+
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self._queue.put(('flush', None, done))
+        return done.wait(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    # ---------------- 启动时加载 ----------------
+
+    def _load(self):
+        stems = set()
+        for name in os.listdir(self.directory):
+            for suffix in (LOG_SUFFIX, ACK_SUFFIX):
+                if name.endswith(suffix):
+                    stems.add(name[:-len(suffix)])
+        for stem in stems:
+            username = self._username(stem)
+            if username is None:
+                continue
+            mailbox = self.mailboxes[username] = Mailbox(username, self.directory)
+            if os.path.exists(mailbox.ack_path):
+                with open(mailbox.ack_path) as f:
+                    mailbox.acked = mailbox.durable_acked = json.load(f)['acked']
+            if os.path.exists(mailbox.path):
+                with open(mailbox.path, 'rb+') as f:
+                    offset = 0
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            f.truncate(offset)  # 进程崩溃时没写完的最后一行
+                            break
+                        mailbox.seqs.append(json.loads(line.decode('UTF-8'))['seq'])
+                        mailbox.offsets.append(offset)
+                        offset += len(line)
+                    mailbox.size = offset
+            last_seq = mailbox.seqs[-1] if mailbox.seqs else 0
+            mailbox.next_seq = max(last_seq, mailbox.acked) + 1
+
+    def _username(self, stem):
+        # 文件名是哈希，用户名记在 .ack 文件里；还没有确认过的信箱就看第一条私信的接收者
+        ack_path = os.path.join(self.directory, stem + ACK_SUFFIX)
+        if os.path.exists(ack_path):
+            with open(ack_path) as f:
+                username = json.load(f).get('user')
+            if username:
+                return username
+        log_path = os.path.join(self.directory, stem + LOG_SUFFIX)
+        if os.path.exists(log_path):
+            with open(log_path, 'rb') as f:
+                line = f.readline()
+            if line.endswith(b'\n'):
+                return json.loads(line.decode('UTF-8'))['to']
+        return None
+
+    # ---------------- 后台写线程 ----------------
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = {}  # 信箱 -> 这一批还没写出的 [(序号, 一行, on_error)]，每个信箱一次写出
+            synced = set()  # 这一批写过的信箱，统一 fsync
+            acked = set()
+            waiters = []
+            stop = False
+            for item in batch:
+                if item is None:
+                    stop = True
+                    continue
+                op, mailbox, arg = item
+                if op == 'append':
+                    written.setdefault(mailbox, []).append(arg)
+                elif op == 'register':
+                    acked.add(mailbox)
+                elif op == 'ack':
+                    if arg > mailbox.durable_acked:
+                        mailbox.durable_acked = arg
+                        acked.add(mailbox)
+                elif op == 'read':
+                    # 读之前先把这一批里排在前面的追加写出去，读请求之前的追加都能读到
+                    if mailbox in written and self._write(mailbox, written.pop(mailbox)):
+                        synced.add(mailbox)
+                    try:
+                        self._read(mailbox, *arg)
+                    except OSError as e:
+                        print('读信箱%s失败：%s' % (mailbox.path, e))
+                        arg[1](None, arg[0])
+                else:
+                    waiters.append(arg)
+            for mailbox, lines in written.items():
+                if self._write(mailbox, lines):
+                    synced.add(mailbox)
+            self._commit(synced, acked, force=bool(waiters) or stop)
+            for done in waiters:
+                done.set()
+            if stop:
+                for mailbox in self.mailboxes.values():
+                    if mailbox.file is not None:
+                        mailbox.file.close()
+                return
+
+    def _open(self, mailbox):
+        if mailbox.file is None:
+            mailbox.file = open(mailbox.path, 'ab')
+        return mailbox.file
+
+    def _write(self, mailbox, lines):
+        '''把一个信箱这一批的私信一次写出，成功了才记下它们的序号和偏移'''
+        try:
+            file = self._open(mailbox)
+            file.write(b''.join(line for _, line, _ in lines))
+            file.flush()
+        except OSError as e:
+            print('写信箱%s失败：%s' % (mailbox.path, e))
+            self._truncate(mailbox)
+            for seq, _, on_error in lines:
+                if on_error is not None:
+                    on_error(seq, e)
+            return False
+        for seq, line, _ in lines:
+            mailbox.seqs.append(seq)
+            mailbox.offsets.append(mailbox.size)
+            mailbox.size += len(line)
+        return True
+
+    def _truncate(self, mailbox):
+        # 写了一半的内容去掉，文件退回到最后一条完整的私信；下次追加时重新打开
+        file, mailbox.file = mailbox.file, None
+        try:
+            if file is not None:
+                file.close()
+        except OSError:
+            pass
+        try:
+            if os.path.exists(mailbox.path):
+                os.truncate(mailbox.path, mailbox.size)
+        except OSError:
+            pass
+
+    def _read(self, mailbox, after, callback):
+        index = bisect_right(mailbox.seqs, after)
+        lines = []
+        last = after
+        if index < len(mailbox.offsets):
+            start = mailbox.offsets[index]
+            end = min(mailbox.size, start + self.read_bytes)
+            with open(mailbox.path, 'rb') as f:
+                f.seek(start)
+                data = f.read(end - start)
+            # 只要完整的行；一行比 read_bytes 还长时至少读出这一行
+            cut = data.rfind(b'\n') + 1
+            if cut == 0:
+                with open(mailbox.path, 'rb') as f:
+                    f.seek(start)
+                    data = f.readline()
+                cut = len(data)
+            lines = data[:cut].splitlines()
+            last = mailbox.seqs[index + len(lines) - 1]
+        callback(lines, last)
+
+    def _commit(self, written, acked, force):
+        now = time.monotonic()
+        sync = self.fsync == FSYNC_ALWAYS or (self.fsync == FSYNC_INTERVAL and (
+            force or now - self._last_fsync >= self.fsync_interval))
+        for mailbox in written:
+            if sync and mailbox.file is not None:
+                try:
+                    os.fsync(mailbox.file.fileno())
+                except OSError as e:
+                    print('信箱%s落盘失败：%s' % (mailbox.path, e))
+        for mailbox in acked:
+            try:
+                self._write_ack(mailbox, sync)
+                self._maybe_compact(mailbox)
+            except OSError as e:
+                # 确认序号下次确认时再写，压缩下次再做
+                print('写信箱%s的确认序号失败：%s' % (mailbox.ack_path, e))
+        if sync:
+            self._last_fsync = now
+
+    def _write_ack(self, mailbox, sync):
+        tmp = mailbox.ack_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'user': mailbox.username, 'acked': mailbox.durable_acked}, f, ensure_ascii=False)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, mailbox.ack_path)
+
+    def _maybe_compact(self, mailbox):
+        # 文件开头确认过的部分太大了，就只保留没确认的部分
+        index = bisect_right(mailbox.seqs, mailbox.durable_acked)
+        if index == 0:
+            return
+        start = mailbox.offsets[index] if index < len(mailbox.offsets) else mailbox.size
+        if start < self.compact_bytes or start * 2 < mailbox.size:
+            return
+        if mailbox.file is not None:
+            mailbox.file.close()
+            mailbox.file = None
+        tmp = mailbox.path + '.tmp'
+        with open(mailbox.path, 'rb') as src, open(tmp, 'wb') as dst:
+            src.seek(start)
+            while True:
+                data = src.read(1024 * 1024)
+                if not data:
+                    break
+                dst.write(data)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, mailbox.path)
+        mailbox.offsets = array('Q', (offset - start for offset in mailbox.offsets[index:]))
+        mailbox.seqs = mailbox.seqs[index:]
+        mailbox.size -= start
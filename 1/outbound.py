@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+每个会话自己的发送队列。广播只是把帧放进各个会话的队列，真正的发送由事件循环在
+socket 可写的时候完成，所以一个接收很慢的客户端不会拖住其他人的聊天。
+
+队列有上限，满了之后按 overflow 策略处理：
+    drop_oldest  丢掉最早的还没开始发送的聊天广播
+    disconnect   断开这个客户端
+    coalesce     把积压的聊天广播合并成一条“省略了 N 条消息”的通知
+
+丢弃和合并都只针对 CHAT 帧。ACK、私信、文件通知这些控制帧丢了，客户端会一直等一个不会来的回复，
+所以永远不丢；只剩控制帧也超过上限的两倍时，说明客户端根本不读，按 disconnect 处理。
+'''
+import os
+import time
+from collections import deque
+from itertools import islice
+
+import protocol
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+COALESCE = 'coalesce'
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+
+# 一次 sendmsg 最多带多少块缓冲区
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def is_chat(frame):
+    '''编码好的一帧是不是聊天广播（帧头的第二个字节是类型）'''
+    return frame[1] == protocol.CHAT
+
+
+class QueueOverflow(Exception):
+    '''队列满了并且策略是 disconnect'''
+
+
+class OutboundQueue:
+    def __init__(self, max_frames=1000, max_bytes=4 * 1024 * 1024, overflow=DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('未知的溢出策略：%s' % overflow)
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.frames = deque()
+        self.nbytes = 0  # 队列里还没发出去的字节数
+        self.offset = 0  # 队头那一帧已经发出去的字节数
+        self.dropped = 0  # 因为溢出被丢掉（或者合并掉）的帧数
+
+    def __len__(self):
+        return len(self.frames)
+
+    def depth(self):
+        '''队列深度：(帧数, 字节数)'''
+        return len(self.frames), self.nbytes
+
+    def push(self, payload):
+        '''放入一帧，队列满了按策略处理；策略是 disconnect（或者控制帧也放不下）时抛出 QueueOverflow'''
+        if self._full(len(payload)):
+            if self.overflow == DISCONNECT:
+                raise QueueOverflow('发送队列已满：%d 帧，%d 字节' % self.depth())
+            elif self.overflow == DROP_OLDEST:
+                while self._full(len(payload)) and self._drop_one():
+                    pass
+            else:
+                self._coalesce()
+            if self._full(len(payload)):
+                # 能丢的聊天广播都丢完了，新来的是聊天广播就丢它自己，控制帧照样放进去
+                if is_chat(payload):
+                    self.dropped += 1
+                    return
+                if self._full(len(payload), 2):
+                    raise QueueOverflow('发送队列里的控制帧已满：%d 帧，%d 字节' % self.depth())
+        self.frames.append(payload)
+        self.nbytes += len(payload)
+
+    def write_to(self, sock):
+        '''
+        尽量把队列里的数据写到非阻塞 socket，返回 (写出的字节数, 系统调用次数)。
+        队列里积压的多帧用一次 sendmsg 集中写出（writev），不用每帧调用一次 send；
+        没有 sendmsg 的平台（Windows）先拼成一块再 send。内核缓冲区写满时返回，等下次可写。
+        '''
+        total = 0
+        calls = 0
+        while self.frames:
+            buffers = list(islice(self.frames, 0, IOV_MAX))
+            if self.offset:
+                buffers[0] = memoryview(buffers[0])[self.offset:]
+            size = sum(len(buf) for buf in buffers)
+            try:
+                calls += 1
+                if hasattr(sock, 'sendmsg'):
+                    sent = sock.sendmsg(buffers)
+                else:
+                    sent = sock.send(b''.join(buffers))
+            except (BlockingIOError, InterruptedError):
+                break
+            total += sent
+            self.consume(sent)
+            if sent < size:
+                break  # 只发出去一部分，内核缓冲区满了
+        return total, calls
+
+    def consume(self, sent):
+        '''确认已经发出去 sent 个字节，把发完的帧移出队列'''
+        self.nbytes -= sent
+        while sent:
+            remain = len(self.frames[0]) - self.offset
+            if sent < remain:
+                self.offset += sent
+                return
+            sent -= remain
+            self.frames.popleft()
+            self.offset = 0
+
+    def _full(self, incoming, factor=1):
+        return len(self.frames) >= self.max_frames * factor or self.nbytes + incoming > self.max_bytes * factor
+
+    def _drop_one(self):
+        # 队头如果已经发了一半不能丢，否则对方收到的字节流就乱了；控制帧跳过，只丢最早的聊天广播
+        for index in range(1 if self.offset else 0, len(self.frames)):
+            frame = self.frames[index]
+            if is_chat(frame):
+                del self.frames[index]
+                self.nbytes -= len(frame)
+                self.dropped += 1
+                return True
+        return False
+
+    def _coalesce(self):
+        keep = 1 if self.offset else 0
+        kept = deque(islice(self.frames, 0, keep))
+        skipped = 0
+        for frame in islice(self.frames, keep, None):
+            if is_chat(frame):
+                skipped += 1
+                self.nbytes -= len(frame)
+            else:
+                kept.append(frame)
+        if not skipped:
+            return
+        self.frames = kept
+        self.dropped += skipped
+        notice = protocol.encode_frame(protocol.CHAT, {'source': '服务器通知', 'data': '网络太慢，省略了%d条消息' % skipped,
+                                                       'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())})
+        self.frames.append(notice)
+        self.nbytes += len(notice)
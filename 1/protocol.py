@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+'''
+聊天消息的二进制分帧协议，服务器和客户端共用。
+
+每一帧 = 8 字节帧头 + 消息体：
+
+    版本(1B) | 类型(1B) | 标志(1B) | 保留(1B) | 消息体长度(4B，网络字节序)
+
+消息体是 UTF-8 编码的 JSON。TCP 是字节流，一次 recv 可能收到半帧或者好几帧，
+FrameDecoder 负责把收到的字节重新切成完整的帧，多字节的中文也不会被截断。
+
+压缩：客户端在 JOIN 里带上 {"compress": ["zlib"]}，服务器同意就在 ACK 里回 {"compress": "zlib"}，
+之后双方都可以发压缩过的帧（标志位 FLAG_COMPRESSED）。每帧单独用 zlib 压缩，不共享流式上下文，
+这样一条广播只压缩一次就能发给所有人；双方共用一个预置字典 CHAT_DICT（消息的 JSON 键、时间格式、
+常见的服务器通知），短消息也能压下来。消息体小于阈值的帧不压缩。FrameDecoder 收到压缩帧时自动解压。
+'''
+import json
+import struct
+import zlib
+from collections import namedtuple
+
+VERSION = 1
+
+# 帧类型
+CHAT = 1  # 聊天信息，客户端发 {"data": ..., "room": ...}，服务器广播 {"source": ..., "data": ..., "time": ..., "room": ...}
+JOIN = 2  # 客户端连上之后的第一帧，{"name": 客户端名字, "room": 进入的房间，不写就是大厅, "compress": ["zlib"]}
+LEAVE = 3  # 客户端离开，代替原来的 'A^disconnect^B'
+PING = 4  # 心跳，双方都可以发，收到的一方回 ACK {"ping": true}
+ACK = 5  # 确认，服务器对 JOIN、PING 的回复；请求出错时带 {"error": ...}
+ROOM_JOIN = 6  # 加入房间 {"room": 房间名}
+ROOM_LEAVE = 7  # 离开房间 {"room": 房间名}
+ROOM_LIST = 8  # 客户端发 {} 查询所有房间，发 {"room": 房间名} 查询成员；服务器用同类型的帧回复
+HISTORY = 9  # 请求历史消息 {"room": 房间名, "last": N（最多 1000）} 或 {"room": 房间名, "since": 消息id}；
+             # 服务器用 CHAT 帧回放，最后回一个 ACK {"history_done": 条数}
+# 文件传输，见 files.py
+FILE_OFFER = 10  # 上传文件 {"name": 文件名, "size": 字节数, "room": 房间名, "token": 客户端自己的编号}；
+                 # 服务器回 ACK {"token": ..., "file_id": ..., "window": ...} 或 ACK {"token": ..., "error": ...}
+FILE_DATA = 11  # 文件内容，消息体是 4 字节 file_id + 内容，上传和下载都用它
+FILE_READY = 12  # 服务器通知房间成员有新文件 {"file_id", "name", "size", "source", "room", "time"}
+FILE_GET = 13  # 下载文件 {"file_id": ...}，服务器回 ACK {"file_id", "name", "size"}，然后发 FILE_DATA
+# 私信，见 offline.py
+DM = 14  # 客户端发 {"to": 登录过的用户名, "data": ..., "token": 客户端自己的编号}，服务器回 ACK {"token", "dm": 序号, "to", "online"}；
+         # 服务器投递 {"source", "to", "data", "time", "seq"}，seq 是接收者信箱里的序号
+DM_ACK = 15  # 接收者确认收到了序号不超过 upto 的私信 {"upto": seq}，之后服务器不再投递这些私信
+SEARCH = 16  # 搜索聊天记录 {"q": 关键词, "user", "room", "since", "until", "before", "limit", "token"}，都可以不写；
+             # 服务器用同类型的帧回复 {"token", "results": [消息], "next": 下一页的 before}，见 search.py
+
+TYPE_NAMES = {CHAT: 'chat', JOIN: 'join', LEAVE: 'leave', PING: 'ping', ACK: 'ack',
+              ROOM_JOIN: 'room_join', ROOM_LEAVE: 'room_leave', ROOM_LIST: 'room_list', HISTORY: 'history',
+              FILE_OFFER: 'file_offer', FILE_DATA: 'file_data', FILE_READY: 'file_ready', FILE_GET: 'file_get',
+              DM: 'dm', DM_ACK: 'dm_ack', SEARCH: 'search'}
+
+# 标志位
+FLAG_COMPRESSED = 0x01  # 消息体用 zlib（预置字典 CHAT_DICT）压缩过
+
+COMPRESSION = 'zlib'
+COMPRESS_THRESHOLD = 256  # 消息体小于这么多字节就不压缩，省下的字节抵不上压缩的开销
+
+# zlib 的预置字典：压缩和解压双方都用它打底，越常见的内容放得越靠后
+CHAT_DICT = ('{"ping":true}{"error":"你不在房间里"}{"history_done":'
+             '"source":"服务器通知","data":"欢迎进入房间！进入聊天室！离开房间！离开聊天室！'
+             '哈哈，好的，谢谢，大家好，你好，我们，你们，他们，什么，怎么，没有，可以，知道，现在，今天，明天，'
+             '{"source":"","data":"","time":"2026-","room":"大厅","id":').encode('UTF-8')
+
+HEADER = struct.Struct('!BBBxI')
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 单帧消息体的上限，防止恶意的超大长度把内存撑爆
+MAX_LOGIN_FRAME_SIZE = 16 * 1024  # 登录（JOIN）之前单帧的上限，没登录的连接用不着大帧
+MAX_NAME_LENGTH = 64  # 用户名、房间名最多多少个字符
+
+Frame = namedtuple('Frame', ['type', 'flags', 'payload'])
+
+
+class ProtocolError(Exception):
+    '''收到的字节不符合协议，连接应该断开'''
+
+
+def encode_frame(ftype, body=None, flags=0):
+    '''把一帧编码成 bytes，body 可以是 dict（转成 JSON）或者已经编码好的 bytes'''
+    if body is None:
+        payload = b''
+    elif isinstance(body, (bytes, bytearray, memoryview)):
+        payload = body
+    else:
+        payload = json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('UTF-8')
+    return HEADER.pack(VERSION, ftype, flags, len(payload)) + payload
+
+
+def compress_frame(frame, threshold=COMPRESS_THRESHOLD, level=6):
+    '''
+    把已经编码好的一帧压缩成带 FLAG_COMPRESSED 的帧；消息体小于 threshold、已经压缩过、
+    或者压缩之后没有变小时原样返回。广播时对同一帧只调用一次，结果发给所有支持压缩的客户端。
+    '''
+    version, ftype, flags, length = HEADER.unpack_from(frame)
+    if length < threshold or flags & FLAG_COMPRESSED:
+        return frame
+    compressor = zlib.compressobj(level, zdict=CHAT_DICT)
+    payload = compressor.compress(memoryview(frame)[HEADER.size:]) + compressor.flush()
+    if len(payload) >= length:
+        return frame
+    return HEADER.pack(version, ftype, flags | FLAG_COMPRESSED, len(payload)) + payload
+
+
+def decompress_payload(payload, max_size=MAX_FRAME_SIZE):
+    decompressor = zlib.decompressobj(zdict=CHAT_DICT)
+    try:
+        data = decompressor.decompress(payload, max_size)
+    except zlib.error as e:
+        raise ProtocolError('压缩的消息体解不开：%s' % e)
+    if decompressor.unconsumed_tail:
+        # 防止很小的压缩数据解压出巨大的内容
+        raise ProtocolError('解压之后超过了 %d 字节' % max_size)
+    return data
+
+
+def decode_body(payload):
+    '''把消息体解析成 dict，payload 可以直接是 FrameDecoder 给出的 memoryview'''
+    if not payload:
+        return {}
+    try:
+        body = json.loads(str(payload, 'UTF-8'))
+    except ValueError as e:
+        raise ProtocolError('消息体不是合法的 JSON：%s' % e)
+    if not isinstance(body, dict):
+        # 列表、字符串这些也是合法的 JSON，但是后面都按 dict 取字段
+        raise ProtocolError('消息体不是 JSON 对象')
+    return body
+
+
+def valid_name(value):
+    '''用户名、房间名必须是不超过 MAX_NAME_LENGTH 个字符的非空字符串，JSON 里的列表、数字都不行'''
+    return isinstance(value, str) and 0 < len(value) <= MAX_NAME_LENGTH
+
+
+def is_integer(value):
+    '''JSON 里的整数；true / false 在 Python 里也是 int，要排除掉'''
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class FrameDecoder:
+    '''
+    增量解码器。数据直接 recv_into 到内部缓冲区，解析出来的消息体是缓冲区上的
+    memoryview，不会再复制一遍。用法：
+
+        n = sock.recv_into(decoder.buffer())
+        decoder.advance(n)
+        for frame in decoder.frames():
+            ...
+
+    frames() 给出的 payload 只在下一次调用 buffer()/feed() 之前有效，需要保存的话自己 bytes() 一下。
+    '''
+
+    def __init__(self, capacity=64 * 1024, max_frame=MAX_FRAME_SIZE):
+        self.max_frame = max_frame
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0  # 还没解析的数据从这里开始
+        self._end = 0  # 已经收到的数据到这里结束
+
+    def buffer(self, min_free=4096):
+        '''
+        返回可以写入新数据的缓冲区。帧头里声称的长度再大也不会一次分配那么多：
+        空闲空间最多和已经收到的数据一样多，缓冲区随着数据真正到达成倍扩大，
+        只发一个帧头的连接只占 capacity 大小的内存。
+        '''
+        pending = self._end - self._start
+        need = max(min_free, min(self._frame_size() - pending, pending))
+        if len(self._buf) - self._end < need:
+            self._make_room(need)
+        return self._view[self._end:]
+
+    def advance(self, n):
+        '''告诉解码器 buffer() 里写入了 n 个字节'''
+        self._end += n
+
+    def feed(self, data):
+        '''把已经收到的 bytes 放进解码器，适合不方便用 recv_into 的场合'''
+        n = len(data)
+        self.buffer(n)[:n] = data
+        self._end += n
+
+    def frames(self):
+        '''依次给出缓冲区里所有完整的帧'''
+        while self._end - self._start >= HEADER.size:
+            version, ftype, flags, length = HEADER.unpack_from(self._buf, self._start)
+            if version != VERSION:
+                raise ProtocolError('不支持的协议版本：%d' % version)
+            if length > self.max_frame:
+                raise ProtocolError('帧太大：%d 字节' % length)
+            end = self._start + HEADER.size + length
+            if end > self._end:
+                break  # 半帧，等后面的数据
+            payload = self._view[self._start + HEADER.size:end]
+            self._start = end
+            if flags & FLAG_COMPRESSED:
+                payload = decompress_payload(payload, self.max_frame)
+                flags &= ~FLAG_COMPRESSED
+            yield Frame(ftype, flags, payload)
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def pending(self):
+        '''缓冲区里还没有解析的字节数'''
+        return self._end - self._start
+
+    def _frame_size(self):
+        # 缓冲区开头那一帧的完整长度，帧头还没收全时返回 0
+        if self._end - self._start < HEADER.size:
+            return 0
+        length = HEADER.unpack_from(self._buf, self._start)[3]
+        return HEADER.size + min(length, self.max_frame)
+
+    def _make_room(self, need):
+        pending = self._end - self._start
+        if pending + need <= len(self._buf):
+            # 把没解析完的数据挪到开头，memoryview 之间的复制不会产生临时对象
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            # 放不下，换一块更大的缓冲区；旧的 memoryview 仍然指向旧缓冲区，不受影响
+            buf = bytearray(max(pending + need, len(self._buf) * 2))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
+
+
+def recv_frames(sock, decoder):
+    '''阻塞 socket 用的读取函数：读一次，返回读到的完整帧（消息体已经复制成 bytes），对方关闭时返回 None'''
+    n = sock.recv_into(decoder.buffer())
+    if n == 0:
+        return None
+    decoder.advance(n)
+    return [Frame(frame.type, frame.flags, bytes(frame.payload)) for frame in decoder.frames()]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+聊天消息的限流（令牌桶）。
+
+每条消息都会广播给房间里的所有人，一个客户端刷屏，服务器的负载就放大成房间人数倍。
+RateLimiter 给每个会话一个消息数的桶和一个字节数的桶，另外所有会话共用一组全局的桶。
+令牌按 rate 每秒匀速补充，最多攒 burst 个；一帧要同时从这几个桶里拿到令牌才放行。
+
+拿不到令牌时的处理策略：
+    reject  丢掉这一帧，给发送者回一个 ACK {"error": ...}（连续被拒只提醒一次）
+    delay   这一帧先扣着，暂停读这个会话的 socket，等令牌够了再继续；
+            发得太快的客户端会被 TCP 的流量控制自然地压住
+
+文件内容的分块（FILE_DATA）只算字节数，不算消息条数；丢掉一块文件就坏了，所以它们总是推迟，不会被拒绝。
+'''
+import time
+
+REJECT = 'reject'
+DELAY = 'delay'
+THROTTLE_POLICIES = (REJECT, DELAY)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic() if now is None else now
+
+    def wait_time(self, n, now):
+        '''还要等多少秒才有 n 个令牌，0 表示现在就够'''
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+        # 比 burst 还大的请求永远等不到，只要求桶是满的，拿走之后令牌变成负数（欠着）
+        need = min(n, self.burst)
+        if self.tokens >= need:
+            return 0.0
+        return (need - self.tokens) / self.rate
+
+    def take(self, n):
+        self.tokens -= n
+
+
+class SessionLimits:
+    '''一个会话自己的桶和被限流的次数'''
+
+    def __init__(self, buckets):
+        self.messages, self.bytes = buckets
+        self.throttled = 0  # 被拒绝或者被推迟的帧数
+        self.warned = False  # reject 策略下是否已经提醒过
+
+
+class RateLimiter:
+    '''rate 为 None 的桶不限制'''
+
+    def __init__(self, message_rate=None, message_burst=None, byte_rate=None, byte_burst=None,
+                 global_message_rate=None, global_message_burst=None, global_byte_rate=None,
+                 global_byte_burst=None, policy=REJECT):
+        if policy not in THROTTLE_POLICIES:
+            raise ValueError('未知的限流策略：%s' % policy)
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.policy = policy
+        self.global_messages = TokenBucket(global_message_rate, global_message_burst) if global_message_rate else None
+        self.global_bytes = TokenBucket(global_byte_rate, global_byte_burst) if global_byte_rate else None
+
+    def session(self):
+        now = time.monotonic()
+        return SessionLimits((
+            TokenBucket(self.message_rate, self.message_burst, now) if self.message_rate else None,
+            TokenBucket(self.byte_rate, self.byte_burst, now) if self.byte_rate else None))
+
+    def check(self, limits, nbytes, now=None, messages=1):
+        '''
+        一帧 nbytes 字节能不能放行：能就从所有桶里扣掉令牌并返回 0；
+        不能就什么都不扣，返回需要等待的秒数。文件内容的分块不算消息条数，传 messages=0。
+        '''
+        now = time.monotonic() if now is None else now
+        wait = 0.0
+        for bucket, n in ((limits.messages, messages), (limits.bytes, nbytes),
+                          (self.global_messages, messages), (self.global_bytes, nbytes)):
+            if bucket is not None and n:
+                wait = max(wait, bucket.wait_time(n, now))
+        if wait:
+            limits.throttled += 1
+            return wait
+        for bucket, n in ((limits.messages, messages), (limits.bytes, nbytes),
+                          (self.global_messages, messages), (self.global_bytes, nbytes)):
+            if bucket is not None:
+                bucket.take(n)
+        return 0.0
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''
+聊天室房间的成员索引。
+
+同时维护两张表：房间 -> 成员集合、成员 -> 所在房间集合。
+广播时只需要取出一个房间的成员，代价和房间人数成正比，和服务器上的总人数无关；
+成员断开时也能直接找到他在哪些房间，不用扫描所有房间。
+'''
+
+# 默认房间，登录时没有指定房间就进入大厅，原来的客户端都在这里聊天
+LOBBY = '大厅'
+
+
+class RoomIndex:
+    def __init__(self):
+        self.members_of = {}  # 房间名 -> set(会话)
+        self.rooms_of = {}  # 会话 -> set(房间名)
+
+    def join(self, member, room):
+        '''加入房间，原来不在房间里返回 True'''
+        members = self.members_of.setdefault(room, set())
+        if member in members:
+            return False
+        members.add(member)
+        self.rooms_of.setdefault(member, set()).add(room)
+        return True
+
+    def leave(self, member, room):
+        '''离开房间，原来在房间里返回 True；房间空了就删掉'''
+        members = self.members_of.get(room)
+        if not members or member not in members:
+            return False
+        members.discard(member)
+        if not members:
+            del self.members_of[room]
+        rooms = self.rooms_of[member]
+        rooms.discard(room)
+        if not rooms:
+            del self.rooms_of[member]
+        return True
+
+    def leave_all(self, member):
+        '''离开所有房间，返回原来所在的房间列表'''
+        rooms = self.rooms_of.pop(member, set())
+        for room in rooms:
+            members = self.members_of[room]
+            members.discard(member)
+            if not members:
+                del self.members_of[room]
+        return sorted(rooms)
+
+    def members(self, room):
+        '''房间的成员集合，房间不存在时返回空集合（不要修改返回值）'''
+        return self.members_of.get(room, ())
+
+    def rooms(self, member):
+        return self.rooms_of.get(member, ())
+
+    def is_member(self, member, room):
+        return member in self.members_of.get(room, ())
+
+    def list_rooms(self):
+        '''所有房间和人数：{房间名: 人数}'''
+        return {room: len(members) for room, members in self.members_of.items()}
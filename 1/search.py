@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+'''
+聊天记录的全文搜索（SQLite FTS5）。
+
+每条广播除了写进聊天记录日志（transcript.py），还会交给 SearchIndex 建索引：
+
+    messages      id（和聊天记录的消息 id 一样）、发送者、房间、时间、内容，按发送者和时间建了普通索引
+    messages_fts  FTS5 全文索引，rowid 就是消息 id，只存分词之后的内容（contentless），原文在 messages 里
+
+unicode61 分词器把连在一起的汉字当成一个词，搜“吃饭”找不到“一起去吃饭”，所以建索引和搜索时都先把
+每个汉字（以及日文、韩文字符）用空格隔开，一个字一个词；搜索时一个关键词变成一个短语查询，
+“吃饭”就是 "吃 饭"，相邻的两个字都在才算匹配，等于子串搜索，而且用得上倒排索引。
+
+写入和查询都不在事件循环里做：
+    写线程  add 只把消息放进队列，后台线程每次把积压的消息放在一个事务里批量插入
+    读线程  search 把请求放进另一个队列，读线程用自己的连接查询（WAL 模式下读写互不阻塞），
+            查完调用 callback(结果)，需要切换线程的话由 callback 自己处理
+
+结果按消息 id 从新到旧排列，分页用上一页最后一条的 id（before），不用 OFFSET，翻到多深都一样快。
+只按时间条件搜索时沿着时间索引按 (time, id) 从新到旧排列，这时 next 是上一页最后一条的 [time, id]，
+原样作为 before 传回来就行。
+'''
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+from transcript import list_segments
+
+MAX_LIMIT = 100  # 一页最多多少条
+
+_CJK = re.compile('([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff])')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    room TEXT NOT NULL,
+    time TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_source ON messages (source, id);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (body, content='', tokenize='unicode61');
+'''
+
+
+class SearchError(Exception):
+    '''搜索条件不对，消息作为错误回给客户端'''
+
+
+def tokenize(text):
+    '''把汉字一个一个用空格隔开，其余的交给 FTS5 的 unicode61 分词器'''
+    return _CJK.sub(r' \1 ', text)
+
+
+def match_query(keywords):
+    '''把用户输入的关键词变成 FTS5 的 MATCH 表达式：每个关键词是一个短语，都要出现'''
+    phrases = []
+    for keyword in keywords.split():
+        tokens = tokenize(keyword.replace('"', ' ')).split()
+        if tokens:
+            phrases.append('"%s"' % ' '.join(tokens))
+    return ' AND '.join(phrases)
+
+
+class SearchIndex:
+    def __init__(self, path='records/search.db', batch_size=2048):
+        self.path = path
+        self.batch_size = batch_size
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._connect()
+        db.executescript(SCHEMA)
+        db.close()
+        self._write_queue = queue.Queue()
+        self._read_queue = queue.Queue()
+        self._writer = threading.Thread(target=self._run_writer, name='search-writer')
+        self._writer.daemon = True
+        self._writer.start()
+        self._reader = threading.Thread(target=self._run_reader, name='search-reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')  # 聊天记录日志才是原始数据，索引丢了最后几条可以从日志补
+        return db
+
+    # ---------------- 事件循环线程调用 ----------------
+
+    def add(self, record):
+        '''给一条广播（带 id 的 dict）建索引，不等待'''
+        self._write_queue.put(record)
+
+    def catch_up(self, directory):
+        '''在写线程里把聊天记录日志里还没建索引的消息补上（第一次启用搜索、或者上次没来得及写的）'''
+        self._write_queue.put(('catch_up', directory))
+
+    def search(self, callback, q=None, user=None, rooms=None, since=None, until=None, before=None, limit=20):
+        '''
+        在读线程里查询，查完在读线程里调用 callback({"results": [...], "next": 下一页的 before 或 None})，
+        条件不对时调用 callback({"error": ...})。
+        q 是空格隔开的关键词，user 是发送者，rooms 是房间名的列表，since / until 是
+        "%Y-%m-%d %H:%M:%S" 格式的时间（含 since，不含 until），before 是上一页返回的 next。
+        '''
+        self._read_queue.put((callback, q, user, rooms, since, until, before, limit))
+
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self._write_queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self._write_queue.put(None)
+        self._read_queue.put(None)
+        self._writer.join()
+        self._reader.join()
+
+    # ---------------- 后台写线程 ----------------
+
+    def _run_writer(self):
+        db = self._connect()
+        while True:
+            batch = [self._write_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = []
+            waiters = []
+            stop = False
+            for item in batch:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                elif isinstance(item, tuple):
+                    self._insert(db, records)
+                    records = []
+                    self._catch_up(db, item[1])
+                else:
+                    records.append(item)
+            self._insert(db, records)
+            for done in waiters:
+                done.set()
+            if stop:
+                db.close()
+                return
+
+    def _insert(self, db, records):
+        if not records:
+            return
+        rows = [(record.get('id'), record['source'], record.get('room') or '', record['time'], record['data'])
+                for record in records]
+        with db:  # 一批一个事务
+            cursor = db.cursor()
+            for row in rows:
+                # 没有聊天记录日志时消息没有 id，由 SQLite 分配
+                cursor.execute('INSERT OR IGNORE INTO messages (id, source, room, time, data) VALUES (?, ?, ?, ?, ?)',
+                               row)
+                if cursor.rowcount:
+                    cursor.execute('INSERT INTO messages_fts (rowid, body) VALUES (?, ?)',
+                                   (cursor.lastrowid, tokenize(row[4])))
+
+    def _catch_up(self, db, directory):
+        last = db.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+        segments = list_segments(directory)
+        records = []
+        for i, (first_id, path) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= last + 1:
+                continue  # 这一段的消息都已经有索引了
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    record = json.loads(line.decode('UTF-8'))
+                    if record['id'] > last:
+                        records.append(record)
+                        if len(records) >= self.batch_size:
+                            self._insert(db, records)
+                            records = []
+        self._insert(db, records)
+
+    # ---------------- 后台读线程 ----------------
+
+    def _run_reader(self):
+        db = self._connect()
+        while True:
+            request = self._read_queue.get()
+            if request is None:
+                db.close()
+                return
+            callback, args = request[0], request[1:]
+            try:
+                result = self._query(db, *args)
+            except SearchError as e:
+                result = {'error': str(e)}
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                # 客户端传来的条件类型不对也只是这一次搜索失败，读线程不能退出
+                result = {'error': '搜索条件不对：%s' % e}
+            callback(result)
+
+    def _query(self, db, q, user, rooms, since, until, before, limit):
+        start = time.perf_counter()
+        limit = max(1, min(int(limit or 20), MAX_LIMIT))
+        where = []
+        params = []
+        if user:
+            where.append('m.source = ?')
+            params.append(user)
+        if rooms is not None:
+            if not rooms:
+                return {'results': [], 'next': None, 'took_ms': 0.0}
+            where.append('m.room IN (%s)' % ','.join('?' * len(rooms)))
+            params.extend(rooms)
+        if since:
+            where.append('m.time >= ?')
+            params.append(since)
+        if until:
+            where.append('m.time < ?')
+            params.append(until)
+        match = match_query(str(q or ''))
+        # 只有时间条件时沿着时间索引倒着走，不用把这段时间的消息都取出来再排序
+        by_time = bool(since or until) and not user and not match
+        if before is not None:
+            if by_time != isinstance(before, list):
+                raise SearchError('before 要用上一页返回的 next')
+            if by_time:
+                # 时间相同的消息再按 id 排，m.time <= ? 让查询用得上时间索引
+                before_time, before_id = before
+                where.append('m.time <= ? AND (m.time < ? OR m.id < ?)')
+                params.extend([str(before_time), str(before_time), int(before_id)])
+            else:
+                where.append('m.id < ?')
+                params.append(int(before))
+        columns = 'SELECT m.id, m.source, m.room, m.time, m.data'
+        if match and user:
+            # 沿着发送者的索引从新到旧走，每条按 rowid 到全文索引里核对；一个人的消息再多，
+            # 也比一个常见词匹配到的所有消息少得多
+            sql = (columns + ' FROM messages m INDEXED BY messages_source WHERE EXISTS '
+                   '(SELECT 1 FROM messages_fts WHERE messages_fts MATCH ? AND rowid = m.id)')
+            order = 'm.id DESC'
+        elif match:
+            sql = columns + ' FROM messages_fts f JOIN messages m ON m.id = f.rowid WHERE messages_fts MATCH ?'
+            order = 'f.rowid DESC'
+        elif where:
+            sql = columns + ' FROM messages m WHERE 1'
+            order = 'm.time DESC, m.id DESC' if by_time else 'm.id DESC'
+        else:
+            raise SearchError('至少要给出关键词、发送者、房间或者时间中的一个')
+        if match:
+            params.insert(0, match)
+        if where:
+            sql += ' AND ' + ' AND '.join(where)
+        sql += ' ORDER BY %s LIMIT ?' % order
+        params.append(limit)
+        results = [{'id': row[0], 'source': row[1], 'room': row[2], 'time': row[3], 'data': row[4]}
+                   for row in db.execute(sql, params)]
+        next_before = None
+        if len(results) == limit:
+            last = results[-1]
+            next_before = [last['time'], last['id']] if by_time else last['id']
+        return {'results': results, 'next': next_before,
+                'took_ms': (time.perf_counter() - start) * 1000}
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+'''
+总线 BusHub 的测试：python -m unittest test_cluster
+'''
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+import protocol
+from cluster import BusHub
+
+
+class BusHubTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'bus.sock')
+        self.hub = BusHub(self.path)
+        self.thread = threading.Thread(target=self.hub.serve_forever)
+        self.thread.start()
+        self.workers = [self.connect() for _ in range(3)]
+        # 等总线把三条连接都接受了
+        for _ in range(100):
+            if len(self.hub.peers) == 3:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(len(self.hub.peers), 3)
+
+    def tearDown(self):
+        for sock in self.workers:
+            sock.close()
+        self.hub.isOn = False
+        self.thread.join(5)
+        os.rmdir(os.path.dirname(self.path))
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.settimeout(2)
+        return sock
+
+    def receive(self, sock):
+        decoder = protocol.FrameDecoder()
+        while True:
+            frames = protocol.recv_frames(sock, decoder)
+            if frames is None or frames:
+                return frames
+
+    def test_bad_frame_drops_only_sender(self):
+        bad, a, b = self.workers
+        # 版本号不对的帧头
+        bad.sendall(protocol.HEADER.pack(99, protocol.CHAT, 0, 0))
+        self.assertEqual(bad.recv(1), b'')  # 发坏帧的进程被断开
+        frame = protocol.encode_frame(protocol.CHAT, {'source': 'a', 'data': '还在', 'time': 't', 'room': '大厅'})
+        a.sendall(frame)
+        received = self.receive(b)
+        self.assertEqual([(f.type, protocol.decode_body(f.payload)['data']) for f in received],
+                         [(protocol.CHAT, '还在')])
+        self.assertTrue(self.thread.is_alive())
+        self.assertEqual(len(self.hub.peers), 2)
+
+    def test_frames_before_bad_frame_are_relayed(self):
+        bad, a, b = self.workers
+        good = protocol.encode_frame(protocol.CHAT, {'source': 'x', 'data': '先到', 'time': 't', 'room': '大厅'})
+        bad.sendall(good + protocol.HEADER.pack(protocol.VERSION, protocol.CHAT, 0, protocol.MAX_FRAME_SIZE + 1))
+        for sock in (a, b):
+            self.assertEqual(protocol.decode_body(self.receive(sock)[0].payload)['data'], '先到')
+        self.assertEqual(bad.recv(1), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''
+聊天记录的追加日志。
+
+每条聊天信息都自动写进 records 目录下的日志段文件，一行一条 JSON：
+
+    {"id": 1, "source": "张三", "data": "你好", "time": "2020-05-20 13:14:00", "room": "大厅"}
+
+文件名是这一段第一条消息的 id（%020d.log），段文件超过 segment_bytes 字节或者打开超过
+segment_seconds 秒就换一个新段。写文件由后台线程完成：事件循环只把记录放进队列，后台线程
+每次把队列里积压的记录一起写出、一起 flush（group commit）。fsync 策略：
+
+    always    每批写完都 fsync，断电也不丢
+    interval  距离上次 fsync 超过 fsync_interval 秒才 fsync
+    never     只 flush 到操作系统，由系统决定什么时候落盘
+'''
+import json
+import os
+import queue
+import threading
+import time
+
+from history import HistoryIndex
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+SEGMENT_SUFFIX = '.log'
+
+
+def segment_name(first_id):
+    return '%020d%s' % (first_id, SEGMENT_SUFFIX)
+
+
+def list_segments(directory):
+    '''目录里所有段文件，按第一条消息的 id 排序：[(first_id, 路径), ...]'''
+    segments = []
+    for name in os.listdir(directory):
+        if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+            segments.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+class TranscriptLog:
+    def __init__(self, directory='records', segment_bytes=64 * 1024 * 1024, segment_seconds=24 * 3600,
+                 fsync=FSYNC_INTERVAL, fsync_interval=1.0, batch_size=1024):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('未知的 fsync 策略：%s' % fsync)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        os.makedirs(directory, exist_ok=True)
+        self.last_id = self._recover()  # 已经分配出去的最大 id
+        # 偏移索引，给新加入的客户端回放历史用（见 history.py）
+        self.index = HistoryIndex()
+        self.index.load(list_segments(directory))
+        self._indexed = []  # 这一批写出、还没有提交给索引的记录
+        self._id_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._file = None
+        self._file_opened = 0
+        self._last_fsync = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='transcript-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, record):
+        '''追加一条记录（dict），分配并返回消息 id；只是放进队列，不会阻塞调用者'''
+        with self._id_lock:
+            self.last_id += 1
+            record['id'] = self.last_id
+        self._queue.put(record)
+        return record['id']
+
+    def flush(self, timeout=None):
+        '''等到目前为止追加的记录都写进文件（并按策略 fsync）'''
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.index.close()
+
+    # ---------------- 后台写线程 ----------------
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # 把队列里已经积压的记录一起取出来，一次写完
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            waiters = []
+            stop = False
+            for item in batch:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    self._write(item)
+            if self._file is not None:
+                self._commit(force=bool(waiters) or stop)
+            for done in waiters:
+                done.set()
+            if stop:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+    def _write(self, record):
+        if self._file is None or self._should_rotate():
+            self._open_segment(record['id'])
+        line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('UTF-8')
+        start = self._file.tell()
+        self._file.write(line)
+        first_id, path = self._segment
+        self._indexed.append((first_id, path, record['id'], record.get('room'), start, start + len(line)))
+
+    def _commit(self, force=False):
+        self._file.flush()
+        # flush 之后这些行才能被别的线程通过 mmap 读到，这时再交给索引
+        if self._indexed:
+            self.index.add_batch(self._indexed)
+            self._indexed = []
+        now = time.monotonic()
+        if self.fsync == FSYNC_ALWAYS or (self.fsync == FSYNC_INTERVAL and (
+                force or now - self._last_fsync >= self.fsync_interval)):
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def _should_rotate(self):
+        return (self._file.tell() >= self.segment_bytes
+                or time.monotonic() - self._file_opened >= self.segment_seconds)
+
+    def _open_segment(self, first_id):
+        if self._file is not None:
+            self._commit(force=True)
+            self._file.close()
+        path = os.path.join(self.directory, segment_name(first_id))
+        self._file = open(path, 'ab')
+        self._file_opened = time.monotonic()
+        self._segment = (first_id, path)
+
+    def _recover(self):
+        # 启动时从最后一个段文件的最后一行找出已经用过的最大 id；最后一行没写完（进程崩溃）就截掉
+        segments = list_segments(self.directory)
+        if not segments:
+            return 0
+        first_id, path = segments[-1]
+        with open(path, 'rb+') as f:
+            # 只读文件末尾一段，不把整个段读进内存
+            size = f.seek(0, os.SEEK_END)
+            tail_start = max(0, size - 64 * 1024)
+            f.seek(tail_start)
+            tail = f.read()
+            end = tail.rfind(b'\n') + 1
+            if end < len(tail):
+                f.truncate(tail_start + end)
+        lines = tail[:end].splitlines()
+        if not lines:
+            return first_id - 1
+        return json.loads(lines[-1].decode('UTF-8'))['id']
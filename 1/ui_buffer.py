@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+'''
+聊天窗口的消息显示缓冲，客户端和服务器界面共用。
+
+原来每收到一条消息就 wx.CallAfter 一次 AppendText，消息一多界面线程排满了回调，窗口卡住，
+文本框里的内容也越攒越多。现在：
+
+    后台线程只调用 post() 把消息放进队列，不碰控件
+    界面线程最多每 1/fps 秒刷新一次，把这段时间攒下的消息拼成一个字符串一次 AppendText
+    文本框里只保留最近 visible 条，更早的消息放在固定容量的环形缓冲区 RingBuffer 里（最多 keep 条）
+    Ctrl+PageUp / Ctrl+PageDown 向前、向后翻页，Ctrl+End 回到最新消息；翻页期间新消息照样进缓冲区，
+    但不打乱正在看的那一页
+'''
+import time
+from collections import deque
+
+import wx
+
+
+class RingBuffer:
+    '''固定容量的环形缓冲区，满了以后新元素覆盖最旧的'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._head = 0  # 最旧元素的位置
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, item):
+        if self._count < self.capacity:
+            self._items[(self._head + self._count) % self.capacity] = item
+            self._count += 1
+        else:
+            self._items[self._head] = item
+            self._head = (self._head + 1) % self.capacity
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def slice(self, start, end):
+        '''第 start 到 end 个元素（0 是最旧的）'''
+        start = max(0, start)
+        end = min(self._count, end)
+        return [self._items[(self._head + i) % self.capacity] for i in range(start, end)]
+
+
+class MessageView:
+    def __init__(self, text, visible=200, keep=5000, fps=20):
+        self.text = text  # 只读的多行 wx.TextCtrl
+        self.visible = visible
+        self.lines = RingBuffer(keep)  # 只在界面线程里访问
+        self.interval = 1.0 / fps
+        self.offset = 0  # 当前这一页的最后一条离最新消息有多远，0 表示跟着最新消息走
+        self._incoming = deque()  # 后台线程 append，界面线程 popleft，deque 的这两个操作是线程安全的
+        self._scheduled = False
+        self._last_flush = 0.0
+        self._shown = deque()  # 文本框里每条消息占了多少个位置，用来从开头删除
+        self.text.Bind(wx.EVT_KEY_DOWN, self._on_key)
+
+    def post(self, info):
+        '''任意线程都可以调用'''
+        self._incoming.append(info)
+        if not self._scheduled:
+            self._scheduled = True
+            wx.CallAfter(self._schedule)
+
+    def _schedule(self):
+        # 距离上次刷新不够一帧就等到下一帧，这样不管消息来得多快，每秒最多刷新 fps 次
+        wait = self.interval - (time.monotonic() - self._last_flush)
+        if wait > 0:
+            wx.CallLater(int(wait * 1000) + 1, self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        self._scheduled = False  # 先清标记，刷新过程中新来的消息会再安排一次
+        self._last_flush = time.monotonic()
+        batch = []
+        while self._incoming:
+            batch.append(self._incoming.popleft())
+        if not batch:
+            return
+        self.lines.extend(batch)
+        if self.offset:
+            # 正在看前面的页，不动文本框，只让这一页保持在原来的位置
+            self.offset = min(self.offset + len(batch), max(0, len(self.lines) - self.visible))
+            return
+        if len(batch) >= self.visible:
+            self._render()
+            return
+        start = self.text.GetLastPosition()
+        self.text.AppendText(''.join(batch))
+        self._shown.extend(self._widths(batch, self.text.GetLastPosition() - start))
+        remove = 0
+        while len(self._shown) > self.visible:
+            remove += self._shown.popleft()
+        if remove:
+            self.text.Remove(0, remove)
+
+    def page_up(self):
+        self.flush()
+        self.offset = min(self.offset + self.visible, max(0, len(self.lines) - self.visible))
+        self._render()
+
+    def page_down(self):
+        self.flush()
+        self.offset = max(0, self.offset - self.visible)
+        self._render()
+
+    def follow(self):
+        self.flush()
+        self.offset = 0
+        self._render()
+
+    def _render(self):
+        end = len(self.lines) - self.offset
+        page = self.lines.slice(end - self.visible, end)
+        self.text.Freeze()
+        try:
+            self.text.SetValue(''.join(page))
+            self._shown = deque(self._widths(page, self.text.GetLastPosition()))
+            # 翻页时停在这一页的开头，跟着最新消息时停在末尾
+            self.text.ShowPosition(0 if self.offset else self.text.GetLastPosition())
+        finally:
+            self.text.Thaw()
+
+    def _widths(self, texts, written):
+        '''
+        每条消息在文本框里占多少个位置。文本框的位置和 Python 的字符串长度不一样：MSW 把换行存成回车加换行，
+        一个换行占两个位置。写进去的这一段实际占了 written 个位置，由此算出每个换行占几个位置；
+        剩下的差额（比如 UTF-16 里占两个位置的表情）算在最后一条上，整段删除时总是准确的。
+        '''
+        if not texts:
+            return []
+        newlines = sum(info.count('\n') for info in texts)
+        extra = min(1, max(0, (written - sum(len(info) for info in texts)) // newlines)) if newlines else 0
+        widths = [len(info) + extra * info.count('\n') for info in texts]
+        widths[-1] += written - sum(widths)
+        return widths
+
+    def _on_key(self, event):
+        if event.ControlDown():
+            key = event.GetKeyCode()
+            if key == wx.WXK_PAGEUP:
+                self.page_up()
+                return
+            if key == wx.WXK_PAGEDOWN:
+                self.page_down()
+                return
+            if key == wx.WXK_END:
+                self.follow()
+                return
+        event.Skip()
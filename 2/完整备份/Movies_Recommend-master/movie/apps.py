@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class MovieConfig(AppConfig):
     name = 'movie'
+
+    def ready(self):
+        # 注册电影保存、删除时更新搜索索引的信号
+        from . import search  # noqa: F401
@@ -0,0 +1,76 @@
+'''
+比较原来逐个用户查数据库的 UserCF 和 recommender.UserCF 的用时、SQL 条数和推荐结果：
+
+    python manage.py bench_recommend --users 20
+'''
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Max
+from django.test.utils import CaptureQueriesContext
+
+from movie.models import Movie, Movie_rating, User
+from movie.recommender import UserCF
+
+
+def legacy_recommend(cur_user, K=20, N=10):
+    '''原来 RecommendMovieView.get_user_sim 和 get_recommend_movie 的做法，每个用户一条 SQL'''
+    user_sim_dct = dict()
+    other_users = User.objects.exclude(pk=cur_user.pk)
+    cur_user_movie_qs = Movie.objects.filter(user=cur_user)
+    for user in other_users:
+        user_sim_dct[user.id] = len(Movie.objects.filter(user=user) & cur_user_movie_qs)
+    user_lst = sorted(user_sim_dct.items(), key=lambda x: -x[1])[:K]
+    movie_val_dct = dict()
+    for user, _ in user_lst:
+        movie_set = Movie.objects.filter(user=user).exclude(id__in=cur_user_movie_qs).annotate(
+            score=Max('movie_rating__score'))
+        for movie in movie_set:
+            movie_val_dct.setdefault(movie, 0)
+            movie_val_dct[movie] += movie.score
+    return [(movie.id, value) for movie, value in sorted(movie_val_dct.items(), key=lambda x: -x[1])[:N]]
+
+
+class Command(BaseCommand):
+    help = '比较原来的 UserCF 和内存稀疏矩阵版本的推荐用时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='随机挑多少个用户做推荐')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        user_ids = list(Movie_rating.objects.values_list('user_id', flat=True).distinct())
+        random.Random(options['seed']).shuffle(user_ids)
+        user_ids = user_ids[:options['users']]
+
+        start = time.perf_counter()
+        engine = UserCF().load()
+        load_time = time.perf_counter() - start
+        self.stdout.write('加载评分矩阵 %.0fms（%d个用户 × %d部电影，%d条评分）' % (
+            load_time * 1000, engine.ratings.shape[0], engine.ratings.shape[1], engine.ratings.nnz))
+
+        legacy_time = fast_time = 0.0
+        legacy_queries = fast_queries = 0
+        same = 0
+        for user_id in user_ids:
+            user = User.objects.get(pk=user_id)
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                old = legacy_recommend(user)
+                legacy_time += time.perf_counter() - start
+            legacy_queries += len(ctx.captured_queries)
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                rated = Movie_rating.objects.filter(user_id=user_id).values_list('movie_id', flat=True)
+                new = engine.recommend(user_id, rated)
+                fast_time += time.perf_counter() - start
+            fast_queries += len(ctx.captured_queries)
+            # 兴趣值相同的电影排列顺序可能不一样，比较兴趣值序列
+            if [round(value, 3) for _, value in old] == [round(value, 3) for _, value in new]:
+                same += 1
+        n = len(user_ids)
+        self.stdout.write('原来的视图  平均 %8.1fms  %6.1f条SQL' % (legacy_time / n * 1000, legacy_queries / n))
+        self.stdout.write('稀疏矩阵    平均 %8.1fms  %6.1f条SQL' % (fast_time / n * 1000, fast_queries / n))
+        self.stdout.write('结果一致 %d/%d，加速 %.0f 倍' % (same, n, legacy_time / max(fast_time, 1e-9)))
@@ -0,0 +1,66 @@
+'''
+比较原来的 name__icontains 搜索和全文索引搜索（movie/search.py）的用时：
+
+    python manage.py bench_search --queries 200
+
+从电影名、导演、演员里随机挑词当关键词（一个词、两个词、只输入前几个字母的都有），
+每种搜索各查 --queries 次，统计每次的用时（p50 / p99 / max，毫秒）和平均搜到多少部电影。
+icontains 只搜电影名，全文索引搜五个字段，所以搜到的数量不一样。
+'''
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from movie import search
+from movie.models import Movie
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_queries(rng, count):
+    words = []
+    for row in Movie.objects.values_list('name', 'director', 'actors'):
+        for text in row:
+            words.extend(word for word in search.split_keyword(text) if len(word) >= 3 and not word.isdigit())
+    queries = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.5:
+            queries.append(rng.choice(words))
+        elif kind < 0.8:
+            queries.append('%s %s' % (rng.choice(words), rng.choice(words)))
+        else:
+            word = rng.choice(words)
+            queries.append(word[:max(3, len(word) // 2)])  # 只输入了前面一部分
+    return queries
+
+
+class Command(BaseCommand):
+    help = '比较 name__icontains 和全文索引搜索的用时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=200, help='每种搜索查多少次')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        queries = make_queries(random.Random(options['seed']), options['queries'])
+        backend = search.get_backend()
+        cases = [
+            ('name__icontains', lambda q: list(Movie.objects.filter(name__icontains=q).values_list('id', flat=True))),
+            (type(backend).__name__, backend.search),
+        ]
+        self.stdout.write('%d部电影，%d个关键词' % (Movie.objects.count(), len(queries)))
+        for name, run in cases:
+            run(queries[0])  # 预热
+            latencies = []
+            found = 0
+            for q in queries:
+                start = time.perf_counter()
+                found += len(run(q))
+                latencies.append((time.perf_counter() - start) * 1000)
+            self.stdout.write('%-16s p50 %6.2fms  p99 %6.2fms  max %6.2fms  平均搜到 %.1f 部' % (
+                name, percentile(latencies, 50), percentile(latencies, 99), max(latencies), found / len(queries)))
@@ -0,0 +1,67 @@
+'''
+给所有用户预先算好推荐结果，写进 Movie_recommend 表：
+
+    python manage.py build_recommendations --workers 4
+
+评分矩阵只在主进程里读一次，交给进程池里的每个进程；用户分成若干块并行计算，
+结果在一个事务里先删掉旧的再 bulk_create，推荐页面看到的要么全是旧的，要么全是新的。
+'''
+import os
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from movie.models import Movie_recommend, User
+from movie.recommender import UserCF
+
+_engine = None
+
+
+def _init_worker(engine):
+    global _engine
+    _engine = engine
+
+
+def _recommend_chunk(args):
+    user_ids, K, N = args
+    return _engine.recommend_users(user_ids, K, N)
+
+
+class Command(BaseCommand):
+    help = '用进程池给所有用户计算推荐结果，写进 Movie_recommend 表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='进程数，1 表示不用进程池')
+        parser.add_argument('--chunk', type=int, default=50, help='每个任务包含多少个用户')
+        parser.add_argument('-K', type=int, default=20, help='最相似的K个用户')
+        parser.add_argument('-N', type=int, default=10, help='每个用户推荐几部电影')
+        parser.add_argument('--batch-size', type=int, default=2000, help='bulk_create 每批的行数')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        engine = UserCF().load()
+        user_ids = list(User.objects.values_list('id', flat=True))
+        K, N, size = options['K'], options['N'], options['chunk']
+        chunks = [(user_ids[i:i + size], K, N) for i in range(0, len(user_ids), size)]
+        loaded = time.perf_counter()
+
+        if options['workers'] > 1:
+            with Pool(options['workers'], initializer=_init_worker, initargs=(engine,)) as pool:
+                results = [item for chunk in pool.imap_unordered(_recommend_chunk, chunks) for item in chunk]
+        else:
+            _init_worker(engine)
+            results = [item for chunk in chunks for item in _recommend_chunk(chunk)]
+        computed = time.perf_counter()
+
+        now = timezone.now()
+        rows = [Movie_recommend(user_id=user_id, movie_id=movie_id, rank=rank, interest=interest, created=now)
+                for user_id, movie_lst in results for rank, (movie_id, interest) in enumerate(movie_lst)]
+        with transaction.atomic():
+            Movie_recommend.objects.all().delete()
+            Movie_recommend.objects.bulk_create(rows, batch_size=options['batch_size'])
+        written = time.perf_counter()
+        self.stdout.write('%d个用户，%d条推荐；加载 %.2fs，计算 %.2fs（%d个进程），写入 %.2fs' % (
+            len(results), len(rows), loaded - start, computed - loaded, options['workers'], written - computed))
@@ -0,0 +1,23 @@
+'''
+重建电影搜索的全文索引（见 movie/search.py）：
+
+    python manage.py rebuild_search_index
+
+平时电影保存、删除时会自动更新索引；bulk_create 或者直接改数据库导入电影之后用这个命令重建。
+'''
+import time
+
+from django.core.management.base import BaseCommand
+
+from movie import search
+
+
+class Command(BaseCommand):
+    help = '重建电影搜索的全文索引'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        backend = search.get_backend()
+        count = backend.rebuild()
+        self.stdout.write('%s：索引了%d部电影；用时 %.2fs' % (
+            type(backend).__name__, count, time.perf_counter() - start))
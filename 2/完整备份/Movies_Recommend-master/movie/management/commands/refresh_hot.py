@@ -0,0 +1,26 @@
+'''
+更新热门电影列表（Movie_hot）：
+
+    python manage.py refresh_hot            只重新统计上次之后评分有变化的电影
+    python manage.py refresh_hot --full     全部重新统计
+
+可以放在 crontab 里每隔几分钟跑一次，没有评分变化时只有几条很快的查询。
+'''
+import time
+
+from django.core.management.base import BaseCommand
+
+from movie.models import Movie_hot
+
+
+class Command(BaseCommand):
+    help = '更新热门电影列表，只重新统计评分有变化的电影'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100, help='列表里放多少部电影')
+        parser.add_argument('--full', action='store_true', help='全部重新统计')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        recounted = Movie_hot.refresh(size=options['size'], full=options['full'])
+        self.stdout.write('重新统计了%d部电影；用时 %.3fs' % (recounted, time.perf_counter() - start))
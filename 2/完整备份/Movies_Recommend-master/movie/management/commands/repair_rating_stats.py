@@ -0,0 +1,26 @@
+'''
+按 Movie_rating 重新计算每部电影的评分人数、总分和平均分（Movie.rating_count / rating_sum / rating_avg）：
+
+    python manage.py repair_rating_stats
+
+平时这几个字段在评分和删除评分时直接在数据库里加减；直接改过数据库、或者导入了评分数据之后用这个命令修正。
+整个过程是两条带子查询的 UPDATE，放在一个事务里。
+'''
+import time
+
+from django.core.management.base import BaseCommand
+
+from movie.models import Movie
+
+
+class Command(BaseCommand):
+    help = '重新计算所有电影的评分人数、总分和平均分'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        fields = ('id', 'rating_count', 'rating_sum')
+        before = set(Movie.objects.values_list(*fields))
+        rated = Movie.repair_rating_stats()
+        changed = len(set(Movie.objects.values_list(*fields)) - before)
+        self.stdout.write('%d部电影有评分，%d部的评分数据被修正；用时 %.2fs' % (
+            rated, changed, time.perf_counter() - start))
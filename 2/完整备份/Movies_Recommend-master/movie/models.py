@@ -1,7 +1,9 @@
 
-from django.db import models
-from django.db.models import Avg
+from django.db import models, transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.core import validators
+from django.utils import timezone
 
 
 class Genre(models.Model):
@@ -38,6 +40,12 @@ class Movie(models.Model):
     actors = models.CharField(max_length=512, blank=True)
     # 电影和电影之间的相似度,A和B的相似度与B和A的相似度是一致的，所以symmetrical设置为True
     movie_similarity=models.ManyToManyField("self",through="Movie_similarity",symmetrical=False)
+    # 评分人数、总分和平均分，评分变化时在数据库里直接加减（update_rating），repair_rating_stats 命令可以全部重算
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.FloatField(default=0)
+    rating_avg = models.FloatField(default=0)
+    # 最近一次评分变化的时间，refresh_hot 命令只重新统计这之后有变化的电影
+    rating_updated = models.DateTimeField(null=True, blank=True, db_index=True)
 
     class Meta:
         db_table = 'Movie'
@@ -48,15 +56,33 @@ class Movie(models.Model):
 
     def get_score(self):
         # 定义一个获取平均分的方法，模板中直接调用即可
-        # 格式 {'score__avg': 3.125}
-        result_dct = self.movie_rating_set.aggregate(Avg('score'))
-        try:
-            # 只保留一位小数
-            result = round(result_dct['score__avg'], 1)
-        except TypeError:
+        # 平均分存在 rating_avg 里，不用每次都对评分表做 AVG
+        if not self.rating_count:
             return 0
-        else:
-            return result
+        # 只保留一位小数
+        return round(self.rating_avg, 1)
+
+    def update_rating(self, count, score):
+        '''评分人数加 count，总分加 score（都可以是负数），用 F 表达式在数据库里加减，同时评分的人不会互相覆盖'''
+        movies = Movie.objects.filter(pk=self.pk)
+        with transaction.atomic():
+            movies.update(rating_count=F('rating_count') + count, rating_sum=F('rating_sum') + score,
+                          rating_updated=timezone.now())
+            # 平均分单独更新：MySQL 的 UPDATE 里后面的赋值会用到前面刚改过的值，其他数据库用的是旧值
+            movies.update(rating_avg=average_expression())
+        self.refresh_from_db(fields=['rating_count', 'rating_sum', 'rating_avg', 'rating_updated'])
+
+    @classmethod
+    def repair_rating_stats(cls):
+        '''按 Movie_rating 重新计算所有电影的评分人数、总分和平均分，返回有评分的电影数'''
+        ratings = Movie_rating.objects.filter(movie=OuterRef('pk')).order_by().values('movie')
+        count = ratings.annotate(n=Count('id')).values('n')
+        total = ratings.annotate(s=Sum('score')).values('s')
+        with transaction.atomic():
+            cls.objects.update(rating_count=Coalesce(Subquery(count, output_field=models.IntegerField()), 0),
+                               rating_sum=Coalesce(Subquery(total, output_field=models.FloatField()), 0.0))
+            cls.objects.update(rating_avg=average_expression())
+        return cls.objects.filter(rating_count__gt=0).count()
 
     def get_user_score(self, user):
         #返回特定用户对电影的评分
@@ -68,21 +94,26 @@ class Movie(models.Model):
 
     def get_genre(self):
         #返回与电影相关联的流派或类型列表
-        genre_dct = self.genre.all().values('name')
-        genre_lst = []
-        for dct in genre_dct.values():
-            genre_lst.append(dct['name'])
-        return genre_lst
+        # 用 genre.all()，列表页面 prefetch_related('genre') 之后不会每部电影再查一次
+        return [genre.name for genre in self.genre.all()]
 
     def get_similarity(self,k=5):
         #获取与当前电影最相似的前k部电影
         # 获取5部最相似的电影的id
-        similarity_movies=self.movie_similarity.all()[:k]
+        # 按中间表里的相似度从高到低取，build_similarity 命令给每部电影存了最相似的几部
+        similarity_movies=self.movie_similarity.order_by('-movie_target__similarity')[:k]
         print(similarity_movies)
         # movies=Movie.objects.filter(=similarity_movies)
         # print(movies)
         return similarity_movies
 
+def average_expression():
+    # rating_sum / rating_count，没有评分时是0
+    return Case(When(rating_count=0, then=Value(0.0)),
+                default=ExpressionWrapper(F('rating_sum') / F('rating_count'), output_field=models.FloatField()),
+                output_field=models.FloatField())
+
+
 class Movie_similarity(models.Model):
     #通过此模型，可以方便地检索和操作电影之间的相似度信息。
     movie_source=models.ForeignKey(Movie,related_name='movie_source',on_delete=models.CASCADE)
@@ -120,12 +151,64 @@ class Movie_rating(models.Model):
         db_table = 'Movie_rating'
 
 class Movie_hot(models.Model):
-    '''存放最热门的一百部电影'''
+    '''存放最热门的一百部电影，由 refresh_hot 命令更新'''
     # 电影外键
     #表示当关联的电影被删除时，与之关联的热门电影也会被级联删除
     movie=models.ForeignKey(Movie,on_delete=models.CASCADE)
     # 评分人数
     rating_number=models.IntegerField()
+    # 排第几，从0开始，评分人数相同的按电影id从小到大排
+    rank=models.IntegerField(default=0, db_index=True)
+    # 统计的时间，下次只重新统计这之后评分有变化的电影
+    updated=models.DateTimeField(null=True, blank=True)
     class Meta:
         db_table='Movie_hot'
-        ordering=['-rating_number']
+        ordering=['rank']
+
+    @classmethod
+    def refresh(cls, size=100, full=False):
+        '''
+        更新热门电影列表，返回重新统计了多少部电影。
+        只对上次统计之后评分有变化的电影在 Movie_rating 里重新数一遍评分人数，和原来的列表合在一起取前 size 个；
+        原来在列表里的电影评分人数变少了的话，排在列表外面的电影可能会进来，这时候全部重新统计。
+        '''
+        now = timezone.now()
+        since = cls.objects.aggregate(Max('updated'))['updated__max']
+        hot = dict(cls.objects.values_list('movie_id', 'rating_number'))
+        counts = Movie_rating.objects.order_by().values('movie').annotate(n=Count('id'))
+        if not full and since is not None and len(hot) >= size:
+            changed = Movie.objects.filter(rating_updated__gte=since).values('id')
+            recount = dict(counts.filter(movie__in=changed).values_list('movie', 'n'))
+            # 评分全部删掉了的电影不会出现在 GROUP BY 的结果里
+            recount.update((movie_id, 0) for movie_id in changed.values_list('id', flat=True) if movie_id not in recount)
+            if not recount:
+                return 0
+            full = any(count < hot[movie_id] for movie_id, count in recount.items() if movie_id in hot)
+        if full or since is None or len(hot) < size:
+            recount = dict(counts.order_by('-n', 'movie')[:size].values_list('movie', 'n'))
+            hot = {}
+        hot.update(recount)
+        ranking = sorted(((count, movie_id) for movie_id, count in hot.items() if count > 0),
+                         key=lambda item: (-item[0], item[1]))[:size]
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([cls(movie_id=movie_id, rating_number=count, rank=rank, updated=now)
+                                     for rank, (count, movie_id) in enumerate(ranking)])
+        return len(recount)
+
+class Movie_recommend(models.Model):
+    '''预先算好的每个用户的推荐结果，由 build_recommendations 命令批量生成'''
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE)
+    # 在推荐列表里排第几，从0开始
+    rank = models.IntegerField()
+    # 兴趣值，见 recommender.py
+    interest = models.FloatField()
+    # 计算的时间
+    created = models.DateTimeField()
+
+    class Meta:
+        db_table = 'Movie_recommend'
+        ordering = ['rank']
+        # 推荐页面按用户取出排好序的推荐结果
+        indexes = [models.Index(fields=['user', 'rank'], name='Movie_recommend_user_rank')]
@@ -0,0 +1,171 @@
+'''
+基于用户的协同过滤（UserCF），整个评分矩阵放在内存里计算。
+
+原来的 RecommendMovieView 每推荐一次要对其他 600 多个用户各查一次交集，再对 20 个相似用户各查一次评分，
+一个页面六百多条 SQL，要 3~4 秒。这里把 Movie_rating 一次读出来做成稀疏矩阵（用户 × 电影），
+当前用户和所有用户的相似度是一次稀疏矩阵乘法，候选电影的兴趣值是相似用户评分行的加和，
+取前 N 个用 argpartition，整个推荐在几毫秒内完成。
+
+相似度：
+    overlap  两个用户都评分过的电影数（和原来的视图一样），兴趣值是相似用户评分的直接加和
+    cosine   评分过的电影集合的余弦相似度，兴趣值按相似度加权
+
+矩阵加载一次之后缓存起来（get_engine），超过 max_age 秒或者调用 invalidate() 后重新加载。
+当前用户自己的评分每次都从数据库里取，刚刚评过的分马上就会影响他的推荐结果。
+
+item_neighbours 是 ItemCF 的电影相似度（详情页的相似电影），在同一个 0/1 评分矩阵上算：
+一批电影和所有电影共同被多少用户评分过是一次稀疏矩阵乘法，再除以两边评分人数乘积的平方根（余弦相似度），
+每部电影只留最相似的 k 部，见 build_similarity 命令。
+'''
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+
+from .models import Movie_rating
+
+OVERLAP = 'overlap'
+COSINE = 'cosine'
+
+
+def top_n(values, ids, n):
+    '''values 最大的 n 个的下标，值相同的按 ids 从小到大排（和原来的视图一样），边界上相同的值也不会随机取'''
+    n = min(n, len(values))
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    # argpartition 找出第 n 大的值，只对不小于它的那些排序
+    threshold = values[np.argpartition(-values, n - 1)[n - 1]]
+    candidates = np.flatnonzero(values >= threshold)
+    return candidates[np.lexsort((ids[candidates], -values[candidates]))][:n]
+
+
+class UserCF:
+    def __init__(self, K=20, N=10, similarity=OVERLAP):
+        # 最相似的K个用户
+        self.K = K
+        # 推荐出N个
+        self.N = N
+        self.similarity = similarity
+        self.user_ids = None  # 矩阵的第i行是哪个用户，升序
+        self.movie_ids = None  # 矩阵的第j列是哪部电影，升序
+        self.ratings = None  # 评分矩阵，csr
+        self.rated = None  # 是否评分过（0/1），csr，算交集用
+        self.user_counts = None  # 每个用户评分过几部电影
+        self.loaded_at = 0
+
+    def load(self, ratings=None):
+        '''从 Movie_rating 读出所有评分，ratings 可以直接给 [(user_id, movie_id, score), ...]'''
+        if ratings is None:
+            ratings = Movie_rating.objects.values_list('user_id', 'movie_id', 'score')
+        data = np.array(list(ratings), dtype=np.float64).reshape(-1, 3)
+        users = data[:, 0].astype(np.int64)
+        movies = data[:, 1].astype(np.int64)
+        self.user_ids = np.unique(users)
+        self.movie_ids = np.unique(movies)
+        rows = np.searchsorted(self.user_ids, users)
+        cols = np.searchsorted(self.movie_ids, movies)
+        shape = (len(self.user_ids), len(self.movie_ids))
+        self.ratings = sparse.csr_matrix((data[:, 2].astype(np.float32), (rows, cols)), shape=shape)
+        self.rated = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+        self.user_counts = np.asarray(self.rated.sum(axis=1)).ravel()
+        self.loaded_at = time.time()
+        return self
+
+    def _movie_vector(self, movie_ids):
+        # 把一组电影id变成矩阵列上的0/1向量，矩阵里没有的电影（还没人评过分）忽略
+        vector = np.zeros(len(self.movie_ids), dtype=np.float32)
+        vector[self._known_columns(movie_ids)] = 1
+        return vector
+
+    def _known_columns(self, movie_ids):
+        # 电影id对应的列号，矩阵里没有的电影去掉
+        movie_ids = np.asarray(list(movie_ids), dtype=np.int64)
+        if not len(movie_ids) or not len(self.movie_ids):
+            return np.zeros(0, dtype=np.int64)
+        cols = np.searchsorted(self.movie_ids, movie_ids)
+        cols = np.minimum(cols, len(self.movie_ids) - 1)
+        return cols[self.movie_ids[cols] == movie_ids]
+
+    def get_user_sim(self, user_id, rated_movie_ids, K=None):
+        '''当前用户和其他所有用户的相似度，返回最相似的K个：[(user_id, 相似度), ...]'''
+        K = K or self.K
+        vector = self._movie_vector(rated_movie_ids)
+        sim = self.rated @ vector  # 和每个用户评分过的电影的交集数
+        if self.similarity == COSINE:
+            norm = np.sqrt(self.user_counts * vector.sum())
+            sim = np.divide(sim, norm, out=np.zeros_like(sim), where=norm > 0)
+        # 自己不算
+        me = np.searchsorted(self.user_ids, user_id)
+        if me < len(self.user_ids) and self.user_ids[me] == user_id:
+            sim[me] = -np.inf
+        top = top_n(sim, self.user_ids, min(K, int(np.isfinite(sim).sum())))
+        return [(int(self.user_ids[i]), float(sim[i])) for i in top]
+
+    def recommend(self, user_id, rated_movie_ids, K=None, N=None):
+        '''根据最相似的K个用户，给用户推荐N部他没有评分过的电影，返回 [(movie_id, 兴趣值), ...]，兴趣值从高到低'''
+        N = N or self.N
+        rated_movie_ids = list(rated_movie_ids)
+        neighbours = self.get_user_sim(user_id, rated_movie_ids, K)
+        if not neighbours:
+            return []
+        rows = np.searchsorted(self.user_ids, [user for user, _ in neighbours])
+        weights = np.ones(len(rows), dtype=np.float32)
+        if self.similarity == COSINE:
+            weights = np.array([sim for _, sim in neighbours], dtype=np.float32)
+        # 相似用户评分的（加权）和，就是每部电影的兴趣值
+        interest = np.asarray(self.ratings[rows].T @ weights).ravel()
+        # 只推荐相似用户评分过、而且当前用户没有评分过的电影
+        seen = np.asarray(self.rated[rows].sum(axis=0)).ravel() > 0
+        seen[self._known_columns(rated_movie_ids)] = False
+        candidates = np.flatnonzero(seen)
+        top = candidates[top_n(interest[candidates], self.movie_ids[candidates], N)]
+        return [(int(self.movie_ids[j]), float(interest[j])) for j in top]
+
+    def rated_movies(self, user_id):
+        '''矩阵里这个用户评分过的电影id'''
+        i = np.searchsorted(self.user_ids, user_id)
+        if i >= len(self.user_ids) or self.user_ids[i] != user_id:
+            return []
+        return self.movie_ids[self.rated.indices[self.rated.indptr[i]:self.rated.indptr[i + 1]]]
+
+    def recommend_users(self, user_ids, K=None, N=None):
+        '''批量推荐，用户评分过的电影直接从矩阵里取：[(user_id, [(movie_id, 兴趣值), ...]), ...]'''
+        return [(user_id, self.recommend(user_id, self.rated_movies(user_id), K, N)) for user_id in user_ids]
+
+
+def item_neighbours(items, rated, counts, movie_ids, columns, k):
+    '''
+    columns 这些电影（矩阵的列号）各自最相似的k部电影：[(电影id, [(电影id, 相似度), ...]), ...]，相似度从高到低。
+    items 是 电影 × 用户 的 0/1 矩阵（csr），rated 是它的转置（用户 × 电影，csr），counts 是每部电影的评分人数。
+    '''
+    co = (items[columns] @ rated).tocsr()  # 两部电影共同被多少用户评分过，只有非零的部分
+    result = []
+    for row, col in enumerate(columns):
+        start, end = co.indptr[row], co.indptr[row + 1]
+        targets = co.indices[start:end]
+        sim = co.data[start:end] / np.sqrt(counts[col] * counts[targets])
+        sim[targets == col] = -np.inf  # 自己不算
+        top = top_n(sim, movie_ids[targets], min(k, int(np.isfinite(sim).sum())))
+        result.append((int(movie_ids[col]), [(int(movie_ids[targets[i]]), float(sim[i])) for i in top]))
+    return result
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(max_age=300):
+    '''进程里共用的 UserCF，第一次调用时加载，超过 max_age 秒重新加载'''
+    global _engine
+    with _engine_lock:
+        if _engine is None or time.time() - _engine.loaded_at > max_age:
+            _engine = UserCF().load()
+        return _engine
+
+
+def invalidate():
+    '''评分有变化，下次 get_engine 时重新加载'''
+    global _engine
+    with _engine_lock:
+        _engine = None
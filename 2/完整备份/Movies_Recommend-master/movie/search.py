@@ -0,0 +1,204 @@
+'''
+电影搜索：在电影名、导演、演员、编剧和简介上建全文索引（倒排索引），按相关度排序。
+
+原来的 SearchView 是 Movie.objects.filter(name__icontains=keyword)，LIKE '%x%' 用不上索引，
+每次都要扫一遍整个 Movie 表，而且只搜电影名。这里按数据库选择搜索后端：
+
+    sqlite  FTS5 虚拟表 movie_search，rowid 就是电影 id，bm25 按字段加权排序
+    mysql   Movie 表上的 FULLTEXT 索引，各字段的 MATCH ... AGAINST 加权求和排序
+    其他    各字段 icontains，没有索引，只是让别的数据库也能用
+
+也可以在 settings 里用 MOVIE_SEARCH_BACKEND 指定后端类的路径，比如 'movie.search.LikeBackend'。
+索引由迁移 0013 建好；电影保存、删除时通过信号更新这一部电影的索引（apps.py 里注册），
+批量导入（bulk_create 不发信号）之后用 python manage.py rebuild_search_index 重建。
+
+关键词按空格（和标点）分成几个词，每个词都要出现，最后一个词可以只输入前面一部分：
+“star wa” 能搜到 Star Wars。
+'''
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import Movie
+
+# 参与搜索的字段和权重，电影名里出现的最重要
+WEIGHTS = (('name', 10.0), ('director', 4.0), ('actors', 3.0), ('writers', 2.0), ('intro', 1.0))
+FIELDS = tuple(field for field, _ in WEIGHTS)
+
+_WORD = re.compile(r'\w+')
+
+
+def split_keyword(keyword):
+    '''用户输入的关键词分成几个词，标点和 FTS5 / MySQL 的查询运算符都去掉'''
+    return _WORD.findall(keyword or '')
+
+
+class SearchResult:
+    '''按相关度排好序的电影id，分页时只把当前这一页的电影从数据库里取出来'''
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            ids = self.ids[index]
+            movies = Movie.objects.in_bulk(ids)
+            return [movies[movie_id] for movie_id in ids if movie_id in movies]
+        return Movie.objects.get(pk=self.ids[index])
+
+
+class FTS5Backend:
+    '''SQLite FTS5，movie_search 表里存一份各字段的文本'''
+    table = 'movie_search'
+
+    def match_query(self, keyword):
+        # 每个词是一个前缀查询，都要出现
+        return ' AND '.join('"%s"*' % word for word in split_keyword(keyword))
+
+    def search(self, keyword, limit=None):
+        match = self.match_query(keyword)
+        if not match:
+            return []
+        # bm25 越小越相关，参数是各字段的权重
+        sql = 'SELECT rowid FROM %s WHERE %s MATCH %%s ORDER BY bm25(%s, %s), rowid' % (
+            self.table, self.table, self.table, ', '.join(str(weight) for _, weight in WEIGHTS))
+        params = [match]
+        if limit:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def update(self, movie):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.table, [movie.pk])
+            cursor.execute('INSERT INTO %s (rowid, %s) VALUES (%%s, %s)' % (
+                self.table, ', '.join(FIELDS), ', '.join(['%s'] * len(FIELDS))),
+                [movie.pk] + [getattr(movie, field) for field in FIELDS])
+
+    def delete(self, movie_id):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.table, [movie_id])
+
+    def rebuild(self):
+        '''清空索引，从 Movie 表重新导入，返回索引了多少部电影'''
+        columns = ', '.join(FIELDS)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % self.table)
+            cursor.execute('INSERT INTO %s (rowid, %s) SELECT id, %s FROM %s' % (
+                self.table, columns, columns, Movie._meta.db_table))
+            cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (self.table, self.table))
+            cursor.execute('SELECT COUNT(*) FROM %s' % self.table)
+            return cursor.fetchone()[0]
+
+
+class MySQLBackend:
+    '''
+    MySQL FULLTEXT 索引：五个字段合在一起一个索引用来过滤，每个字段单独一个索引用来算加权的相关度。
+    InnoDB 在事务提交时自己维护 FULLTEXT 索引，电影改动时不用做什么。
+    '''
+
+    def match_query(self, keyword):
+        # BOOLEAN MODE：+ 表示必须出现，* 表示前缀
+        return ' '.join('+%s*' % word for word in split_keyword(keyword))
+
+    def search(self, keyword, limit=None):
+        match = self.match_query(keyword)
+        if not match:
+            return []
+        against = 'AGAINST (%s IN BOOLEAN MODE)'
+        score = ' + '.join('%s * MATCH (`%s`) %s' % (weight, field, against) for field, weight in WEIGHTS)
+        sql = 'SELECT id FROM `%s` WHERE MATCH (%s) %s ORDER BY %s DESC, id' % (
+            Movie._meta.db_table, ', '.join('`%s`' % field for field in FIELDS), against, score)
+        params = [match] * (len(WEIGHTS) + 1)
+        if limit:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def update(self, movie):
+        pass
+
+    def delete(self, movie_id):
+        pass
+
+    def rebuild(self):
+        # 重建表和 FULLTEXT 索引，整理掉删除和修改留下的旧记录
+        with connection.cursor() as cursor:
+            cursor.execute('OPTIMIZE TABLE `%s`' % Movie._meta.db_table)
+            cursor.fetchall()
+        return Movie.objects.count()
+
+
+class LikeBackend:
+    '''没有全文索引的数据库：各字段 icontains，匹配到的字段权重加起来排序'''
+
+    def search(self, keyword, limit=None):
+        words = split_keyword(keyword)
+        if not words:
+            return []
+        movies = Movie.objects.all()
+        score = Value(0, output_field=IntegerField())
+        for word in words:
+            q = Q()
+            for field in FIELDS:
+                q |= Q(**{field + '__icontains': word})
+            movies = movies.filter(q)
+            for field, weight in WEIGHTS:
+                score = score + Case(When(**{field + '__icontains': word, 'then': Value(int(weight))}),
+                                     default=Value(0), output_field=IntegerField())
+        ids = movies.annotate(search_score=score).order_by('-search_score', 'id').values_list('id', flat=True)
+        return list(ids[:limit] if limit else ids)
+
+    def update(self, movie):
+        pass
+
+    def delete(self, movie_id):
+        pass
+
+    def rebuild(self):
+        return Movie.objects.count()
+
+
+BACKENDS = {
+    'sqlite': FTS5Backend,
+    'mysql': MySQLBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    '''当前数据库用的搜索后端，settings.MOVIE_SEARCH_BACKEND 可以指定'''
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'MOVIE_SEARCH_BACKEND', None)
+        backend_class = import_string(path) if path else BACKENDS.get(connection.vendor, LikeBackend)
+        _backend = backend_class()
+    return _backend
+
+
+def search(keyword, limit=None):
+    '''按相关度排好序的电影id'''
+    return get_backend().search(keyword, limit)
+
+
+@receiver(post_save, sender=Movie)
+def _movie_saved(sender, instance, **kwargs):
+    get_backend().update(instance)
+
+
+@receiver(post_delete, sender=Movie)
+def _movie_deleted(sender, instance, **kwargs):
+    get_backend().delete(instance.pk)
@@ -1,3 +1,135 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from . import recommender, search
+from .models import Genre, Movie, Movie_hot, Movie_rating, Movie_similarity, User
+
+
+class QueryBudgetTest(TestCase):
+    '''
+    每个页面最多执行几条 SQL。页面上每部电影的平均分、类型都要一次查出来，
+    哪个模板或者视图又变成了每部电影查一次，这里的条数就会超出，测试失败。
+    '''
+    MOVIES = 40
+
+    @classmethod
+    def setUpTestData(cls):
+        genres = [Genre.objects.create(name=name) for name in ('Drama', 'Comedy', 'Action')]
+        cls.movies = []
+        for i in range(1, cls.MOVIES + 1):
+            movie = Movie.objects.create(name='Movie %d' % i, imdb_id=i)
+            movie.genre.add(genres[i % 3], genres[(i + 1) % 3])
+            cls.movies.append(movie)
+        cls.users = [User.objects.create(name='user%d' % i, password='pw', email='user%d@test.com' % i)
+                     for i in range(10)]
+        # 每个用户评分一部分电影，互相有交集，UserCF 能推荐出东西
+        Movie_rating.objects.bulk_create([
+            Movie_rating(user=user, movie=movie, score=(i + j) % 5 + 1)
+            for i, user in enumerate(cls.users) for j, movie in enumerate(cls.movies) if (i + j) % 3])
+        Movie.repair_rating_stats()
+        Movie_hot.refresh(size=30)
+        Movie_similarity.objects.bulk_create([
+            Movie_similarity(movie_source=cls.movies[0], movie_target=movie, similarity=1.0 / (j + 1))
+            for j, movie in enumerate(cls.movies[1:6])])
+        cls.user = cls.users[0]
+        # 这个用户只评分了几部电影，推荐列表是满的
+        Movie_rating.objects.filter(user=cls.user, movie__in=cls.movies[10:]).delete()
+        Movie.repair_rating_stats()
+
+    def setUp(self):
+        recommender.invalidate()
+        session = self.client.session
+        session['user_id'] = self.user.pk
+        session.save()
+
+    def assertMaxQueries(self, limit, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        queries = '\n'.join(query['sql'] for query in context.captured_queries)
+        self.assertLessEqual(len(context), limit, '%s 执行了%d条 SQL：\n%s' % (url, len(context), queries))
+        return response
+
+    def test_index(self):
+        response = self.assertMaxQueries(4, reverse('movie:index'))
+        self.assertEqual(len(response.context['movies']), 15)
+
+    def test_index_last_page(self):
+        self.assertMaxQueries(4, reverse('movie:index') + '?p=3')
+
+    def test_tag(self):
+        response = self.assertMaxQueries(5, reverse('movie:tag') + '?genre=Drama')
+        self.assertTrue(response.context['movies'])
+
+    def test_search(self):
+        response = self.assertMaxQueries(4, reverse('movie:search') + '?keyword=Movie')
+        self.assertEqual(len(response.context['movies']), 15)
+
+    def test_search_last_page(self):
+        response = self.assertMaxQueries(4, reverse('movie:search') + '?keyword=Movie&p=3')
+        self.assertEqual(len(response.context['movies']), 10)
+
+    def test_hot(self):
+        response = self.assertMaxQueries(4, reverse('movie:hot'))
+        self.assertEqual(len(response.context['movies']), 15)
+
+    def test_recommend_computed(self):
+        # 没有预先算好的推荐结果：当场计算并写进 Movie_recommend
+        response = self.assertMaxQueries(8, reverse('movie:recommend'))
+        self.assertEqual(len(response.context['movies']), 10)
+
+    def test_recommend_stored(self):
+        self.client.get(reverse('movie:recommend'))
+        response = self.assertMaxQueries(4, reverse('movie:recommend'))
+        self.assertEqual(len(response.context['movies']), 10)
+
+    def test_detail(self):
+        response = self.assertMaxQueries(9, reverse('movie:detail', args=(self.movies[0].pk,)))
+        self.assertEqual(len(response.context['similarity_movies']), 5)
+
+    def test_history(self):
+        response = self.assertMaxQueries(5, reverse('movie:history', args=(self.user.pk,)))
+        self.assertTrue(response.context['ratings'])
+
+
+class SearchTest(TransactionTestCase):
+    '''
+    全文搜索：各字段加权排序，电影改动后索引马上更新。
+    MySQL 的 FULLTEXT 索引在事务提交之后才更新，所以不能用 TestCase（每个测试都在一个不提交的事务里）。
+    '''
+
+    def setUp(self):
+        self.title = Movie.objects.create(name='The Matrix', imdb_id=1, director='Lana Wachowski')
+        self.intro = Movie.objects.create(name='Dark City', imdb_id=2, intro='A man wakes up inside a matrix of memories.')
+        self.actor = Movie.objects.create(name='Speed', imdb_id=3, actors='Keanu Reeves, Sandra Bullock')
+        # 每个测试之后只清空了 Django 的表，索引里可能还有上一个测试的电影
+        search.get_backend().rebuild()
+
+    def test_fields_and_ranking(self):
+        # 电影名里出现的排在简介里出现的前面
+        self.assertEqual(search.search('matrix'), [self.title.pk, self.intro.pk])
+        self.assertEqual(search.search('keanu'), [self.actor.pk])
+        self.assertEqual(search.search('wachowski matrix'), [self.title.pk])
+
+    def test_prefix(self):
+        self.assertEqual(search.search('matr'), [self.title.pk, self.intro.pk])
+
+    def test_punctuation(self):
+        self.assertEqual(search.search('"matrix" (*'), [self.title.pk, self.intro.pk])
+        self.assertEqual(search.search('  '), [])
+
+    def test_update_and_delete(self):
+        self.actor.actors = 'Dennis Hopper'
+        self.actor.save()
+        self.assertEqual(search.search('keanu'), [])
+        self.assertEqual(search.search('hopper'), [self.actor.pk])
+        self.intro.delete()
+        self.assertEqual(search.search('matrix'), [self.title.pk])
+
+    def test_rebuild(self):
+        Movie.objects.filter(pk=self.actor.pk).update(name='Speed Racer')  # update 不发信号
+        self.assertEqual(search.search('racer'), [])
+        self.assertEqual(search.get_backend().rebuild(), 3)
+        self.assertEqual(search.search('racer'), [self.actor.pk])
@@ -3,12 +3,15 @@ import time
 import os.path
 from math import sqrt
 from django.contrib import messages
+from django.db import transaction
 from django.db.models import Avg, Count, Max
 from django.http import HttpResponse, request
 from django.shortcuts import render, redirect, reverse
+from django.utils import timezone
 from .forms import RegisterForm, LoginForm, CommentForm
 from django.views.generic import View, ListView, DetailView
-from .models import User, Movie, Genre, Movie_rating, Movie_similarity, Movie_hot
+from .models import User, Movie, Genre, Movie_rating, Movie_similarity, Movie_hot, Movie_recommend
+from . import recommender, search
 
 # DO NOT MAKE ANY CHANGES
 BASE = os.path.dirname(os.path.abspath(__file__))
@@ -69,10 +72,8 @@ class PopularMovieView(ListView):
     page_kwarg = 'p'
 
     def get_queryset(self):
-        # movie_hot__rating_number 的最大值进行注解，并按照该字段降序排列，以获取热门电影列表。
-        hot_movies=Movie_hot.objects.all().values("movie_id")
-        movies=Movie.objects.filter(id__in=hot_movies).annotate(nums=Max('movie_hot__rating_number')).order_by('-nums')
-        return movies
+        # refresh_hot 命令已经排好了名次，沿着 rank 索引顺序取，电影一起 JOIN 出来
+        return Movie_hot.objects.select_related('movie').order_by('rank')
 
     def get_context_data(self, *, object_list=None, **kwargs):
 
@@ -172,10 +173,9 @@ class SearchView(ListView):
     page_kwarg = 'p'
 
     def get_queryset(self):
-        # 获取请求中的 'keyword' 参数，并根据电影名中包含该关键字的电影进行过滤。
-        movies = Movie.objects.filter(name__icontains=self.request.GET.dict()['keyword'])
-        print(movies)
-        return movies
+        # 获取请求中的 'keyword' 参数，在电影名、导演、演员、编剧和简介的全文索引里搜索，按相关度排序，见 search.py
+        # 分页时只取当前这一页的电影
+        return search.SearchResult(search.search(self.request.GET.dict()['keyword']))
 
     def get_context_data(self, *, object_list=None, **kwargs):
         # self.genre=self.request.GET.dict()['genre']
@@ -328,20 +328,25 @@ class MovieDetailView(DetailView):#用于展示单个对象的详细信息
             user = User.objects.get(pk=user_id)
             movie = Movie.objects.get(pk=pk)
 
-            # 更新一条记录
-            rating = Movie_rating.objects.filter(user=user, movie=movie).first()
-            if rating:
-                # 如果存在则更新
-                # print(rating)
-                rating.score = score
-                rating.comment = comment
-                rating.save()
-                # messages.info(request,"更新评分成功！")
-            else:
-                print('记录不存在')
-                # 如果不存在则添加
-                rating = Movie_rating(user=user, movie=movie, score=score, comment=comment)
-                rating.save()
+            # 更新一条记录，同时更新电影的评分人数和总分；锁住这条评分，旧分数不会被同时提交的另一次修改改掉
+            with transaction.atomic():
+                rating = Movie_rating.objects.select_for_update().filter(user=user, movie=movie).first()
+                if rating:
+                    # 如果存在则更新
+                    # print(rating)
+                    movie.update_rating(0, score - rating.score)
+                    rating.score = score
+                    rating.comment = comment
+                    rating.save()
+                    # messages.info(request,"更新评分成功！")
+                else:
+                    print('记录不存在')
+                    # 如果不存在则添加
+                    rating = Movie_rating(user=user, movie=movie, score=score, comment=comment)
+                    rating.save()
+                    movie.update_rating(1, score)
+            # 评分变了，预先算好的推荐已经不准，下次打开推荐页面时重新计算
+            Movie_recommend.objects.filter(user=user).delete()
             messages.info(request, "评论成功!")
 
         else:
@@ -363,7 +368,7 @@ class RatingHistoryView(DetailView):
         user_id = self.request.session['user_id']
         user = User.objects.get(pk=user_id)
         # 获取ratings即可
-        ratings = Movie_rating.objects.filter(user=user)
+        ratings = Movie_rating.objects.filter(user=user).select_related('movie')
 
         context.update({'ratings': ratings})
         return context
@@ -376,9 +381,12 @@ def delete_recode(request, pk):
     user_id = request.session['user_id']
     print(user_id)
     user = User.objects.get(pk=user_id)
-    rating = Movie_rating.objects.get(user=user, movie=movie)
-    print(movie, user, rating)
-    rating.delete()
+    with transaction.atomic():
+        rating = Movie_rating.objects.select_for_update().get(user=user, movie=movie)
+        print(movie, user, rating)
+        rating.delete()
+        movie.update_rating(-1, -rating.score)
+    Movie_recommend.objects.filter(user=user).delete()
     messages.info(request, f"删除 {movie.name} 评分记录成功！")
     # 跳转回评分历史
     return redirect(reverse('movie:history', args=(user_id,)))
@@ -399,67 +407,35 @@ class RecommendMovieView(ListView):
         self.K = 20
         # 推荐出10个
         self.N = 10
-        # 存放当前用户评分过的电影querySet
-        self.cur_user_movie_qs = None
-
-    def get_user_sim(self):
-        #获取与当前用户相似度最高的 K 个用户
-        # 用户相似度字典，格式为{ user_id1:val , user_id2:val , ... }
-        user_sim_dct = dict()
-        '''获取用户之间的相似度,存放在user_sim_dct中'''
-        # 获取当前用户
-        cur_user_id = self.request.session['user_id']
-        cur_user = User.objects.get(pk=cur_user_id)
-        # 获取其它用户
-        other_users = User.objects.exclude(pk=cur_user_id)
-
-        self.cur_user_movie_qs = Movie.objects.filter(user=cur_user)
-
-        # 计算当前用户与其他用户评分过的电影交集数
-        for user in other_users:
-            # 记录感兴趣的数量
-            user_sim_dct[user.id] = len(Movie.objects.filter(user=user) & self.cur_user_movie_qs)
-
-        # 按照key排序value，返回K个最相近的用户
-        print("user similarity calculated!")
-        # 格式是 [ (user, value), (user, value), ... ]
-        return sorted(user_sim_dct.items(), key=lambda x: -x[1])[:self.K]
-
-    def get_recommend_movie(self, user_lst):
-        #基于相似用户列表，获取推荐的电影列表。
-        #遍历相似用户列表，获取这些相似用户评分过的电影，并根据用户评分，计算电影的兴趣值。
-        #返回按兴趣值排序的前N个电影。
-        # 电影兴趣值字典，{ movie:value, movie:value , ...}
-        movie_val_dct = dict()
-        # print(f'cur_user_movie_qs:{self.cur_user_movie_qs},type:{type(self.cur_user_movie_qs)}')
-        # print(Movie.objects.all() & self.cur_user_movie_qs)
-        # 用户，相似度
-        for user, _ in user_lst:
-            # 获取相似用户评分过的电影，并且不在前用户的评分列表中的，再加上score字段，方便计算兴趣值
-            movie_set = Movie.objects.filter(user=user).exclude(id__in=self.cur_user_movie_qs).annotate(
-                score=Max('movie_rating__score'))
-            for movie in movie_set:
-                movie_val_dct.setdefault(movie, 0)
-                # 累计用户的评分
-                movie_val_dct[movie] += movie.score
-        print('recommend movie list calculated!')
-        return sorted(movie_val_dct.items(), key=lambda x: -x[1])[:self.N]
 
     def get_queryset(self):
         #获取要展示的对象列表（推荐的电影列表）
         s = time.time()
-        # 获得最相似的K个用户列表
-        user_lst = self.get_user_sim()
-        # 获得推荐电影的id
-        movie_lst = self.get_recommend_movie(user_lst)
-        print(movie_lst)
-        result_lst = []
-        for movie, _ in movie_lst:
-            result_lst.append(movie)
+        cur_user_id = self.request.session['user_id']
+        # 先取 build_recommendations 预先算好的推荐结果，一条按 (user, rank) 索引的查询
+        # 模板里每部电影都要显示类型，一起 prefetch，不用每部电影查一次
+        recommends = Movie_recommend.objects.filter(user_id=cur_user_id).select_related('movie')
+        result_lst = [rec.movie for rec in recommends.prefetch_related('movie__genre').order_by('rank')]
+        if not result_lst:
+            # 新用户或者刚改过评分的用户还没有预先算好的结果，当场算一次并存起来
+            result_lst = self.compute_recommend(cur_user_id)
         e = time.time()
         print(f"用时:{e - s}")
         return result_lst
 
+    def compute_recommend(self, cur_user_id):
+        # 当前用户评分过的电影直接从数据库取，刚评过的分马上就算进去
+        rated = Movie_rating.objects.filter(user_id=cur_user_id).values_list('movie_id', flat=True)
+        # 相似度和兴趣值都在内存里的评分矩阵上算，见 recommender.py
+        movie_lst = recommender.get_engine().recommend(cur_user_id, rated, K=self.K, N=self.N)
+        print(movie_lst)
+        movies = Movie.objects.prefetch_related('genre').in_bulk([movie_id for movie_id, _ in movie_lst])
+        now = timezone.now()
+        Movie_recommend.objects.bulk_create([
+            Movie_recommend(user_id=cur_user_id, movie_id=movie_id, rank=rank, interest=interest, created=now)
+            for rank, (movie_id, interest) in enumerate(movie_lst) if movie_id in movies])
+        return [movies[movie_id] for movie_id, _ in movie_lst if movie_id in movies]
+
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super(RecommendMovieView, self).get_context_data(*kwargs)
         paginator = context.get('paginator')
@@ -0,0 +1,33 @@
+# Generated by Django 2.0 on 2026-10-18 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0009_auto_20200514_2052'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Movie_recommend',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.IntegerField()),
+                ('interest', models.FloatField()),
+                ('created', models.DateTimeField()),
+                ('movie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='movie.Movie')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='movie.User')),
+            ],
+            options={
+                'db_table': 'Movie_recommend',
+                'ordering': ['rank'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='movie_recommend',
+            index=models.Index(fields=['user', 'rank'], name='Movie_recommend_user_rank'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.0 on 2026-10-18 11:00
+
+from django.db import migrations, models
+from django.db.models import Case, Count, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+
+def fill_rating_stats(apps, schema_editor):
+    # 和 Movie.repair_rating_stats 一样，按已有的评分算出每部电影的评分人数、总分和平均分
+    Movie = apps.get_model('movie', 'Movie')
+    Movie_rating = apps.get_model('movie', 'Movie_rating')
+    ratings = Movie_rating.objects.filter(movie=OuterRef('pk')).order_by().values('movie')
+    count = ratings.annotate(n=Count('id')).values('n')
+    total = ratings.annotate(s=Sum('score')).values('s')
+    Movie.objects.update(rating_count=Coalesce(Subquery(count, output_field=models.IntegerField()), 0),
+                         rating_sum=Coalesce(Subquery(total, output_field=models.FloatField()), 0.0))
+    Movie.objects.update(rating_avg=Case(
+        When(rating_count=0, then=Value(0.0)),
+        default=ExpressionWrapper(F('rating_sum') / F('rating_count'), output_field=models.FloatField()),
+        output_field=models.FloatField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0010_movie_recommend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='rating_avg',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='rating_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(fill_rating_stats, migrations.RunPython.noop),
+    ]
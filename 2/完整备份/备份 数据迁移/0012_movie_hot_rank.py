@@ -0,0 +1,41 @@
+# Generated by Django 2.0 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+def fill_rank(apps, schema_editor):
+    # 已有的热门电影按评分人数排好名次
+    Movie_hot = apps.get_model('movie', 'Movie_hot')
+    for rank, hot in enumerate(Movie_hot.objects.order_by('-rating_number', 'movie_id')):
+        hot.rank = rank
+        hot.save(update_fields=['rank'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0011_movie_rating_stats'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='movie_hot',
+            options={'ordering': ['rank']},
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='rating_updated',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='movie_hot',
+            name='rank',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='movie_hot',
+            name='updated',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_rank, migrations.RunPython.noop),
+    ]
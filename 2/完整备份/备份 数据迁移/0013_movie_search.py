@@ -0,0 +1,40 @@
+# Generated by Django 2.0 on 2026-10-18 13:00
+
+from django.db import migrations
+
+# 参与搜索的字段，和 movie/search.py 里的 FIELDS 一样
+FIELDS = ('name', 'director', 'actors', 'writers', 'intro')
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    columns = ', '.join(FIELDS)
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE movie_search USING fts5 (%s, tokenize="unicode61 remove_diacritics 2")' % columns)
+        schema_editor.execute('INSERT INTO movie_search (rowid, %s) SELECT id, %s FROM Movie' % (columns, columns))
+    elif vendor == 'mysql':
+        # 合在一起的索引用来过滤，每个字段单独的索引用来算加权的相关度
+        indexes = ['ADD FULLTEXT INDEX movie_search (%s)' % columns]
+        indexes += ['ADD FULLTEXT INDEX movie_search_%s (%s)' % (field, field) for field in FIELDS]
+        schema_editor.execute('ALTER TABLE Movie %s' % ', '.join(indexes))
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE movie_search')
+    elif vendor == 'mysql':
+        indexes = ['DROP INDEX movie_search'] + ['DROP INDEX movie_search_%s' % field for field in FIELDS]
+        schema_editor.execute('ALTER TABLE Movie %s' % ', '.join(indexes))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0012_movie_hot_rank'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]